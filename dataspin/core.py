@@ -1,4 +1,6 @@
 import atexit
+from concurrent.futures import ThreadPoolExecutor
+from collections.abc import Mapping
 from functools import partial
 import os
 import json
@@ -7,23 +9,27 @@ import datetime
 import time
 import tempfile
 import importlib
-from boltons.fileutils import atomic_save, iter_find_files
+import threading
+from boltons.fileutils import AtomicSaver, atomic_save
 from dataspin.data import AppSystemData, DataFileMessage
-from dataspin.model import SystemDatabase
 from dataspin.pkindex.pk_index import IndexSearcher, PKIndexCache
+from dataspin.pkindex.pk_cache import PKCache
 
 from dataspin.providers import get_provider
 from dataspin.utils import common
 from dataspin.utils.file import DataFileReader
-from dataspin.utils.schedule import add_schedule, run_scheduler
+from dataspin.utils.multipart import DirectSaver
+from dataspin.utils.memory_tier import MemoryTier
+from dataspin.utils.object_cache import ObjectCache
+from dataspin.utils.registry import RunRegistry
+from dataspin.utils.uploader import (BackgroundUploader, DEFAULT_UPLOAD_CONCURRENCY, DEFAULT_UPLOAD_RETRIES,
+                                     DEFAULT_UPLOAD_BACKOFF)
+from dataspin.utils.schedule import HeapScheduler
 from dataspin.utils.common import uuid_generator, marshal, format_timestring,parse_url, get_file_md5
-from dataspin.providers import get_provider
-from dataspin.utils.schedule import add_schedule, run_scheduler
 from dataspin.functions import creat_function_with
-from dataspin.utils.file import DataFileReader
 from basepy.log import logger
 from .project import ProjectConfig
-from .runner import ProcessJobRunner
+from .runner import ProcessJobRunner, WorkerPoolJobRunner
 
 
 class DataSource:
@@ -45,7 +51,7 @@ class DataSource:
         datasets = self._do_fetch(fetch_args)
         data_files = []
         for key in datasets.keys():
-            file_path = os.path.join(context.temp_dir, f"source_{key}.jsonl")
+            file_path = context.temp_path(f"source_{key}.jsonl")
             with atomic_save(file_path, text_mode=False) as fo:
                 for data in datasets[key]:
                     line = "{}\n".format(marshal(data))
@@ -115,12 +121,23 @@ class DataStream:
         dm = DataFileMessage(file_url=file_url, tags=tags)
         self._provider.send_message(dm.to_dict())
 
+    def flush_sends(self):
+        """
+        wait for messages a provider sends asynchronously, raises if any failed
+        """
+        if hasattr(self.provider, 'flush_sends'):
+            self.provider.flush_sends()
+
     def get_nowait(self):
         return self.get(block=False)
 
     def task_done(self, context):
         return self.provider.task_done(context.data_file.file_path)
 
+    def close(self):
+        if hasattr(self.provider, 'close'):
+            self.provider.close()
+
 
 class DataFileStream:
     def __init__(self, data_files):
@@ -150,6 +167,9 @@ class DataFileStream:
         if data_file.file_path in self.processing_data_files:
             self.processing_data_files.remove(data_file)
 
+    def close(self):
+        pass
+
 
 class ObjectStorage:
     def __init__(self, conf):
@@ -157,6 +177,11 @@ class ObjectStorage:
         self._name = conf.name
         self._args = conf.args
         self._provider = get_provider(conf.url)
+        self._object_cache = None
+        self._uploader = None
+        if self._args.get('cache_dir') and self.storage_type not in ['local', 'file']:
+            max_bytes = common.convert_size_to_bytes(self._args.get('cache_max_size', '1GB'))
+            self._object_cache = ObjectCache(self._args['cache_dir'], max_bytes)
 
     @property
     def name(self):
@@ -166,8 +191,23 @@ class ObjectStorage:
     def provider(self):
         return self._provider
 
+    @property
+    def object_cache(self):
+        return self._object_cache
+
     def fetch_file(self, file_path):
-        for fp in self._provider.fetch_file(file_path):
+        """
+        With cache_dir in storage args, reads go through a local disk cache keyed by ETag.
+        """
+        if not self._object_cache:
+            yield from self._provider.fetch_file(file_path)
+            return
+        etag = self._provider.head(file_path)['etag']
+        fp = self._object_cache.get(file_path, etag)
+        if fp is None:
+            for remote_fp in self._provider.fetch_file(file_path):
+                fp = self._object_cache.put(file_path, etag, remote_fp)
+        with fp:
             yield fp
 
     @property
@@ -179,16 +219,52 @@ class ObjectStorage:
         return self._provider.storage_type
 
     def get(self, prefix=None):
-        yield self._provider.get(prefix)
+        yield from self._provider.get(prefix)
 
-    def save(self, key, local_file):
-        return self.provider.save(key, local_file)
+    @property
+    def uploader(self):
+        """
+        Background upload pool of this storage, tuned with the storage args
+        upload_concurrency, upload_retries and upload_backoff (seconds).
+        """
+        if self._uploader is None:
+            self._uploader = BackgroundUploader(
+                concurrency=self._args.get('upload_concurrency', DEFAULT_UPLOAD_CONCURRENCY),
+                retries=self._args.get('upload_retries', DEFAULT_UPLOAD_RETRIES),
+                backoff=self._args.get('upload_backoff', DEFAULT_UPLOAD_BACKOFF))
+        return self._uploader
+
+    def save(self, key, local_file, skip_unchanged=False, move=False, checksum=None, link=False):
+        """
+        with skip_unchanged, an object already holding the same content is not uploaded again.
+        with move, a local storage may rename local_file into place instead of copying it.
+        with link, a local storage may hardlink it, for working files of a run only.
+        checksum is the md5 of local_file when known, then an object holding it is not
+        written again even if local_file is gone, e.g. moved there by an earlier attempt.
+        """
+        kwargs = {}
+        if skip_unchanged and not checksum:
+            checksum = get_file_md5(local_file)
+        if checksum:
+            kwargs['checksum'] = checksum
+        if move and self.storage_type in ['local', 'file']:
+            kwargs['move'] = True
+        if link and self.storage_type in ['local', 'file']:
+            kwargs['link'] = True
+        return self.provider.save(key, local_file, **kwargs)
+
+    def save_async(self, key, local_file, skip_unchanged=False, move=False, checksum=None, link=False):
+        """
+        queue the upload on the background pool, return a future of the saved path
+        """
+        return self.uploader.submit(self.save, key, local_file, skip_unchanged, move, checksum, link)
 
     def save_data(self, key, lines):
         return self.provider.save_data(key, lines)
 
-    def fetch_file(self, path):
-        return self.provider.fetch_file(path)
+    def close(self):
+        if self._uploader is not None:
+            self._uploader.close()
 
 
 class DataView:
@@ -230,27 +306,59 @@ class DataFile:
         self.generation_time = datetime.datetime.now()
         self.tags = tags
         self.provider = provider
+        self._md5 = None
 
     @property
     def basename(self):
         return '{}{}'.format(self.name, self.ext)
 
+    @property
+    def md5(self):
+        # files are not changed once created, the md5 is taken at the first checkpoint
+        if self._md5 is None:
+            self._md5 = get_file_md5(self.file_path)
+        return self._md5
+
     def serialize(self):
+        storage = getattr(self.provider, 'name', None)
         return {'name': self.name,
                 'ext': self.ext,
                 'file_path': self.file_path,
                 'file_type': self.file_type,
                 'file_format': self.file_format,
-                'md5': get_file_md5(self.file_path),
+                'md5': '' if storage else self.md5,
+                'storage': storage,
                 'tags': self.tags}
 
     @classmethod
-    def deserialize(cls, meta):
-        if get_file_md5(meta['file_path']) != meta['md5']:
-            return None
-        return DataFile(file_path=meta['file_path'],
-                        file_type=meta['file_type'],
-                        tags=meta['tags'])
+    def deserialize(cls, meta, engine=None, verify=True, moved=False):
+        """
+        files living in a storage are restored with it, local files only if unchanged, or
+        gone when moved says a save with move may have moved them into place. Without
+        verify the file is restored as recorded, it may have been released since.
+        """
+        provider = None
+        if meta.get('storage') and engine:
+            provider = engine.storages.get(meta['storage'])
+        elif verify and get_file_md5(meta['file_path']) != meta['md5']:
+            if os.path.exists(meta['file_path']) or not moved:
+                return None
+        data_file = DataFile(file_path=meta['file_path'],
+                             file_type=meta['file_type'],
+                             tags=meta['tags'],
+                             provider=provider)
+        data_file._md5 = meta['md5'] or None
+        return data_file
+
+    def read_bytes(self):
+        if not self.provider:
+            with open(self.file_path, 'rb') as f:
+                return f.read()
+        for file in self.provider.fetch_file(self.file_path):
+            if isinstance(file, str):
+                with open(file, 'rb') as f:
+                    return f.read()
+            return file.read()
 
     def readlines(self):
         if not self.provider:
@@ -260,7 +368,10 @@ class DataFile:
                 yield data, line
         else:
             for file in self.provider.fetch_file(self.file_path):
-                file_reader = DataFileReader(file=file, ext=self.ext)
+                if isinstance(file, str):
+                    file_reader = DataFileReader(file_path=file, ext=self.ext)
+                else:
+                    file_reader = DataFileReader(file=file, ext=self.ext)
                 for (data, line) in file_reader.readlines():
                     yield data, line
 
@@ -275,8 +386,9 @@ class DataTaskContext:
         self.end_flag = False
         self.task_process_history = []
         self.engine = kwargs['engine']
-        self._process = kwargs['process']
+        self._process = kwargs.get('process')
         self.task_order = 0
+        self._direct_files = {}
 
     @property
     def data_file(self):
@@ -315,17 +427,128 @@ class DataTaskContext:
             'output_files': data_files
         })
 
+    def temp_path(self, file_name):
+        """
+        path for an intermediate file of this run, in the memory tier while it has room
+        """
+        tier = self.engine.memory_tier
+        if tier and tier.has_room():
+            return os.path.join(tier.run_dir(self.run_id), file_name)
+        return os.path.join(self.temp_dir, file_name)
+
     def create_data_file(self, file_path, file_type="table", data_format="jsonl", tags=None):
-        datafile = DataFile(file_path=file_path, file_type=file_type,tags=tags)
+        tier = self.engine.memory_tier
+        if tier and tier.contains(file_path) and not tier.add(file_path):
+            file_path = tier.spill(file_path, self.temp_dir)
+        datafile = DataFile(file_path=file_path, file_type=file_type,tags=tags,
+                            provider=self._direct_files.get(file_path))
         datafile.file_format = data_format
         return datafile
 
+    @property
+    def is_last_task(self):
+        return bool(self._process) and self.task_order + 1 >= len(self._process.task_list)
+
+    def create_file_saver(self, dst_path, tags=None):
+        """
+        AtomicSaver for dst_path, unless the next task is a save with `direct: true` to
+        remote storage. Then records stream straight into a multipart upload of the object
+        the save would write, and the data file created from saver.dest_path lives in that
+        storage, so save has nothing left to upload.
+        """
+        next_order = self.task_order + 1
+        task_list = self._process.task_list if self._process else []
+        if next_order < len(task_list):
+            task = task_list[next_order]
+            if task.function_name == 'save' and task.args.get('direct'):
+                storage = self.get_storage(task.args.get('location'))
+                if storage and hasattr(storage.provider, 'open_multipart_writer'):
+                    key = task.get_key(os.path.basename(dst_path), tags)
+                    return DirectSaver(storage, key, on_commit=self._direct_saved)
+        return AtomicSaver(dst_path)
+
+    def map_files(self, fn, items):
+        """
+        fn over items in order, in parallel with the parallelism of the process
+        """
+        if self._process:
+            return self._process.map_files(fn, items)
+        return [fn(item) for item in items]
+
+    def is_run_file(self, file_path):
+        """
+        whether file_path is a working file of this run, in its run dir or memory tier dir
+        """
+        run_dirs = [os.path.join(os.path.abspath(self.temp_dir), '')]
+        tier = self.engine.memory_tier
+        if tier:
+            run_dirs.append(os.path.join(tier.path, self.run_id, ''))
+        return os.path.abspath(file_path).startswith(tuple(run_dirs))
+
+    def release_files(self, data_files):
+        """
+        delete the files of this run that are no longer final files. Call it once the
+        checkpoint without them is saved: later tasks only read the final files and
+        recovery restarts from them, so nothing needs the released files anymore.
+        """
+        final_paths = set(data_file.file_path for data_file in self.final_files)
+        tier = self.engine.memory_tier
+        for data_file in data_files:
+            if data_file.provider or data_file.file_path in final_paths:
+                continue
+            if not self.is_run_file(data_file.file_path):
+                continue
+            try:
+                os.remove(data_file.file_path)
+                logger.debug('release data file', file_path=data_file.file_path)
+            except FileNotFoundError:
+                pass
+            if tier:
+                tier.remove(data_file.file_path)
+
+    def spill_final_files(self):
+        """
+        move final files of the memory tier to the run dir, for a checkpoint that must
+        survive losing the tier
+        """
+        tier = self.engine.memory_tier
+        for data_file in self.final_files:
+            if not data_file.provider and tier.contains(data_file.file_path):
+                data_file.file_path = tier.spill(data_file.file_path, self.temp_dir)
+
+    def release_memory_files(self):
+        """
+        free the memory tier of final files once the message is done: files the last task
+        saved are deleted, any other outputs are spilled to the run dir and kept
+        """
+        tier = self.engine.memory_tier
+        if not tier:
+            return
+        saved = bool(self.task_process_history) and self.task_process_history[-1]['function'] == 'save'
+        for data_file in self.final_files:
+            if data_file.provider or not tier.contains(data_file.file_path):
+                continue
+            if not saved:
+                data_file.file_path = tier.spill(data_file.file_path, self.temp_dir)
+                continue
+            try:
+                os.remove(data_file.file_path)
+            except FileNotFoundError:
+                pass
+            tier.remove(data_file.file_path)
+
+    def _direct_saved(self, saver):
+        self._direct_files[saver.dest_path] = saver.storage
+
     def get_storage(self, name):
         return self.engine.storages.get(name)
 
     def get_stream(self, name):
         return self.engine.streams.get(name)
 
+    def get_pk_cache(self, name):
+        return self.engine.pk_caches.get(name)
+
     def end(self):
         self.end_flag = True
 
@@ -348,17 +571,29 @@ class DataTaskContext:
         name = meta['name']
         run_id = meta['run_id']
         temp_dir = meta['temp_dir']
-        data_files = [DataFile.deserialize(data_file_meta) for data_file_meta in meta['data_files']]
-        context = DataTaskContext(name, run_id, temp_dir, data_files=data_files, engine=kwargs['engine'])
-        context.final_files = [DataFile.deserialize(data_file_meta) for data_file_meta in meta['task_meta'][-1]['output_files']] if meta['task_meta'] else data_files
+        engine = kwargs['engine']
+        data_files = [DataFile.deserialize(data_file_meta, engine, verify=False)
+                      for data_file_meta in meta['data_files']]
+        process = kwargs.get('process')
+        context = DataTaskContext(name, run_id, temp_dir, data_files=data_files, engine=engine,
+                                  process=process)
+        # the run may have crashed in a last save with move, after it moved some files
+        task_list = process.task_list if process else []
+        task_order = len(meta['task_meta'])
+        moved = (task_order == len(task_list) - 1 and task_list[task_order].function_name == 'save'
+                 and bool(task_list[task_order].args.get('move')))
+        context.final_files = [DataFile.deserialize(data_file_meta, engine, moved=moved) for data_file_meta in meta['task_meta'][-1]['output_files']] if meta['task_meta'] else data_files
         context.task_process_history = [
-            {'name': task_process['name'], 'function': task_process['function'], 'output_files': [DataFile.deserialize(data_file_meta) for data_file_meta in task_process['output_files']]}
+            {'name': task_process['name'], 'function': task_process['function'], 'output_files': [DataFile.deserialize(data_file_meta, engine, verify=False) for data_file_meta in task_process['output_files']]}
             for task_process in meta['task_meta']
         ]
         context.task_order = len(context.task_process_history)
         return context
 
     def meta_save(self, dst_path, temporary=False):
+        tier = self.engine.memory_tier
+        if temporary and tier and tier.durable:
+            self.spill_final_files()
         serialized_meta = self.serialize()
         logger.debug(str(serialized_meta))
         temporary_path = os.path.join(dst_path, '_temp')
@@ -387,7 +622,7 @@ class DataTaskContext:
             if auth_info['storage_type'] != storage_type:
                 continue
             if path.startswith(auth_info['path']):
-                return storage_info['storage']
+                return self.engine.storages[storage_info['name']]
         return None
 
     def is_duplicated_data(self, data: dict):
@@ -395,8 +630,8 @@ class DataTaskContext:
             return self._process.index_cache.is_exists(data)
         return False
 
-    def update_pk_cache(self, data_file, index_keys):
-        self._process.update_pk_cache(data_file, index_keys)
+    def update_pk_cache(self, data_file, index_keys, time_range=None):
+        self._process.update_pk_cache(data_file, index_keys, time_range)
 
 
 class DataProcess:
@@ -406,76 +641,131 @@ class DataProcess:
         self._source = conf.source
         self._source_args = conf.source_args
         self._schedules = conf.schedules
+        self.overlap_policy = conf.overlap_policy or 'allow'
+        self.max_concurrent = conf.max_concurrent
+        self.parallelism = int(conf.parallelism or 1)
+        self._executor = None
+        self._lock = threading.Lock()
         self.engine = engine
         self.index_cache = None
-        self._index_file_paths = set()
+        self._index_searcher = None
         self.is_fetch_job = self._source in self.engine.sources
         self.is_process_job = self._source in self.engine.streams
-        self._task_list = []
-        self._load()
+        self._task_list = None
 
     def _load(self):
+        task_list = []
         for proc in self.conf.processes:
             function_name = proc.function
             function = creat_function_with(function_name, proc.args)
-            self._task_list.append(function)
-
-    def update_pk_cache(self, data_file, index_keys):
+            task_list.append(function)
+        return task_list
+
+    def update_pk_cache(self, data_file, index_keys, time_range=None):
+        """
+        Load index files of the dedup window into the pk cache. With the event time range of
+        the data file, only partitions overlapping it plus event_time_slack are loaded,
+        future-dated records included, otherwise the last time_window before now.
+        """
         provider = data_file.provider
+        if not provider or 'index_pattern' not in provider.args:
+            return
         args = provider.args
         time_window = args['time_window']
         index_pattern = args['index_pattern']
-        if not self.index_cache:
-            current_timestamp = int(time.time())
-            duration = common.convert_time_window_to_seconds(time_window)
+        current_timestamp = int(time.time())
+        duration = common.convert_time_window_to_seconds(time_window)
+        if time_range:
+            slack = common.convert_time_window_to_seconds(args.get('event_time_slack', '1h'))
+            start_timestamp = time_range[0] - slack
+            end_timestamp = time_range[1] + slack
+        else:
             start_timestamp = current_timestamp - duration
+            end_timestamp = current_timestamp
+        if not self.index_cache:
             self.index_cache = PKIndexCache(index_keys,
                                             duration,
-                                            baseline_time=current_timestamp)
-        index_searcher = IndexSearcher()
+                                            baseline_time=current_timestamp,
+                                            load_concurrency=args.get('index_load_concurrency'),
+                                            parse_processes=args.get('index_parse_processes'))
+        if not self._index_searcher:
+            refresh_interval = args.get('index_refresh_interval')
+            if refresh_interval:
+                refresh_interval = common.convert_time_window_to_seconds(refresh_interval)
+            self._index_searcher = IndexSearcher(args.get('list_concurrency'), refresh_interval)
         files = []
-        for filepath in index_searcher.select_index_files(provider,
-                                                          index_pattern,
-                                                          data_file.tags,
-                                                          start_timestamp,
-                                                          current_timestamp):
-            if filepath not in self._index_file_paths:
-                self._index_file_paths.add(filepath)
-                files.append(DataFile(filepath, file_type='index',
-                                      tags=None, provider=self._pk_storage))
+        for filepath in self._index_searcher.select_new_index_files(provider,
+                                                                    index_pattern,
+                                                                    data_file.tags,
+                                                                    start_timestamp,
+                                                                    end_timestamp):
+            files.append(DataFile(filepath, file_type='index',
+                                  tags=None, provider=provider))
         if files:
             self.index_cache.update_pk_files(files)
 
-    def start(self, callback_fn):
+    def start(self, callback_fn, scheduler):
         if self._schedules:
             for schedule_str in self._schedules:
-                add_schedule(schedule_str, callback_fn)
+                scheduler.add(schedule_str, callback_fn, name=f'{self.name}: {schedule_str}')
         else:
             callback_fn()
 
-    def start(self, callback_fn):
-        if self._schedules:
-            for schedule_str in self._schedules:
-                add_schedule(schedule_str, callback_fn)
+    @staticmethod
+    def _append_or_extend(datafiles, newfile):
+        if not newfile:
+            return
+        if isinstance(newfile, (list, tuple)):
+            datafiles.extend(newfile)
         else:
-            callback_fn()
+            datafiles.append(newfile)
 
-    def run(self):
-        def append_or_extend(datafiles, newfile):
-            if not newfile:
-                return
-            if isinstance(newfile, (list, tuple)):
-                datafiles.extend(newfile)
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.parallelism, thread_name_prefix=f'{self.name}-task')
+        return self._executor
+
+    def map_files(self, fn, items):
+        """
+        fn over items, fanned out on the task pool when parallelism is above 1. Results
+        keep the order of items, so outputs and checkpoints do not depend on timing.
+        """
+        if self.parallelism <= 1 or len(items) <= 1:
+            return [fn(item) for item in items]
+        return list(self.executor.map(fn, items))
+
+    def _run_task(self, task, context, meta_temp_dir):
+        logger.debug('handle task', task_name=task.name, task=task, data_file=context.final_file)
+        new_data_files = []
+        if context.single_file:
+            new_data_file = task.process(context.final_file, context)
+            self._append_or_extend(new_data_files, new_data_file)
+        elif context.multi_files:
+            if hasattr(task, 'process_multi'):
+                new_data_file = task.process_multi(context.final_files, context)
+                self._append_or_extend(new_data_files, new_data_file)
             else:
-                datafiles.append(newfile)
-
+                process = partial(task.process, context=context)
+                new_files = (self.map_files(process, context.final_files) if task.parallel_safe
+                             else [process(data_file) for data_file in context.final_files])
+                for new_data_file in new_files:
+                    self._append_or_extend(new_data_files, new_data_file)
+        released_files = context.final_files
+        context.set_data_files(new_data_files, task.name, task.function_name)
+        context.meta_save(meta_temp_dir, temporary=True)
+        context.release_files(released_files)
+        context.task_order += 1
+
+    def run(self, run_id=None):
         name = self.name
-        run_id = uuid_generator('PR')
+        run_id = run_id or uuid_generator('PR')
         temp_dir = os.path.join(self.engine.working_dir, run_id)
         os.makedirs(temp_dir, exist_ok=True)
         if self.is_fetch_job:
             data_source = self.engine.sources.get(self._source)
-            context = DataTaskContext(name, run_id, temp_dir, data_files=[], engine=self.engine)
+            context = DataTaskContext(name, run_id, temp_dir, data_files=[], engine=self.engine, process=self)
             stream = data_source.fetch(self._source_args, context)
         elif self.is_process_job:
             stream = self.engine.streams.get(self._source)
@@ -484,9 +774,10 @@ class DataProcess:
 
         meta_temp_dir = os.path.join(temp_dir, 'meta')
         os.makedirs(meta_temp_dir, exist_ok=True)
+        self.engine.run_registry.start(run_id, name, temp_dir)
 
         while True:
-            context = DataTaskContext(name, run_id, temp_dir, data_files=[], engine=self.engine)
+            context = DataTaskContext(name, run_id, temp_dir, data_files=[], engine=self.engine, process=self)
             if stream.get(context) is None:
                 break
             if context.eof:
@@ -494,64 +785,41 @@ class DataProcess:
             context.meta_save(meta_temp_dir, temporary=True)
             logger.debug('handle task of source.', source_file=context.data_file.basename)
             for task in self.task_list:
-                logger.debug('handle task', task_name=task.name,
-                             task=task, data_file=context.final_file)
-                new_data_files = []
-                if context.single_file:
-                    new_data_file = task.process(context.final_file, context)
-                    append_or_extend(new_data_files, new_data_file)
-                elif context.multi_files:
-                    if hasattr(task, 'process_multi'):
-                        new_data_file = task.process_multi(
-                            context.final_files, context)
-                        append_or_extend(new_data_files, new_data_file)
-                    else:
-                        for data_file in context.final_files:
-                            new_data_file = task.process(data_file, context)
-                            append_or_extend(new_data_files, new_data_file)
-                context.set_data_files(new_data_files, task.name, task.function_name)
-                context.meta_save(meta_temp_dir, temporary=True)
-                context.task_order += 1
+                self._run_task(task, context, meta_temp_dir)
             stream.task_done(context)
             context.end()
+            context.release_memory_files()
             context.meta_save(meta_temp_dir)
+        if self.is_fetch_job:
+            stream.close()
+        self.engine.close_streams()
+        self.engine.finish_run(run_id, temp_dir)
 
     def recover(self, recover_dir):
-        def append_or_extend(datafiles, newfile):
-            if not newfile:
-                return
-            if isinstance(newfile, (list, tuple)):
-                datafiles.extend(newfile)
-            else:
-                datafiles.append(newfile)
-
         temp_meta_dir = os.path.join(recover_dir, 'meta/_temp/meta_data.json')
         with open(temp_meta_dir, 'r') as f:
             temp_meta = json.load(f)
-        context = DataTaskContext.deserialize(temp_meta, engine=self.engine)
+        context = DataTaskContext.deserialize(temp_meta, engine=self.engine, process=self)
 
         meta_temp_dir = os.path.join(recover_dir, 'meta')
         os.makedirs(meta_temp_dir, exist_ok=True)
+        self.engine.run_registry.start(context.run_id, self.name, recover_dir)
 
         for task in self.task_list[context.task_order:]:
-            logger.debug('recover task', task_name=task.name, task=task, data_file=context.final_file)
-            new_data_files = []
-            if context.single_file:
-                new_data_file = task.process(context.final_file, context)
-                append_or_extend(new_data_files, new_data_file)
-            elif context.multi_files:
-                if hasattr(task, 'process_multi'):
-                    new_data_file = task.process_multi(context.final_files, context)
-                    append_or_extend(new_data_files, new_data_file)
-                else:
-                    for data_file in context.final_files:
-                        new_data_file = task.process(data_file, context)
-                        append_or_extend(new_data_files, new_data_file)
-            context.set_data_files(new_data_files, task.name, task.function_name)
-            context.meta_save(meta_temp_dir, temporary=True)
-            context.task_order += 1
+            self._run_task(task, context, meta_temp_dir)
         context.end()
+        context.release_memory_files()
         context.meta_save(meta_temp_dir)
+        self.engine.close_streams()
+        self.engine.finish_run(context.run_id, recover_dir)
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+        if self.index_cache:
+            self.index_cache.close()
 
     @property
     def name(self):
@@ -563,9 +831,44 @@ class DataProcess:
 
     @property
     def task_list(self):
+        if self._task_list is None:
+            self._task_list = self._load()
         return self._task_list
 
 
+class LazyResources(Mapping):
+    """
+    Name to resource mapping of one kind of engine resource. A resource is built from its
+    config on first access, so running one process only creates what that process uses.
+    """
+
+    def __init__(self, confs, factory):
+        self._confs = {conf.name: conf for conf in confs}
+        self._factory = factory
+        self._resources = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        if name not in self._resources:
+            conf = self._confs[name]
+            with self._lock:
+                if name not in self._resources:
+                    self._resources[name] = self._factory(conf)
+        return self._resources[name]
+
+    def __contains__(self, name):
+        return name in self._confs
+
+    def __iter__(self):
+        return iter(self._confs)
+
+    def __len__(self):
+        return len(self._confs)
+
+    def loaded(self):
+        return dict(self._resources)
+
+
 class SpinEngine:
     def __init__(self, conf):
         self.conf = conf
@@ -575,15 +878,41 @@ class SpinEngine:
         self.streams = {}
         self.storages = {}
         self.data_views = {}
+        self.pk_caches = {}
         self.data_processes = {}
-        self.stop_scheduler_event = None
-        self.scheduler_thread = None
+        self.scheduler = None
+        self._run_registry = None
+        self._memory_tier = None
+        self._lock = threading.Lock()
         self.load()
 
     @property
     def working_dir(self):
         return self.config.working_dir
 
+    @property
+    def run_registry(self):
+        with self._lock:
+            if self._run_registry is None:
+                self._run_registry = RunRegistry(self.working_dir)
+        return self._run_registry
+
+    @property
+    def memory_tier(self):
+        """
+        MemoryTier for intermediates when memory_dir is set in the dataspin config, with
+        memory_budget bytes (default 256MB). With memory_durable every checkpoint spills the
+        files it refers to, so only files being written between two checkpoints are kept in
+        memory, none survive from one task to the next.
+        """
+        if not self.config.memory_dir:
+            return None
+        with self._lock:
+            if self._memory_tier is None:
+                budget = common.convert_size_to_bytes(self.config.memory_budget or '256MB')
+                self._memory_tier = MemoryTier(self.config.memory_dir, budget, bool(self.config.memory_durable))
+        return self._memory_tier
+
     def load(self):
         conf = self.conf
         self.config = conf.dataspin
@@ -592,15 +921,14 @@ class SpinEngine:
         working_dir = os.path.abspath(self.config.working_dir)
         os.makedirs(working_dir, exist_ok=True)
         self.config.working_dir = working_dir
-        for source in conf.sources:
-            self.sources[source.name] = DataSource.load(source)
-
-        for stream in conf.streams:
-            self.streams[stream.name] = DataStream(stream)
+        self.sources = LazyResources(conf.sources, DataSource.load)
+        self.streams = LazyResources(conf.streams, DataStream)
+        self.storages = LazyResources(conf.storages, ObjectStorage)
+        self.data_views = LazyResources(conf.data_views, DataView)
+        self.pk_caches = LazyResources(conf.pk_caches, PKCache.load)
+        self.data_processes = LazyResources(conf.data_processes, partial(DataProcess, engine=self))
 
         for storage in conf.storages:
-            obj = ObjectStorage(storage)
-            self.storages[storage.name] = obj
             platform, path, params, options = parse_url(storage.url)
             if platform not in ["file", "local"]:
                 self.storages_info.append({
@@ -611,15 +939,38 @@ class SpinEngine:
                         'secret_key': params['secret_key'],
                         'region': params['region']
                     },
-                    'storage': obj
+                    'name': storage.name
                 })
 
-        for data_view in conf.data_views:
-            self.data_views[data_view.name] = DataView(data_view)
-
-        for process_conf in conf.data_processes:
-            data_process = DataProcess(process_conf, self)
-            self.data_processes[process_conf.name] = data_process
+    def finish_run(self, run_id, run_dir):
+        """
+        mark the run finished and prune finished run dirs past run_retention (age, e.g.
+        7d) or over run_retention_size (total, e.g. 10GB) of the dataspin config
+        """
+        if self.memory_tier:
+            self.memory_tier.clear(run_id)
+        self.run_registry.finish(run_id, run_dir)
+        max_age = self.config.run_retention
+        max_bytes = self.config.run_retention_size
+        if max_age or max_bytes:
+            self.run_registry.prune(common.convert_time_window_to_seconds(max_age) if max_age else None,
+                                    common.convert_size_to_bytes(max_bytes) if max_bytes else None)
+
+    def close_streams(self):
+        """
+        close every stream the run used, the source as well as the trigger streams, so
+        pending acks and sends are done before the run is marked finished
+        """
+        for stream in self.streams.loaded().values():
+            stream.close()
+
+    def close(self):
+        for process in self.data_processes.loaded().values():
+            process.close()
+        for pk_cache in self.pk_caches.loaded().values():
+            pk_cache.close()
+        for storage in self.storages.loaded().values():
+            storage.close()
 
     def run(self):
         for process_name, process in self.data_processes.items():
@@ -632,21 +983,36 @@ class SpinEngine:
         process.run()
 
     def start(self):
-        self.stop_scheduler_event, self.scheduler_thread = run_scheduler()
+        self.scheduler = HeapScheduler()
         for _, process in self.data_processes.items():
-            process.start()
+            process.start(process.run, self.scheduler)
+        self.scheduler.run()
 
 
 class SpinManager:
-    def __init__(self):
-        self.stop_scheduler_event = None
-        self.scheduler_thread = None
+    job_runners = {
+        'process': ProcessJobRunner,
+        'pool': WorkerPoolJobRunner
+    }
+
+    def __init__(self, runner='process', process_count=None, log_max_size=None):
+        self.scheduler = None
         self.engines = {}
-        self.job_runner = ProcessJobRunner()
+        if runner not in self.job_runners:
+            raise Exception(f'unknown job runner {runner}')
+        self.job_runner = self.job_runners[runner](process_count=process_count, log_max_size=log_max_size)
         self.sysdata = AppSystemData()
-        self.db = SystemDatabase()
+        self._db = None
         atexit.register(self.join)
 
+    @property
+    def db(self):
+        # sqlalchemy is only imported once the system database is used
+        if self._db is None:
+            from dataspin.model import SystemDatabase
+            self._db = SystemDatabase()
+        return self._db
+
     def load_one(self, project_path):
         project_path = os.path.abspath(project_path)
         if not os.path.exists(project_path):
@@ -654,6 +1020,7 @@ class SpinManager:
         conf = ProjectConfig.load(project_path)
         engine = SpinEngine(conf)
         self.engines[project_path] = engine
+        self.job_runner.log_dirs[project_path] = os.path.join(engine.working_dir, 'logs')
 
     def load_all(self, project_dir):
         project_paths = []
@@ -667,10 +1034,16 @@ class SpinManager:
             self.load_one(project_path)
 
     def start(self):
-        self.stop_scheduler_event, self.scheduler_thread = run_scheduler()
+        """
+        schedules fire on the scheduler thread and only queue jobs on the job runner, which
+        runs them with the overlap policy of each process
+        """
+        self.scheduler = HeapScheduler()
         for project_path, engine in self.engines.items():
             for name, process in engine.data_processes.items():
-                process.start(partial(self.run_process, project_path, name))
+                process.start(partial(self.job_runner.run, project_path, name,
+                                      process.overlap_policy, process.max_concurrent), self.scheduler)
+        self.scheduler.start()
         self.job_runner.manage_loop()
 
     def run(self):
@@ -684,7 +1057,7 @@ class SpinManager:
                 self.job_runner.run(project_path, name)
         self.job_runner.manage_loop(empty_exit=True)
 
-    def run_process(self, project_path, name):
+    def run_process(self, project_path, name, run_id=None):
         project_path = os.path.abspath(project_path)
         engine = self.engines.get(project_path)
         if not engine:
@@ -692,7 +1065,7 @@ class SpinManager:
         if name not in engine.data_processes:
             raise Exception(f'Named {name} data process not found.')
         process = engine.data_processes[name]
-        process.run()
+        process.run(run_id=run_id)
 
     def recover_process(self, project_path, name, recover_path):
         project_path = os.path.abspath(project_path)
@@ -705,23 +1078,28 @@ class SpinManager:
         process.recover(recover_path)
 
     def join(self):
+        if self.scheduler:
+            self.scheduler.stop()
         self.job_runner.close()
-        if self.stop_scheduler_event:
-            self.stop_scheduler_event.set()
-            time.sleep(3)
-            self.scheduler_thread.join()
+        for engine in self.engines.values():
+            engine.close()
 
     def check_recover(self, process):
+        """
+        only runs the registry has as unfinished are looked at. A run that stopped between
+        two messages has no checkpoint left and needs no recovery, it is marked finished so
+        retention can prune it.
+        """
+        run_registry = process.engine.run_registry
         recover_dir_list = []
-        for iter_dir in iter_find_files(process.engine.working_dir, 'PR*', include_dirs=True):
-            if not os.path.isdir(iter_dir):
-                continue
-
-            temp_meta_dir = os.path.join(iter_dir, 'meta/_temp/meta_data.json')
+        for run_id, run_dir in run_registry.unfinished(process.name):
+            temp_meta_dir = os.path.join(run_dir, 'meta/_temp/meta_data.json')
             if os.path.exists(temp_meta_dir):
                 with open(temp_meta_dir, 'r') as f:
                     temp_meta = json.load(f)
-                    if temp_meta['name'] == process.name and temp_meta['success_flag'] is False:
-                        recover_dir_list.append(iter_dir)
+                if temp_meta['name'] == process.name and temp_meta['success_flag'] is False:
+                    recover_dir_list.append(run_dir)
+                    continue
+            run_registry.finish(run_id, run_dir if os.path.isdir(run_dir) else None)
 
         return len(recover_dir_list) > 0, recover_dir_list
\ No newline at end of file
@@ -1,18 +1,23 @@
+from dataspin.utils.common import load_class
 
-from .function import *
-
+# function name -> class, imported on first use. Other functions can be added by
+# packages through the 'dataspin.functions' entry point group.
+FUNCTION_ENTRY_POINT_GROUP = 'dataspin.functions'
 
 function_class_map = {
-    'splitby': SplitByFunction,
-    'save': SaveFunction,
-    'pk_index': PkIndexFunction,
-    'flatten': FlattenFunction,
-    'format': FormatFunction,
-    'deduplicate': DeduplicateFunction,
-    'filter': FilterFunction,
-    'merge': MergeFunction
+    'splitby': 'dataspin.functions.function:SplitByFunction',
+    'save': 'dataspin.functions.function:SaveFunction',
+    'pk_index': 'dataspin.functions.function:PkIndexFunction',
+    'flatten': 'dataspin.functions.function:FlattenFunction',
+    'format': 'dataspin.functions.function:FormatFunction',
+    'deduplicate': 'dataspin.functions.function:DeduplicateFunction',
+    'filter': 'dataspin.functions.function:FilterFunction',
+    'merge': 'dataspin.functions.function:MergeFunction'
 }
 
 def creat_function_with(name: str, args):
-    function_class = function_class_map.get(name, Function)
-    return function_class(args)
\ No newline at end of file
+    function_class = load_class(name, function_class_map, FUNCTION_ENTRY_POINT_GROUP)
+    if function_class is None:
+        from .function import Function
+        function_class = Function
+    return function_class(args)
@@ -1,19 +1,25 @@
 from collections import namedtuple
+import hashlib
 import os
+import sys
+import time
 from basepy.log import logger
 
 from dataspin.utils import common
+from dataspin.pkindex import index_format
 from boltons.fileutils import AtomicSaver, atomic_save
 import json
-from jinja2 import Environment, TemplateSyntaxError
 
 
 class FunctionMultiMixin:
 
     def process_multi(self, data_files, context):
         result = []
-        for data_file in data_files:
-            file = self.process(data_file, context)
+        if self.parallel_safe:
+            files = context.map_files(lambda data_file: self.process(data_file, context), data_files)
+        else:
+            files = [self.process(data_file, context) for data_file in data_files]
+        for file in files:
             if isinstance(file, (list, tuple)):
                 result.extend(file)
                 continue
@@ -22,7 +28,13 @@ class FunctionMultiMixin:
 
 
 class Function:
+    """
+    With parallelism set on the data process, process runs for several files of a
+    context at once on its task pool; a function sharing state across files sets
+    parallel_safe to False.
+    """
     function_name = 'pass'
+    parallel_safe = True
 
     def __init__(self, args):
         self.args = args
@@ -42,8 +54,8 @@ class SplitByFunction(Function):
         def write_to_group(group_names, line):
             if group_names not in group_file_savers:
                 group_name = '-'.join(group_names)
-                dst_path = os.path.join(context.temp_dir, f'{data_file.name}-group-{group_name}.jsonl')
-                file_saver = AtomicSaver(dst_path)
+                dst_path = context.temp_path(f'{data_file.name}-group-{group_name}.jsonl')
+                file_saver = context.create_file_saver(dst_path, tags_with_group.get(group_names))
                 file_saver.setup()
                 group_file_savers[group_names] = file_saver
             saver = group_file_savers[group_names]
@@ -55,22 +67,28 @@ class SplitByFunction(Function):
         split_keys = self.args['key']
         tags = self.args['tags']
         tags_with_group = {}
-        for (data, line) in data_file.readlines():
-            group_names = []
-            for split_key in split_keys:
-                group_name = data.get(split_key)
-                group_names.append(group_name)
-            group_names = tuple(group_names)
-            if not tags_with_group.get(group_names):
-                object_name = namedtuple("DataObject", data.keys())(*data.values())
-                fill_tags = {}
-                for tag_k,tag_v in tags.items():
-                    fill_tags[tag_k] = tag_v.format(data=object_name)
-                tags_with_group[group_names] = fill_tags
-            if not group_names:
-                # TODO: warning
-                continue
-            write_to_group(group_names, line)
+        try:
+            for (data, line) in data_file.readlines():
+                group_names = []
+                for split_key in split_keys:
+                    group_name = data.get(split_key)
+                    group_names.append(group_name)
+                group_names = tuple(group_names)
+                if not tags_with_group.get(group_names):
+                    object_name = namedtuple("DataObject", data.keys())(*data.values())
+                    fill_tags = {}
+                    for tag_k,tag_v in tags.items():
+                        fill_tags[tag_k] = tag_v.format(data=object_name)
+                    tags_with_group[group_names] = fill_tags
+                if not group_names:
+                    # TODO: warning
+                    continue
+                write_to_group(group_names, line)
+        except BaseException:
+            # aborts direct uploads and drops the part files
+            for saver in group_file_savers.values():
+                saver.__exit__(*sys.exc_info())
+            raise
         for group_names,saver in group_file_savers.items():
             saver.__exit__(None, None, None)                
             tags = tags_with_group[group_names] if tags_with_group[group_names] else None
@@ -79,29 +97,65 @@ class SplitByFunction(Function):
 
 
 class SaveFunction(FunctionMultiMixin,Function):
+    """
+    Uploads run on the storage's background pool, see ObjectStorage.uploader. Trigger
+    messages are sent only after every upload of the batch is confirmed, and are flushed
+    before the task ends, so a failed send fails the task and recovery sends again.
+
+    With `direct: true` the previous task streams its output straight into the storage,
+    see DataTaskContext.create_file_saver, and those files are not uploaded again.
+    With `skip_unchanged: true` files whose content is already at the target key are
+    not uploaded, so retries and recoveries cost no bandwidth. With `move: true` a local
+    storage may rename the files into place when save is the last task of the process.
+    """
     function_name = 'save'
 
+    def get_key(self, basename, tags):
+        path_suffix = self.args.get('path_suffix')
+        if not path_suffix:
+            return basename
+        path_suffix = path_suffix.format(**(tags or {}))
+        if not path_suffix.endswith('/'):
+            path_suffix = path_suffix + '/'
+        return path_suffix + basename
+
     def process(self, data_file, context):
-        logger.debug('save function process', data_file=data_file.file_path)
+        return self.process_multi([data_file], context)[0]
+
+    def process_multi(self, data_files, context):
+        logger.debug('save function process', data_files=[data_file.file_path for data_file in data_files])
         location = self.args.get('location')
-        path_suffix = self.args.get('path_suffix')
         trigger = self.args.get('trigger')
+        skip_unchanged = self.args.get('skip_unchanged', False)
+        move = self.args.get('move', False) and context.is_last_task
 
-        if path_suffix:
-            path_suffix = path_suffix.format(**data_file.tags)
-            if not path_suffix.endswith('/'):
-                path_suffix = path_suffix + '/'
         storage = context.get_storage(location)
         if not storage:
             raise Exception('No storage defined.')
-        key = path_suffix + data_file.basename if path_suffix else data_file.basename
-        path = storage.save(key, data_file.file_path)
+        stream = None
         if trigger:
             stream = context.get_stream(trigger)
             if not stream:
                 raise Exception('No stream defined.')
-            stream.send_to_stream(path,data_file.tags,storage.storage_type)
-        return data_file
+        futures = []
+        for data_file in data_files:
+            if data_file.provider is storage:
+                futures.append(None)
+                continue
+            key = self.get_key(data_file.basename, data_file.tags)
+            checksum = None
+            if move and not os.path.exists(data_file.file_path):
+                # moved into place before a crash, found again by its recorded md5
+                checksum = data_file.md5
+            link = context.is_run_file(data_file.file_path)
+            futures.append(storage.save_async(key, data_file.file_path, skip_unchanged, move, checksum, link))
+        storage.uploader.wait_all([future for future in futures if future])
+        if stream:
+            for data_file, future in zip(data_files, futures):
+                path = future.result() if future else data_file.file_path
+                stream.send_to_stream(path, data_file.tags, storage.storage_type)
+            stream.flush_sends()
+        return data_files
 
 
 class PkIndexFunction(FunctionMultiMixin, Function):
@@ -110,7 +164,9 @@ class PkIndexFunction(FunctionMultiMixin, Function):
     def process(self, data_file, context):
         logger.debug('index function process', data_file=data_file.file_path)
         index_key = self.args['key']
-        dst_path = os.path.join(context.temp_dir, f'{data_file.name}-pk-index.jsonl')
+        if self.args.get('format') == 'v2':
+            return self.process_v2(data_file, context, index_key)
+        dst_path = context.temp_path(f'{data_file.name}-pk-index.jsonl')
         file_saver = AtomicSaver(dst_path)
         file_saver.setup()
         index_set = set()
@@ -128,6 +184,28 @@ class PkIndexFunction(FunctionMultiMixin, Function):
         new_data_file = context.create_data_file(dst_path, file_type="index",tags= data_file.tags)
         return [data_file, new_data_file]
 
+    def process_v2(self, data_file, context, index_key):
+        """
+        Write a binary sorted index, see dataspin.pkindex.index_format.
+        The time range comes from timestamp_field when given, else the current time.
+        """
+        timestamp_field = self.args.get('timestamp_field')
+        dst_path = context.temp_path(f'{data_file.name}-pk-index.index')
+        key_hashes = set()
+        time_start, time_end = None, None
+        for (data, line) in data_file.readlines():
+            key_hashes.add(index_format.pk_hash(data.get(key) for key in index_key))
+            if timestamp_field and data.get(timestamp_field) is not None:
+                ts = common.parse_timestamp(data[timestamp_field])
+                time_start = ts if time_start is None else min(time_start, ts)
+                time_end = ts if time_end is None else max(time_end, ts)
+        if time_start is None:
+            time_start = time_end = int(time.time())
+        with atomic_save(dst_path) as f:
+            index_format.write_index(f, key_hashes, index_key, time_start, time_end)
+        new_data_file = context.create_data_file(dst_path, file_type="index", tags=data_file.tags)
+        return [data_file, new_data_file]
+
 
 class FlattenFunction(FunctionMultiMixin, Function):
     function_name = 'flatten'
@@ -137,12 +215,13 @@ class FlattenFunction(FunctionMultiMixin, Function):
             raise Exception('Not supported file type')
         if data_file.file_type == 'index':
             return data_file
-        dst_path = os.path.join(context.temp_dir, f'{data_file.name}-flatten.jsonl')
-        with atomic_save(dst_path) as f:
+        dst_path = context.temp_path(f'{data_file.name}-flatten.jsonl')
+        file_saver = context.create_file_saver(dst_path, data_file.tags)
+        with file_saver as f:
             for data, line in data_file.readlines():
                 f.write(json.dumps(common.flatten_dict(data)).encode('utf-8'))
                 f.write(b'\n')
-        return context.create_data_file(file_path = dst_path,tags = data_file.tags)
+        return context.create_data_file(file_path=file_saver.dest_path, tags=data_file.tags)
 
 
 class FormatFunction(FunctionMultiMixin, Function):
@@ -172,30 +251,38 @@ class FormatFunction(FunctionMultiMixin, Function):
         field_type_mapping = data_view.field_type_mapping
         fields = data_view.fields
 
-        dst_path = os.path.join(context.temp_dir, f'{data_file.name}-format.jsonl')
-        file_saver = AtomicSaver(dst_path)
-        file_saver.setup()
-        for (data, line) in data_file.readlines():
-            format_line = transform(data, fields, field_type_mapping)
-            if format_line:
-                file_saver.part_file.write(format_line.encode('utf-8'))
-                file_saver.part_file.write(b'\n')
-        file_saver.__exit__(None, None, None)
-        return context.create_data_file(file_path=file_saver.dest_path)
+        dst_path = context.temp_path(f'{data_file.name}-format.jsonl')
+        file_saver = context.create_file_saver(dst_path, data_file.tags)
+        with file_saver as f:
+            for (data, line) in data_file.readlines():
+                format_line = transform(data, fields, field_type_mapping)
+                if format_line:
+                    f.write(format_line.encode('utf-8'))
+                    f.write(b'\n')
+        return context.create_data_file(file_path=file_saver.dest_path, tags=data_file.tags)
 
 
 class DeduplicateFunction(Function):
     function_name = 'deduplicate'
+    # files are checked against the keys the previous files added
+    parallel_safe = False
 
     def process(self, data_file, context):
         if data_file.file_type == 'index':
             return data_file
         pks = self.args['key']
-        context.update_pk_cache(data_file, pks)
-        dst_path = os.path.join(context.temp_dir, f'{data_file.name}-deduplicate.jsonl')
+        pk_cache_name = self.args.get('pk_cache')
+        if pk_cache_name:
+            pk_cache = context.get_pk_cache(pk_cache_name)
+            if not pk_cache:
+                raise Exception(f'No pk cache {pk_cache_name} defined.')
+            return self.process_with_pk_cache(data_file, context, pks, pk_cache)
+        time_range, source_file = self.event_time_range(data_file, context)
+        context.update_pk_cache(data_file, pks, time_range)
+        dst_path = context.temp_path(f'{data_file.name}-deduplicate.jsonl')
         pk_values = set()
         with atomic_save(dst_path) as f:
-            for data, line in data_file.readlines():
+            for data, line in source_file.readlines():
                 pk_value = []
                 for pk in pks:
                     pk_value.append(data[pk])
@@ -207,11 +294,88 @@ class DeduplicateFunction(Function):
                 f.write(b'\n')
         return data_file, context.create_data_file(file_path=dst_path, tags= data_file.tags)
 
+    def event_time_range(self, data_file, context):
+        """
+        Return ((min, max) event timestamp, file to read records from).
+        The range comes from the datetime_start/datetime_end tags, or from scanning the
+        timestamp_field of records. A remote file is spooled to a temp_path while scanning,
+        so it is only downloaded once.
+        """
+        tags = data_file.tags or {}
+        if tags.get('datetime_start') and tags.get('datetime_end'):
+            return (common.parse_timestamp(tags['datetime_start']),
+                    common.parse_timestamp(tags['datetime_end'])), data_file
+        timestamp_field = self.args.get('timestamp_field')
+        if not timestamp_field:
+            return None, data_file
+        if data_file.provider:
+            spool_path = context.temp_path(f'{data_file.name}-spool.jsonl')
+            with atomic_save(spool_path) as spool:
+                time_range = self._scan_event_time(data_file, timestamp_field, spool)
+            return time_range, context.create_data_file(file_path=spool_path, tags=data_file.tags)
+        return self._scan_event_time(data_file, timestamp_field), data_file
+
+    def _scan_event_time(self, data_file, timestamp_field, spool=None):
+        min_ts, max_ts = None, None
+        for data, line in data_file.readlines():
+            if spool:
+                spool.write(line.encode('utf-8'))
+                spool.write(b'\n')
+            value = data.get(timestamp_field)
+            if value is None:
+                continue
+            try:
+                ts = common.parse_timestamp(value)
+            except Exception:
+                logger.error(f'parse event time failed, key={timestamp_field}, value={value}')
+                continue
+            min_ts = ts if min_ts is None else min(min_ts, ts)
+            max_ts = ts if max_ts is None else max(max_ts, ts)
+        if min_ts is None:
+            return None
+        return min_ts, max_ts
+
+    def process_with_pk_cache(self, data_file, context, pks, pk_cache):
+        """
+        Claim the keys of records in a named pk cache, in batches of the batch_size of the
+        cache; records whose key is held by another input are dropped. Keys are claimed for
+        this run and input, so a recovery that runs the task again keeps the records of the
+        first attempt.
+        """
+        owner = hashlib.md5(f'{context.run_id}:{context.data_file.file_path}:{data_file.name}'
+                            .encode('utf-8')).hexdigest()
+
+        def flush(f, batch):
+            claimed = pk_cache.claim_many([pk_value for pk_value, _ in batch], owner)
+            for (pk_value, data), is_new in zip(batch, claimed):
+                if is_new:
+                    f.write(json.dumps(data).encode('utf-8'))
+                    f.write(b'\n')
+
+        batch_size = pk_cache.batch_size
+        dst_path = context.temp_path(f'{data_file.name}-deduplicate.jsonl')
+        pk_values = set()
+        batch = []
+        with atomic_save(dst_path) as f:
+            for data, line in data_file.readlines():
+                pk_value = tuple(data[pk] for pk in pks)
+                if pk_value in pk_values:
+                    continue
+                pk_values.add(pk_value)
+                batch.append((pk_value, data))
+                if len(batch) >= batch_size:
+                    flush(f, batch)
+                    batch = []
+            if batch:
+                flush(f, batch)
+        return data_file, context.create_data_file(file_path=dst_path, tags=data_file.tags)
+
 
 class FilterFunction(FunctionMultiMixin, Function):
     function_name = 'filter'
 
     def process(self, data_file, context):
+        from jinja2 import Environment, TemplateSyntaxError
         logger.debug('filter data file', data_file=data_file.file_path)
         data_files = []
 
@@ -220,25 +384,24 @@ class FilterFunction(FunctionMultiMixin, Function):
             tags = rule_config.get('tags')
             rule = rule_config.get('rule', "False")
 
-            dst_path = os.path.join(context.temp_dir, f'{data_file.name}-filter-{"_".join(list(tags.values())) if tags else "default"}.jsonl')
-            file_saver = AtomicSaver(dst_path)
-            file_saver.setup()
+            dst_path = context.temp_path(f'{data_file.name}-filter-{"_".join(list(tags.values())) if tags else "default"}.jsonl')
+            file_saver = context.create_file_saver(dst_path, tags)
 
             # compile expression by jinja2
             compiled_expr = Environment().compile_expression(rule)
 
-            for data, line in data_file.readlines():
-                try:
-                    filtered = compiled_expr(data)
-                    if filtered:
-                        file_saver.part_file.write(line.encode('utf-8'))
-                        file_saver.part_file.write(b'\n')
-                except TemplateSyntaxError as e:
-                    logger.error(f'filter rule syntax error, exception={repr(e)}')
-                except Exception as e:
-                    logger.error(f'filter failed, exception={repr(e)}')
-
-            file_saver.__exit__(None, None, None)
+            with file_saver as f:
+                for data, line in data_file.readlines():
+                    try:
+                        filtered = compiled_expr(data)
+                        if filtered:
+                            f.write(line.encode('utf-8'))
+                            f.write(b'\n')
+                    except TemplateSyntaxError as e:
+                        logger.error(f'filter rule syntax error, exception={repr(e)}')
+                    except Exception as e:
+                        logger.error(f'filter failed, exception={repr(e)}')
+
             data_files.append(context.create_data_file(file_path=file_saver.dest_path, tags=tags))
 
         return data_files
@@ -271,33 +434,48 @@ class MergeFunction(FunctionMultiMixin, Function):
         else:
             merge_group['default'] = data_files
 
-        for group_set, file_list in merge_group.items():
-            new_data_files = self.merge_group_file(group_set, file_list, context)
+        groups = list(merge_group.items())
+        for new_data_files in context.map_files(lambda group: self.merge_group_file(*group, context), groups):
             result.extend(new_data_files)
         return result
 
+    @staticmethod
+    def common_tags(file_list):
+        """
+        tags all files of a group agree on, those of the merged files
+        """
+        tags = dict(file_list[0].tags or {}) if file_list else {}
+        for file in file_list[1:]:
+            file_tags = file.tags or {}
+            tags = {k: v for k, v in tags.items() if file_tags.get(k) == v}
+        return tags or None
+
     def merge_group_file(self, group_name, file_list, context):
         file_count = 0
         count = 0
         new_data_files = []
-        dst_path = os.path.join(context.temp_dir, f'{context.data_file.name}-merge-{group_name}_{file_count}.jsonl')
-        file_saver = AtomicSaver(dst_path)
+        tags = self.common_tags(file_list)
+        dst_path = context.temp_path(f'{context.data_file.name}-merge-{group_name}_{file_count}.jsonl')
+        file_saver = context.create_file_saver(dst_path, tags)
         file_saver.setup()
-        for file in file_list:
-            for (data, line) in file.readlines():
-                file_saver.part_file.write(line.encode('utf-8'))
-                file_saver.part_file.write(b'\n')
-                if count >= self.file_size:
-                    file_count += 1
-                    count = 0
-                    file_saver.__exit__(None, None, None)
-                    new_data_files.append(context.create_data_file(file_saver.dest_path))
-                    next_dst_path = os.path.join(context.temp_dir, f'{context.data_file.name}-merge-{group_name}_{file_count}.jsonl')
-                    file_saver = AtomicSaver(next_dst_path)
-                    file_saver.setup()
-                count += 1
-
-        if file_saver:
-            file_saver.__exit__(None, None, None)
-            new_data_files.append(context.create_data_file(file_saver.dest_path))
+        try:
+            for file in file_list:
+                for (data, line) in file.readlines():
+                    file_saver.part_file.write(line.encode('utf-8'))
+                    file_saver.part_file.write(b'\n')
+                    if count >= self.file_size:
+                        file_count += 1
+                        count = 0
+                        file_saver.__exit__(None, None, None)
+                        new_data_files.append(context.create_data_file(file_saver.dest_path, tags=tags))
+                        next_dst_path = context.temp_path(f'{context.data_file.name}-merge-{group_name}_{file_count}.jsonl')
+                        file_saver = context.create_file_saver(next_dst_path, tags)
+                        file_saver.setup()
+                    count += 1
+        except BaseException:
+            file_saver.__exit__(*sys.exc_info())
+            raise
+
+        file_saver.__exit__(None, None, None)
+        new_data_files.append(context.create_data_file(file_saver.dest_path, tags=tags))
         return new_data_files
\ No newline at end of file
@@ -12,22 +12,35 @@ def main():
     pass
 
 
+runner_option = click.option("--runner", type=click.Choice(['process', 'pool']), default='process',
+                             help="process starts an interpreter per job, pool reuses warm worker processes")
+process_count_option = click.option("--process-count", type=int, default=None,
+                                    help="max concurrent jobs, default twice the cpu count")
+log_max_size_option = click.option("--log-max-size", type=str, default=None,
+                                   help="also write job output to rotated logs in the working dir, e.g. 100MB; "
+                                        "process runner only")
+
+
 @click.command()
 @click.argument("project", type=click.Path(exists=True))
+@runner_option
+@process_count_option
+@log_max_size_option
 @click.pass_context
-def run(ctx, project):
-    sm = SpinManager()
+def run(ctx, project, runner, process_count, log_max_size):
+    sm = SpinManager(runner=runner, process_count=process_count, log_max_size=log_max_size)
     sm.load_one(project)
     sm.run()
 
 @click.command()
 @click.argument("project", type=click.Path(exists=True))
 @click.argument("process_name", type=str)
+@click.option("--run-id", type=str, default=None, help="run id, generated when not given")
 @click.pass_context
-def run_process(ctx, project, process_name):
+def run_process(ctx, project, process_name, run_id):
     sm = SpinManager()
     sm.load_one(project)
-    sm.run_process(project, process_name)
+    sm.run_process(project, process_name, run_id=run_id)
 
 @click.command()
 @click.argument("project", type=click.Path(exists=True))
@@ -41,9 +54,12 @@ def recover_process(ctx, project, process_name, recover_path):
 
 @click.command()
 @click.argument("project", type=click.Path(exists=True))
+@runner_option
+@process_count_option
+@log_max_size_option
 @click.pass_context
-def start(ctx, project):
-    sm = SpinManager()
+def start(ctx, project, runner, process_count, log_max_size):
+    sm = SpinManager(runner=runner, process_count=process_count, log_max_size=log_max_size)
     if os.path.isfile(project):
         sm.load_one(project)
     elif os.path.isdir(project):
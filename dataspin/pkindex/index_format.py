@@ -0,0 +1,105 @@
+"""
+Binary pk index file, version 3.
+
+    magic      8 bytes  b'DSPKIDX3'
+    length     4 bytes  little endian length of the header
+    header     json     version, key fields, time range, count and blocks layout
+    blocks     bytes    zlib compressed blocks of sorted key hashes, 16 bytes each
+
+A key hash is a 16 byte blake2b over the marshaled pk values, so files written by any
+process can be compared against each other. Two distinct keys with the same hash are
+taken as duplicates and the later record is dropped; with 128 bits that takes around
+2**64 keys in one dedup window, 64 bits would already risk it at a few billion. The
+price is index files of about 16 bytes per key, where deltas of shorter hashes would
+pack smaller, in exchange for fixed width rows that are kept as bytes, no decoding.
+
+Files of an older binary version are rejected, they have to be rebuilt.
+"""
+from operator import itemgetter
+import hashlib
+import json
+import struct
+import zlib
+
+from dataspin.utils.common import marshal
+
+MAGIC_PREFIX = b'DSPKIDX'
+MAGIC = b'DSPKIDX3'
+VERSION = 3
+DEFAULT_BLOCK_SIZE = 8192
+HASH_SIZE = 16
+
+
+def pk_hash(pk_values):
+    return hashlib.blake2b(marshal(list(pk_values)).encode('utf-8'), digest_size=HASH_SIZE).digest()
+
+
+def is_binary_index(content: bytes):
+    """
+    whether content is a binary pk index of any version, read_header rejects the old ones
+    """
+    return content[:len(MAGIC_PREFIX)] == MAGIC_PREFIX
+
+
+def _decode_hashes(data, count):
+    if len(data) != count * HASH_SIZE:
+        raise Exception(f'index block corrupted, expect {count} keys, got {len(data) / HASH_SIZE}')
+    return list(map(itemgetter(0), struct.iter_unpack(f'{HASH_SIZE}s', data)))
+
+
+def write_index(fp, key_hashes, key_fields, time_start=None, time_end=None,
+                block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Write key hashes to the binary file object fp, return the number of keys written.
+    """
+    key_hashes = sorted(set(key_hashes))
+    blocks = []
+    block_data = []
+    for i in range(0, len(key_hashes), block_size):
+        block = key_hashes[i:i + block_size]
+        data = zlib.compress(b''.join(block))
+        blocks.append({'count': len(block), 'length': len(data)})
+        block_data.append(data)
+
+    header = json.dumps({
+        'version': VERSION,
+        'key': list(key_fields),
+        'time_start': time_start,
+        'time_end': time_end,
+        'count': len(key_hashes),
+        'blocks': blocks
+    }).encode('utf-8')
+    fp.write(MAGIC)
+    fp.write(struct.pack('<I', len(header)))
+    fp.write(header)
+    for data in block_data:
+        fp.write(data)
+    return len(key_hashes)
+
+
+def read_header(content: bytes):
+    """
+    return (header, offset of the blocks)
+    """
+    if not is_binary_index(content):
+        raise Exception('not a binary pk index file')
+    if content[:len(MAGIC)] != MAGIC:
+        raise Exception(f'unsupported pk index version {content[:len(MAGIC)]!r}, expect {MAGIC!r}')
+    offset = len(MAGIC)
+    header_length, = struct.unpack_from('<I', content, offset)
+    offset += 4
+    header = json.loads(content[offset:offset + header_length])
+    return header, offset + header_length
+
+
+def read_index(content: bytes):
+    """
+    return (header, list of sorted key hashes)
+    """
+    header, offset = read_header(content)
+    key_hashes = []
+    for block in header['blocks']:
+        data = zlib.decompress(content[offset:offset + block['length']])
+        key_hashes.extend(_decode_hashes(data, block['count']))
+        offset += block['length']
+    return header, key_hashes
@@ -0,0 +1,381 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse, parse_qsl
+
+from basepy.log import logger
+
+from dataspin.utils.common import marshal, parse_scheme, convert_time_window_to_seconds
+
+
+class PKCache:
+    """
+    Named primary key cache shared by deduplicate functions.
+
+    Keys are tuples of primary key values. Backends answer lookups and inserts
+    in batches, so one round trip covers `batch_size` records instead of one.
+    Entries expire `timeout` seconds after they were inserted, a timeout of None
+    keeps them forever.
+
+    Deduplicate claims keys with claim_many, an atomic set-if-absent that stores an
+    owner with each key. A key counts as new for the owner that stored it, so a task
+    run again for the same input (recovery after a crash) keeps its own records
+    instead of dropping them as duplicates.
+    """
+    batch_size = 500
+
+    def __init__(self, name, timeout=None, batch_size=None):
+        self.name = name
+        self.timeout = timeout
+        if batch_size:
+            self.batch_size = int(batch_size)
+
+    @classmethod
+    def load(cls, conf):
+        timeout = convert_time_window_to_seconds(conf.timeout) if conf.timeout else None
+        return get_pk_cache(conf.name, conf.url, timeout)
+
+    @staticmethod
+    def encode_key(key):
+        return marshal(list(key))
+
+    def _expire_at(self, now=None):
+        if not self.timeout:
+            return None
+        return int(now or time.time()) + self.timeout
+
+    def _batches(self, keys):
+        for i in range(0, len(keys), self.batch_size):
+            yield keys[i:i + self.batch_size]
+
+    def exists_many(self, keys):
+        """
+        return a list of bools, one for each key, in the same order
+        """
+        keys = list(keys)
+        result = []
+        for batch in self._batches(keys):
+            result.extend(self._exists_batch([self.encode_key(key) for key in batch]))
+        return result
+
+    def add_many(self, keys):
+        keys = list(keys)
+        for batch in self._batches(keys):
+            self._add_batch([self.encode_key(key) for key in batch])
+
+    def claim_many(self, keys, owner):
+        """
+        add the keys that are absent, with owner; return a list of bools, True for each
+        key now held by owner
+        """
+        keys = list(keys)
+        result = []
+        for batch in self._batches(keys):
+            result.extend(self._claim_batch([self.encode_key(key) for key in batch], owner))
+        return result
+
+    def exists(self, key):
+        return self.exists_many([key])[0]
+
+    def add(self, key):
+        self.add_many([key])
+
+    def _exists_batch(self, encoded_keys):
+        raise NotImplementedError
+
+    def _add_batch(self, encoded_keys):
+        raise NotImplementedError
+
+    def _claim_batch(self, encoded_keys, owner):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MemoryPKCache(PKCache):
+
+    def __init__(self, name, timeout=None, **kwargs):
+        super(MemoryPKCache, self).__init__(name, timeout, kwargs.get('batch_size'))
+        self._keys = {}
+        self._owners = {}
+        self._lock = threading.Lock()
+        self._last_purge = time.time()
+
+    def _live(self, key, now):
+        expire_at = self._keys.get(key, 0)
+        return expire_at is None or expire_at > now
+
+    def _exists_batch(self, encoded_keys):
+        now = time.time()
+        with self._lock:
+            return [self._live(key, now) for key in encoded_keys]
+
+    def _add_batch(self, encoded_keys):
+        now = time.time()
+        expire_at = self._expire_at(now)
+        with self._lock:
+            for key in encoded_keys:
+                self._keys[key] = expire_at
+                self._owners.pop(key, None)
+            self._purge(now)
+
+    def _claim_batch(self, encoded_keys, owner):
+        now = time.time()
+        expire_at = self._expire_at(now)
+        result = []
+        with self._lock:
+            for key in encoded_keys:
+                if not self._live(key, now):
+                    self._keys[key] = expire_at
+                    self._owners[key] = owner
+                result.append(self._owners.get(key) == owner)
+            self._purge(now)
+        return result
+
+    def _purge(self, now):
+        if self.timeout and now - self._last_purge >= self.timeout:
+            self._keys = {k: v for k, v in self._keys.items() if v is None or v > now}
+            self._owners = {k: v for k, v in self._owners.items() if k in self._keys}
+            self._last_purge = now
+
+
+class SqlitePKCache(PKCache):
+    """
+    On-disk embedded store, for dedup windows that do not fit in memory.
+    Several caches can share one database file, rows are namespaced by cache name.
+    """
+    purge_interval = 600
+
+    def __init__(self, name, path, timeout=None, **kwargs):
+        super(SqlitePKCache, self).__init__(name, timeout, kwargs.get('batch_size'))
+        self.path = path
+        dirname = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dirname, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS pk_cache ('
+                           'cache TEXT NOT NULL, pk TEXT NOT NULL, expire_at INTEGER, owner TEXT, '
+                           'PRIMARY KEY (cache, pk)) WITHOUT ROWID')
+        self._conn.commit()
+        self._last_purge = 0
+
+    def _exists_batch(self, encoded_keys):
+        now = int(time.time())
+        placeholders = ','.join('?' * len(encoded_keys))
+        sql = (f'SELECT pk FROM pk_cache WHERE cache = ? AND pk IN ({placeholders}) '
+               'AND (expire_at IS NULL OR expire_at > ?)')
+        with self._lock:
+            rows = self._conn.execute(sql, [self.name, *encoded_keys, now]).fetchall()
+        found = set(row[0] for row in rows)
+        return [key in found for key in encoded_keys]
+
+    def _add_batch(self, encoded_keys):
+        now = int(time.time())
+        expire_at = self._expire_at(now)
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO pk_cache (cache, pk, expire_at) VALUES (?, ?, ?)',
+                                   [(self.name, key, expire_at) for key in encoded_keys])
+            self._purge(now)
+            self._conn.commit()
+
+    def _claim_batch(self, encoded_keys, owner):
+        now = int(time.time())
+        expire_at = self._expire_at(now)
+        placeholders = ','.join('?' * len(encoded_keys))
+        with self._lock:
+            # one write transaction, so concurrent claims of a key serialize
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.execute(f'DELETE FROM pk_cache WHERE cache = ? AND pk IN ({placeholders}) '
+                                   'AND expire_at <= ?', [self.name, *encoded_keys, now])
+                self._conn.executemany('INSERT OR IGNORE INTO pk_cache (cache, pk, expire_at, owner) '
+                                       'VALUES (?, ?, ?, ?)',
+                                       [(self.name, key, expire_at, owner) for key in encoded_keys])
+                rows = self._conn.execute(f'SELECT pk, owner FROM pk_cache WHERE cache = ? '
+                                          f'AND pk IN ({placeholders})', [self.name, *encoded_keys]).fetchall()
+                self._purge(now)
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+        owners = dict(rows)
+        return [owners.get(key) == owner for key in encoded_keys]
+
+    def _purge(self, now):
+        if self.timeout and now - self._last_purge >= self.purge_interval:
+            self._conn.execute('DELETE FROM pk_cache WHERE cache = ? AND expire_at <= ?',
+                               (self.name, now))
+            self._last_purge = now
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisClient:
+    """
+    Minimal RESP client, only what the pk cache needs: pipelined commands over one connection.
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None, socket_timeout=30):
+        self.host = host
+        self.port = int(port)
+        self.db = int(db)
+        self.password = password
+        self.socket_timeout = socket_timeout
+        self._sock = None
+        self._reader = None
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.socket_timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._reader = self._sock.makefile('rb')
+        commands = []
+        if self.password:
+            commands.append(('AUTH', self.password))
+        if self.db:
+            commands.append(('SELECT', self.db))
+        if commands:
+            self._pipeline(commands)
+
+    @staticmethod
+    def _pack(command):
+        parts = [b'*%d\r\n' % len(command)]
+        for arg in command:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(parts)
+
+    def _read_reply(self):
+        line = self._reader.readline()
+        if not line:
+            raise RedisError('connection closed by server')
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode('utf-8')
+        if kind == b'-':
+            return RedisError(payload.decode('utf-8'))
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            if length < 0:
+                return None
+            data = self._reader.read(length + 2)
+            return data[:-2]
+        if kind == b'*':
+            length = int(payload)
+            if length < 0:
+                return None
+            return [self._read_reply() for _ in range(length)]
+        raise RedisError(f'unknown reply type {kind!r}')
+
+    def _pipeline(self, commands):
+        self._sock.sendall(b''.join(self._pack(command) for command in commands))
+        replies = [self._read_reply() for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    def pipeline(self, commands):
+        if self._sock is None:
+            self._connect()
+        try:
+            return self._pipeline(commands)
+        except (OSError, RedisError):
+            self.close()
+            raise
+
+    def execute(self, *command):
+        return self.pipeline([command])[0]
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._reader.close()
+                self._sock.close()
+            finally:
+                self._sock = None
+                self._reader = None
+
+
+class RedisPKCache(PKCache):
+    """
+    Backend for any server speaking the redis protocol. Lookups are one MGET per batch,
+    inserts one pipelined round trip of SET commands per batch. Claims pipeline a
+    SET NX and a GET per key, the GET tells who holds the key after the SET.
+    """
+
+    def __init__(self, name, host='localhost', port=6379, db=0, password=None, timeout=None, **kwargs):
+        super(RedisPKCache, self).__init__(name, timeout, kwargs.get('batch_size'))
+        self.key_prefix = kwargs.get('key_prefix') or f'dataspin:pk:{name}:'
+        self._client = RedisClient(host, port, db, password)
+        self._lock = threading.Lock()
+
+    def _exists_batch(self, encoded_keys):
+        with self._lock:
+            values = self._client.execute('MGET', *[self.key_prefix + key for key in encoded_keys])
+        return [value is not None for value in values]
+
+    def _add_batch(self, encoded_keys):
+        commands = []
+        for key in encoded_keys:
+            if self.timeout:
+                commands.append(('SET', self.key_prefix + key, 1, 'EX', self.timeout))
+            else:
+                commands.append(('SET', self.key_prefix + key, 1))
+        with self._lock:
+            self._client.pipeline(commands)
+
+    def _claim_batch(self, encoded_keys, owner):
+        commands = []
+        for key in encoded_keys:
+            expire = ('EX', self.timeout) if self.timeout else ()
+            commands.append(('SET', self.key_prefix + key, owner, 'NX', *expire))
+            commands.append(('GET', self.key_prefix + key))
+        with self._lock:
+            replies = self._client.pipeline(commands)
+        owner = owner.encode('utf-8')
+        return [value == owner for value in replies[1::2]]
+
+    def close(self):
+        with self._lock:
+            self._client.close()
+
+
+def get_pk_cache(name, url, timeout=None):
+    """
+    memory://
+    sqlite://./tmp/pk_cache.db
+    redis://:password@localhost:6379/0
+    """
+    parsed = urlparse(url)
+    params = dict(parse_qsl(parsed.query))
+    _, platform = parse_scheme(parsed.scheme)
+    logger.debug('load pk cache', name=name, platform=platform)
+    if platform == 'memory':
+        return MemoryPKCache(name, timeout, **params)
+    if platform == 'sqlite':
+        path = os.path.join(parsed.netloc, parsed.path[1:]) if parsed.netloc else parsed.path
+        return SqlitePKCache(name, path, timeout, **params)
+    if platform == 'redis':
+        path = parsed.path.strip('/')
+        return RedisPKCache(name,
+                            host=parsed.hostname or 'localhost',
+                            port=parsed.port or 6379,
+                            db=int(path) if path else 0,
+                            password=parsed.password,
+                            timeout=timeout,
+                            **params)
+    raise Exception(f'No pk cache for platform {platform}')
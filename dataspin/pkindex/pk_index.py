@@ -1,35 +1,88 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import datetime
+import gzip
+import json
+import multiprocessing
+import re
+from string import Formatter
 import time
 from dataspin.utils import common
+from dataspin.pkindex.index_format import pk_hash, is_binary_index, read_index
+
+
+def load_pk_hashes(content: bytes, ext, pk_keys):
+    """
+    Parse the content of an index file, jsonl or binary, into pk key hashes.
+    Module level, so it can run in a process pool.
+    """
+    if ext and ext.endswith('.gz'):
+        content = gzip.decompress(content)
+    if is_binary_index(content):
+        header, key_hashes = read_index(content)
+        if header['key'] != list(pk_keys):
+            raise Exception(f'index keys {header["key"]} do not match pk keys {pk_keys}')
+        return key_hashes
+    pk_hashes = []
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        data = json.loads(line)
+        pk_hashes.append(pk_hash(data[pk_key] for pk_key in pk_keys))
+    return pk_hashes
 
 
 class PKIndexCache:
+    default_load_concurrency = 16
 
-    def __init__(self, pk_keys: list, time_window, baseline_time) -> None:
+    def __init__(self, pk_keys: list, time_window, baseline_time, load_concurrency=None, parse_processes=None) -> None:
         """
         For run once task,expire time is None,and for run loop task,expire time can be seconds.
         When a data file processed success, update the data file index file to caches
         when current_time minus baseline_time larger than time_window,exchange cache and precache,and refresh a new set for precache
+
+        The cache holds pk key hashes, see index_format.pk_hash.
+        Index files are downloaded by load_concurrency threads, and parsed by those threads too
+        unless parse_processes is set, then parsing goes to a process pool of that size.
         """
         self._cache = set()
         self._precache = set()
         self._pk_keys = pk_keys
         self._time_window = time_window
         self._baseline_time = baseline_time
+        self._load_concurrency = int(load_concurrency or self.default_load_concurrency)
+        self._parse_processes = int(parse_processes or 0)
+        self._parse_pool = None
+
+    def _read_pk_hashes(self, data_file):
+        return load_pk_hashes(data_file.read_bytes(), data_file.ext, self._pk_keys)
+
+    def _iter_pk_hashes(self, data_files):
+        with ThreadPoolExecutor(max_workers=min(self._load_concurrency, len(data_files))) as downloader:
+            if not self._parse_processes:
+                yield from downloader.map(self._read_pk_hashes, data_files)
+                return
+            if self._parse_pool is None:
+                # the engine runs threads, forking it could copy a held lock into the workers
+                self._parse_pool = ProcessPoolExecutor(max_workers=self._parse_processes,
+                                                       mp_context=multiprocessing.get_context('forkserver'))
+            futures = []
+            for data_file, content in zip(data_files, downloader.map(lambda f: f.read_bytes(), data_files)):
+                futures.append(self._parse_pool.submit(load_pk_hashes, content, data_file.ext, self._pk_keys))
+        for future in futures:
+            yield future.result()
 
     def update_pk_files(self, data_files:list):
-        for data_file in data_files:
-            self._expire()
-            for data, line in data_file.readlines():
-                self._update_cache_value(data)
+        if not data_files:
+            return
+        self._expire()
+        for pk_hashes in self._iter_pk_hashes(data_files):
+            self._cache.update(pk_hashes)
+            self._precache.update(pk_hashes)
 
     def _update_cache_value(self, data):
-        pk_value = []
-        for pk_key in self._pk_keys:
-            pk_value.append(data[pk_key])
-        pk_value = tuple(pk_value)
-        self._cache.add(pk_value)
-        self._precache.add(pk_value)
+        key_hash = pk_hash(data[pk_key] for pk_key in self._pk_keys)
+        self._cache.add(key_hash)
+        self._precache.add(key_hash)
 
     def _expire(self):
         if not self._time_window:
@@ -44,17 +97,68 @@ class PKIndexCache:
         """
         data {"app_id":"","event_id":""}
         """
-        pk_value = []
-        for k in self._pk_keys:
-            pk_value.append(data[k])
-        pk_value = tuple(pk_value)
-        return pk_value in self._cache
+        return pk_hash(data[k] for k in self._pk_keys) in self._cache
+
+    def close(self):
+        if self._parse_pool is not None:
+            self._parse_pool.shutdown()
+            self._parse_pool = None
 
 
 class IndexSearcher:
+    """
+    Find index files of a time range under an index_pattern like
+    "datalog/event/{app_id}/{year}/{month}/{day}/{hour}/{minute}/".
+
+    The range is covered with the coarsest prefixes the pattern allows: whole days,
+    then whole hours, then minutes at the edges. Prefixes are listed concurrently.
+
+    select_new_index_files remembers the keys it listed per prefix and only returns keys
+    not seen before. Each prefix is refreshed at most every refresh_interval, and keys of
+    prefixes that left the time range are forgotten.
 
-    def __init__(self) -> None:
-        pass
+    Every refresh lists the due prefixes in full, so its cost grows with the index files
+    of the range, not with the new ones. A StartAfter cursor would not do: index keys are
+    named after their source files, not the write time, so a late index file can sort
+    before keys already listed. Coarse prefixes and refresh_interval keep it down.
+    """
+    time_units = ['year', 'month', 'day', 'hour', 'minute', 'second']
+    prefix_levels = [('day', 24*60*60), ('hour', 60*60), ('minute', 60)]
+    default_list_concurrency = 16
+
+    def __init__(self, list_concurrency=None, refresh_interval=None) -> None:
+        self.list_concurrency = int(list_concurrency or self.default_list_concurrency)
+        self.refresh_interval = refresh_interval or 0
+        self._listed_at = {}
+        self._seen_keys = {}
+
+    def _prefix_levels(self, pattern):
+        """
+        return [(unit, seconds, cut)] from coarse to fine, where cut is the pattern part
+        to format for a prefix of that unit.
+        """
+        fields = []
+        for _, field_name, _, _ in Formatter().parse(pattern):
+            if field_name is not None:
+                fields.append((field_name, re.search(r'\{%s[}!:]' % re.escape(field_name), pattern).start()))
+        field_names = [name for name, _ in fields]
+        levels = []
+        for unit, seconds in self.prefix_levels:
+            if unit not in field_names:
+                continue
+            finer_units = self.time_units[self.time_units.index(unit) + 1:]
+            cut = len(pattern)
+            usable = True
+            for i, (name, field_position) in enumerate(fields):
+                if name in finer_units:
+                    cut = field_position
+                    usable = all(rest in finer_units for rest, _ in fields[i:])
+                    break
+            if usable:
+                levels.append((unit, seconds, pattern[:cut]))
+        if not levels:
+            raise Exception(f'index_pattern {pattern} can not be listed by time prefix')
+        return levels
 
     def get_index_prefixs(self, pattern: str, tags, start_timestamp: int, end_timestamp: int):
         """
@@ -64,32 +168,83 @@ class IndexSearcher:
             raise Exception('start_timestamp should be larger than 0')
         if end_timestamp == None:
             end_timestamp = int(time.time())
-        expire_minutes = int((end_timestamp-start_timestamp)/60)
-        end_time = datetime.datetime.utcfromtimestamp(end_timestamp)
+        levels = self._prefix_levels(pattern)
+        step = levels[-1][1]
+        current = int(start_timestamp) // step * step
+        end = int(end_timestamp) // step * step + step
         prefixs = []
-        for i in range(expire_minutes):
-            target_date = end_time+datetime.timedelta(minute=-i)
-            year = str.zfill(str(target_date.year), 4)
-            month = str.zfill(str(target_date.month), 2)
-            day = str.zfill(str(target_date.day), 2)
-            hour = str.zfill(str(target_date.hour), 2)
-            minute = str.zfill(str(target_date.minute), 2)
-            date_pattern = {"year": year, "month": month,
-                            "day": day, "hour": hour, "minute": minute}
-            date_pattern.update(tags)
-            prefixs.append(pattern.format(**date_pattern))
+        while current < end:
+            for unit, seconds, cut in levels:
+                if current % seconds == 0 and current + seconds <= end:
+                    break
+            target_date = datetime.datetime.utcfromtimestamp(current)
+            date_pattern = {"year": str.zfill(str(target_date.year), 4),
+                            "month": str.zfill(str(target_date.month), 2),
+                            "day": str.zfill(str(target_date.day), 2),
+                            "hour": str.zfill(str(target_date.hour), 2),
+                            "minute": str.zfill(str(target_date.minute), 2)}
+            date_pattern.update(tags or {})
+            prefixs.append(cut.format(**date_pattern))
+            current += seconds
         return prefixs
 
     def check_index_file(self, key):
         return key.endswith('.index')
 
+    def list_prefix(self, storage, prefix):
+        return [key for key in storage.get(prefix=prefix) if self.check_index_file(key)]
+
+    def _list_prefixs(self, storage, prefixs):
+        def list_one(prefix):
+            return self.list_prefix(storage, prefix)
+
+        with ThreadPoolExecutor(max_workers=min(self.list_concurrency, len(prefixs))) as executor:
+            return list(executor.map(list_one, prefixs))
+
     def select_index_files(self, storage, pattern: str, tags, start_timestamp,end_timestamp):
         prefixs = self.get_index_prefixs(
             pattern, tags, start_timestamp, end_timestamp)
         target_index_files = []
-        for prefix in prefixs:
-            for key in storage.get(prefix=prefix):
-                if not self.check_index_file(key):
-                    continue
-                target_index_files.append(key)
+        for keys in self._list_prefixs(storage, prefixs):
+            target_index_files.extend(keys)
+        return target_index_files
+
+    def select_new_index_files(self, storage, pattern: str, tags, start_timestamp, end_timestamp):
+        """
+        Index files not returned before. A prefix listed less than refresh_interval ago
+        is skipped, prefixes of a time range not seen before are always listed.
+        """
+        now = time.time()
+        tags_key = common.marshal(sorted((tags or {}).items()))
+        listed_at = self._listed_at.setdefault(tags_key, {})
+        seen_keys = self._seen_keys.setdefault(tags_key, {})
+        window = self.get_index_prefixs(pattern, tags, start_timestamp, end_timestamp)
+        self._forget(window, listed_at, seen_keys)
+        prefixs = [prefix for prefix in window
+                   if prefix not in listed_at or now - listed_at[prefix] >= self.refresh_interval]
+        if not prefixs:
+            return []
+        target_index_files = []
+        for prefix, keys in zip(prefixs, self._list_prefixs(storage, prefixs)):
+            # keys may have been seen under a finer or coarser prefix of an earlier window
+            related = [other for other in seen_keys if other.startswith(prefix) or prefix.startswith(other)]
+            for key in keys:
+                if not any(key in seen_keys[other] for other in related):
+                    target_index_files.append(key)
+            for other in related:
+                if other.startswith(prefix):
+                    seen_keys.pop(other)
+                    listed_at.pop(other, None)
+            seen_keys[prefix] = set(keys)
+            listed_at[prefix] = now
         return target_index_files
+
+    @staticmethod
+    def _forget(window, listed_at, seen_keys):
+        """
+        drop the prefixes, and their keys, no prefix of the time range overlaps
+        """
+        for prefix in list(seen_keys):
+            if not any(prefix.startswith(other) or other.startswith(prefix) for other in window):
+                seen_keys.pop(prefix)
+                listed_at.pop(prefix, None)
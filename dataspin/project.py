@@ -7,6 +7,11 @@ from basepy.log import logger
 @dataclass
 class DataSpinConfig:
     working_dir: Optional[str] = None
+    run_retention: Optional[str] = None
+    run_retention_size: Optional[str] = None
+    memory_dir: Optional[str] = None
+    memory_budget: Optional[str] = None
+    memory_durable: Optional[bool] = False
 
 @dataclass
 class StreamConfig:
@@ -64,6 +69,9 @@ class DataProcessConfig:
     description: Optional[str] = ""
     source_args: Optional[dict] = field(default_factory=dict)
     schedules: Optional[List[str]] = field(default_factory=list)
+    overlap_policy: Optional[str] = "allow"
+    max_concurrent: Optional[int] = None
+    parallelism: Optional[int] = None
     processes: Optional[List[ProcessFunctionConfig]] = field(default_factory=list)
 
 @dataclass
@@ -1,12 +1,24 @@
 
 from urllib.parse import urlparse, parse_qsl
 import os
-from dataspin.providers.aws import S3StorageProvider
-from dataspin.providers.local import LocalStorageProvider
-from dataspin.providers.tencent import COSStorageProvider
 
-from dataspin.utils.common import parse_scheme
-    
+from dataspin.utils.common import parse_scheme, load_class
+
+# platform -> provider class, imported only when a url of that platform is opened so
+# a local project never pays for the cloud sdks. Other platforms can be added by
+# packages through the 'dataspin.providers' entry point group; such a provider is
+# built as cls(path, **params) like the object storages.
+PROVIDER_ENTRY_POINT_GROUP = 'dataspin.providers'
+
+provider_class_map = {
+    's3': 'dataspin.providers.aws:S3StorageProvider',
+    'sqs': 'dataspin.providers.aws:SQSStreamProvider',
+    'local': 'dataspin.providers.local:LocalStreamProvider',
+    'file': 'dataspin.providers.local:LocalStorageProvider',
+    'cos': 'dataspin.providers.tencent:COSStorageProvider',
+    'tdmq': 'dataspin.providers.tencent:TDMQStreamProvider',
+}
+
 
 def get_provider(url):
     parsed = urlparse(url)
@@ -16,26 +28,13 @@ def get_provider(url):
             params[key] = value
 
     options, platform = parse_scheme(parsed.scheme)
-    if platform in ["s3", "sqs"]:
-        from .aws import SQSStreamProvider, S3StorageProvider
-        if platform == 's3':
-            path = parsed.path.strip('/')
-            return S3StorageProvider(path,**params)
-        if platform == 'sqs':
-            return SQSStreamProvider(**params)
-    elif platform in ["local", "file"]:
+    provider_class = load_class(platform, provider_class_map, PROVIDER_ENTRY_POINT_GROUP)
+    if provider_class is None:
+        raise Exception(f'No provider for platform {platform}')
+    if platform in ["local", "file"]:
         path = os.path.join(parsed.netloc, parsed.path[1:])
-        from .local import LocalStreamProvider, LocalStorageProvider
-        if platform == "local":
-            return LocalStreamProvider(path, options)
-        if platform == 'file':
-            return LocalStorageProvider(path, options)
-    elif platform in ["cos","tdmq"]:
-        from .tencent import COSStorageProvider,TDMQStreamProvider
-        if platform == 'cos':
-            path = parsed.path.strip('/')
-            return COSStorageProvider(path,**params)
-        if platform == 'tdmq':
-            return TDMQStreamProvider(**params)
-    raise Exception(f'No provider for platform {platform}')
-
+        return provider_class(path, options)
+    if platform in ["sqs", "tdmq"]:
+        return provider_class(**params)
+    path = parsed.path.strip('/')
+    return provider_class(path, **params)
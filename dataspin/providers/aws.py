@@ -1,33 +1,108 @@
+from collections import deque
 import gzip
 from io import BytesIO
 import json
 import tempfile
+import threading
 import traceback
-import boto3
 
 from basepy.log import logger
+from dataspin.providers.clients import get_aws_client, get_aws_resource
+from dataspin.utils.common import convert_size_to_bytes, is_unchanged
+from dataspin.utils.multipart import MultipartWriter, S3_MIN_PART_SIZE
+from dataspin.utils.ranged import open_ranged, DEFAULT_PART_SIZE, DEFAULT_CONCURRENCY
+
+def _file_key(file_url):
+    """
+    bucket and key of a file url or of the path of its data file, to match one with the other
+    """
+    return '/'.join(part for part in file_url.split('://', 1)[-1].split('/') if part)
+
 
 class SQSStreamProvider:
-    def __init__(self, name=None, access_key=None, secret_key=None, region=None, **kwargs):
-        sqs = boto3.resource('sqs',
-                             aws_access_key_id=access_key,
-                             aws_secret_access_key=secret_key,
-                             region_name = region)
-        self._queue = sqs.get_queue_by_name(QueueName=name)
-        self._pendding_message = []
+    """
+    Receives up to batch_size messages per call with long polling of wait_time seconds,
+    hands them out one by one and deletes finished ones with batched delete_messages.
+    task_done finishes the message of the given file. A heartbeat thread keeps extending
+    the visibility timeout of messages that are buffered, in process or finished but not
+    deleted yet, by visibility_timeout seconds or the VisibilityTimeout of the queue when
+    not set; visibility_timeout 0 turns it off.
 
-    def get(self,block=True, timeout=None):
-        message_list = self._queue.receive_messages(
-            MaxNumberOfMessages=1)
-        if message_list:
-            message = message_list[0]
-            self._pendding_message.append(message)
-            body = json.loads(message.body)
-            if body.get('data_format') == 'dataspin':
-                return body
+    A run ends when a receive comes back empty, so on an idle queue every run waits
+    wait_time seconds before it finishes. Lower it for short scheduled runs.
+    """
+    max_batch_size = 10
+
+    def __init__(self, name=None, access_key=None, secret_key=None, region=None, queue=None, **kwargs):
+        self._queue_args = dict(QueueName=name)
+        self._client_args = (access_key, secret_key, region, kwargs)
+        self._queue = queue
+        self._batch_size = min(int(kwargs.get('batch_size', self.max_batch_size)), self.max_batch_size)
+        self._wait_time = int(kwargs.get('wait_time', 20))
+        self._visibility_timeout_arg = kwargs.get('visibility_timeout')
+        self._visibility_timeout = None
+        self._buffered_message = deque()
+        self._pendding_message = deque()
+        self._done_message = []
+        self._lock = threading.Lock()
+        self._heartbeat_stop = threading.Event()
+        self._heartbeat_thread = None
+
+    @property
+    def queue(self):
+        # looked up on first use, loading a project must not hit the network
+        with self._lock:
+            if self._queue is None:
+                access_key, secret_key, region, kwargs = self._client_args
+                sqs = get_aws_resource('sqs', access_key, secret_key, region, **kwargs)
+                self._queue = sqs.get_queue_by_name(**self._queue_args)
+        return self._queue
+
+    @property
+    def visibility_timeout(self):
+        if self._visibility_timeout is None:
+            if self._visibility_timeout_arg is not None:
+                self._visibility_timeout = int(self._visibility_timeout_arg)
             else:
-                return self._transform_raw_s3(body)
-        return None
+                self._visibility_timeout = int(self.queue.attributes.get('VisibilityTimeout', 0))
+        return self._visibility_timeout
+
+    def _start_heartbeat(self):
+        if not self.visibility_timeout:
+            return
+        if self._heartbeat_thread is None or not self._heartbeat_thread.is_alive():
+            self._heartbeat_stop.clear()
+            self._heartbeat_thread = threading.Thread(target=self._heartbeat, daemon=True)
+            self._heartbeat_thread.start()
+
+    def _receive(self, block, timeout):
+        self._start_heartbeat()
+        wait_time = self._wait_time if block else 0
+        if timeout is not None:
+            wait_time = min(wait_time, int(timeout))
+        kwargs = dict(MaxNumberOfMessages=self._batch_size, WaitTimeSeconds=wait_time)
+        if self._visibility_timeout_arg is not None and self.visibility_timeout:
+            kwargs['VisibilityTimeout'] = self.visibility_timeout
+        message_list = self.queue.receive_messages(**kwargs)
+        with self._lock:
+            self._buffered_message.extend(message_list)
+
+    def get(self,block=True, timeout=None):
+        if not self._buffered_message:
+            self.flush()
+            self._receive(block, timeout)
+        with self._lock:
+            if not self._buffered_message:
+                return None
+            message = self._buffered_message.popleft()
+        body = json.loads(message.body)
+        if body.get('data_format') != 'dataspin':
+            body = self._transform_raw_s3(body)
+            if body is None:
+                return None
+        with self._lock:
+            self._pendding_message.append((_file_key(body['file_url']), message))
+        return body
 
     def _transform_raw_s3(self,body):
         try:
@@ -48,27 +123,80 @@ class SQSStreamProvider:
 
     def send_message(self, message:dict):
         logger.debug('send sqs message body',body=message)
-        self._queue.send_message(MessageBody=json.dumps(message))
+        self.queue.send_message(MessageBody=json.dumps(message))
 
     def task_done(self, file_path):
-        message = self._pendding_message.pop()
-        message.delete()
+        file_key = _file_key(file_path)
+        with self._lock:
+            for pending in self._pendding_message:
+                if pending[0] == file_key:
+                    break
+            else:
+                raise Exception(f'No sqs message in process for {file_path}')
+            self._pendding_message.remove(pending)
+            self._done_message.append(pending[1])
+            full = len(self._done_message) >= self.max_batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            done_message, self._done_message = self._done_message, []
+        for i in range(0, len(done_message), self.max_batch_size):
+            batch = done_message[i:i + self.max_batch_size]
+            response = self.queue.delete_messages(Entries=[
+                {'Id': str(n), 'ReceiptHandle': message.receipt_handle} for n, message in enumerate(batch)])
+            for failed in response.get('Failed', []):
+                logger.error('delete sqs message failed', failed=failed)
+
+    def _heartbeat(self):
+        while not self._heartbeat_stop.wait(self.visibility_timeout / 2):
+            with self._lock:
+                messages = (list(self._buffered_message) + [message for _, message in self._pendding_message]
+                            + self._done_message)
+            for i in range(0, len(messages), self.max_batch_size):
+                batch = messages[i:i + self.max_batch_size]
+                try:
+                    self.queue.change_message_visibility_batch(Entries=[
+                        {'Id': str(n), 'ReceiptHandle': message.receipt_handle,
+                         'VisibilityTimeout': self.visibility_timeout}
+                        for n, message in enumerate(batch)])
+                except Exception as e:
+                    logger.error('extend sqs message visibility failed', error=repr(e))
+
+    def close(self):
+        self._heartbeat_stop.set()
+        if self._heartbeat_thread is not None:
+            self._heartbeat_thread.join()
+            self._heartbeat_thread = None
+        self.flush()
 
 
 class S3StorageProvider:
     def __init__(self, path=None, access_key=None, secret_key=None,region=None, **kwargs):
-        self._s3_client = boto3.client(
-            's3',
-            aws_access_key_id=access_key,
-            aws_secret_access_key=secret_key,
-            region_name = region
-        )
+        self._s3_client = get_aws_client('s3', access_key, secret_key, region, **kwargs)
         self._path = path
         self._bucket, self._prefix = path.split('/', 1)
+        self._fetch_mode = kwargs.get('fetch_mode', 'download')
+        self._part_size = convert_size_to_bytes(kwargs.get('part_size', DEFAULT_PART_SIZE))
+        self._fetch_concurrency = int(kwargs.get('fetch_concurrency', DEFAULT_CONCURRENCY))
+        self._multipart_threshold = convert_size_to_bytes(kwargs.get('multipart_threshold', '16MB'))
+        self._multipart_chunksize = convert_size_to_bytes(kwargs.get('multipart_chunksize', '16MB'))
+        if self._multipart_chunksize < S3_MIN_PART_SIZE:
+            raise Exception(f'multipart_chunksize {self._multipart_chunksize} is below the s3 minimum part size 5MB')
+        self._transfer_config = None
 
     @property
     def storage_type(self):
         return 's3'
+
+    @property
+    def transfer_config(self):
+        if self._transfer_config is None:
+            from boto3.s3.transfer import TransferConfig
+            self._transfer_config = TransferConfig(multipart_threshold=self._multipart_threshold,
+                                                   multipart_chunksize=self._multipart_chunksize)
+        return self._transfer_config
         
     @property
     def path(self):
@@ -81,19 +209,88 @@ class S3StorageProvider:
                 yield self._bucket+'/'+item['Key']
 
     def fetch_file(self,file_path):
+        if self._fetch_mode == 'ranged':
+            yield from self.fetch_file_ranged(file_path)
+            return
         bucket ,key = file_path.split('/',1)
         with tempfile.TemporaryFile('w+b') as fp:
             self._s3_client.download_fileobj(bucket, key, fp)
             fp.seek(0)
             yield fp
 
-    def save(self, key, local_file):
+    def head(self, file_path):
+        bucket, key = file_path.split('/', 1)
+        head = self._s3_client.head_object(Bucket=bucket, Key=key)
+        return {'etag': head['ETag'], 'size': head['ContentLength'],
+                'md5': head.get('Metadata', {}).get('md5')}
+
+    def fetch_file_ranged(self, file_path):
+        """
+        Stream the object with parallel ranged GETs, pinned to the ETag seen at start.
+        """
+        bucket, key = file_path.split('/', 1)
+        head = self._s3_client.head_object(Bucket=bucket, Key=key)
+        etag = head['ETag']
+
+        def fetch_range(start, end):
+            response = self._s3_client.get_object(Bucket=bucket, Key=key, IfMatch=etag,
+                                                  Range=f'bytes={start}-{end}')
+            return response['Body'].read()
+
+        fp = open_ranged(fetch_range, head['ContentLength'], self._part_size, self._fetch_concurrency)
+        try:
+            yield fp
+        finally:
+            fp.close()
+
+    def save(self, key, local_file, checksum=None):
+        """
+        with the md5 checksum of local_file, the upload is skipped when the object
+        already has that content, and the checksum is stored in the object metadata
+        """
         key = self._prefix + '/' + key
-        self._s3_client.upload_file(local_file, self._bucket, key)
-        return self._bucket + '/' + key
+        path = self._bucket + '/' + key
+        extra_args = None
+        if checksum:
+            if is_unchanged(self, path, checksum):
+                logger.debug('skip unchanged object', path=path)
+                return path
+            extra_args = {'Metadata': {'md5': checksum}}
+        self._s3_client.upload_file(local_file, self._bucket, key, ExtraArgs=extra_args,
+                                    Config=self.transfer_config)
+        return path
+
+    def open_multipart_writer(self, key):
+        """
+        writer streaming into a multipart upload of key, commit returns the saved path
+        """
+        key = self._prefix + '/' + key
+        client, bucket = self._s3_client, self._bucket
+
+        def create():
+            return client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+
+        def upload_part(upload_id, part_number, data):
+            return client.upload_part(Bucket=bucket, Key=key, UploadId=upload_id,
+                                      PartNumber=part_number, Body=data)['ETag']
+
+        def complete(upload_id, parts):
+            client.complete_multipart_upload(
+                Bucket=bucket, Key=key, UploadId=upload_id,
+                MultipartUpload={'Parts': [{'PartNumber': n, 'ETag': etag} for n, etag in parts]})
+            return bucket + '/' + key
+
+        def abort(upload_id):
+            client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+
+        def put(data):
+            client.put_object(Bucket=bucket, Key=key, Body=data)
+            return bucket + '/' + key
+
+        return MultipartWriter(create, upload_part, complete, abort, put, self._multipart_chunksize)
 
     def save_data(self, key, lines):
         key = self._prefix + '/' + key
         data = BytesIO(gzip.compress('\n'.join(lines).encode('utf-8')))
-        self.s3_client.upload_fileobj(data, self._bucket, key)
+        self._s3_client.upload_fileobj(data, self._bucket, key)
         return self._bucket + '/' + key
\ No newline at end of file
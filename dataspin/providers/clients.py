@@ -0,0 +1,107 @@
+"""
+Process wide registry of storage and stream clients.
+
+One client is built per (platform, credentials, region) and shared by every storage and
+stream using them, so threads reuse warm connections from one tuned pool instead of each
+provider opening its own. Pool options come from the provider url params:
+
+    max_pool_connections    connections kept per client, default 50
+    keep_alive              tcp keep-alive, default true
+
+boto3 resources are not thread safe, so they are kept per thread, built from the shared
+session; only clients are shared across threads.
+"""
+import threading
+
+DEFAULT_MAX_POOL_CONNECTIONS = 50
+
+_clients = {}
+_lock = threading.RLock()
+_local = threading.local()
+_generation = 0
+
+
+def _pool_options(kwargs):
+    max_pool_connections = int(kwargs.get('max_pool_connections', DEFAULT_MAX_POOL_CONNECTIONS))
+    keep_alive = str(kwargs.get('keep_alive', 'true')).lower() not in ['false', '0', 'no']
+    return max_pool_connections, keep_alive
+
+
+def _get_or_create(key, factory):
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = factory()
+            _clients[key] = client
+        return client
+
+
+def _aws_session(access_key, secret_key, region):
+    import boto3
+
+    def create():
+        return boto3.session.Session(aws_access_key_id=access_key,
+                                     aws_secret_access_key=secret_key,
+                                     region_name=region)
+    return _get_or_create(('aws', 'session', access_key, secret_key, region), create)
+
+
+def _aws_config(max_pool_connections, keep_alive):
+    from botocore.config import Config
+    return Config(max_pool_connections=max_pool_connections, tcp_keepalive=keep_alive)
+
+
+def get_aws_client(service, access_key=None, secret_key=None, region=None, **kwargs):
+    max_pool_connections, keep_alive = _pool_options(kwargs)
+
+    def create():
+        session = _aws_session(access_key, secret_key, region)
+        return session.client(service, config=_aws_config(max_pool_connections, keep_alive))
+    return _get_or_create(('aws', 'client', service, access_key, secret_key, region,
+                           max_pool_connections, keep_alive), create)
+
+
+def get_aws_resource(service, access_key=None, secret_key=None, region=None, **kwargs):
+    max_pool_connections, keep_alive = _pool_options(kwargs)
+    if getattr(_local, 'generation', None) != _generation:
+        _local.resources = {}
+        _local.generation = _generation
+    key = (service, access_key, secret_key, region, max_pool_connections, keep_alive)
+    resource = _local.resources.get(key)
+    if resource is None:
+        session = _aws_session(access_key, secret_key, region)
+        with _lock:
+            resource = session.resource(service, config=_aws_config(max_pool_connections, keep_alive))
+        _local.resources[key] = resource
+    return resource
+
+
+def get_cos_client(access_key=None, secret_key=None, region=None, **kwargs):
+    max_pool_connections, keep_alive = _pool_options(kwargs)
+
+    def create():
+        from qcloud_cos import CosConfig, CosS3Client
+        config = CosConfig(Region=region, SecretId=access_key, SecretKey=secret_key, Token=None,
+                           Scheme='https', KeepAlive=keep_alive,
+                           PoolConnections=max_pool_connections, PoolMaxSize=max_pool_connections)
+        return CosS3Client(config)
+    return _get_or_create(('cos', 'client', access_key, secret_key, region,
+                           max_pool_connections, keep_alive), create)
+
+
+def get_pulsar_client(host=None, token=None, **kwargs):
+    def create():
+        import pulsar
+        return pulsar.Client(service_url='http://' + host,
+                             authentication=pulsar.AuthenticationToken(token))
+    return _get_or_create(('tdmq', 'client', host, token), create)
+
+
+def clear_clients():
+    """
+    Drop all shared clients, e.g. in a forked child that must not reuse the parent's sockets.
+    """
+    global _generation
+    with _lock:
+        _clients.clear()
+        _generation += 1
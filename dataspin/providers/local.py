@@ -1,9 +1,13 @@
+from collections import Counter
+import errno
+import fcntl
 import os
 import shutil
+import threading
 from basepy.log import logger
 from boltons.fileutils import atomic_save
 
-from dataspin.utils.common import scantree
+from dataspin.utils.common import scantree, get_file_md5
 
 
 class LocalStreamProvider:
@@ -19,7 +23,7 @@ class LocalStreamProvider:
         self.path = path
         if (not os.path.exists(self.path)) or (not os.path.isdir(self.path)):
             logger.warning('read non-exists file path')
-        watch = 'watch' in options
+        watch = bool(options) and 'watch' in options
         self.polling_flag = watch
 
     def _scan(self):
@@ -54,11 +58,27 @@ class LocalStreamProvider:
             self.processing_file_list.remove(file_path)
             self.processed_file_list.append(file_path)
 
+FICLONE = 0x40049409
+COPY_FALLBACK_ERRORS = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP, errno.ENOTTY,
+                        errno.EINVAL, errno.ENOSYS)
+
+
 class LocalStorageProvider:
+    """
+    Saves avoid copying data where the filesystem allows: a rename when the caller allows
+    moving the file, a hardlink when it allows linking, else a reflink, and a buffered copy
+    only across filesystems. The method used is counted in save_methods.
+
+    A hardlinked output shares its inode with the local file, so callers only allow it for
+    working files of a run: dataspin only ever replaces or removes those, never writes into
+    them, and removing the working file leaves the output in place.
+    """
 
     def __init__(self, path, options):
         self._path = path
         self.options = options
+        self.save_methods = Counter()
+        self._lock = threading.Lock()
 
     @property
     def path(self):
@@ -68,10 +88,59 @@ class LocalStorageProvider:
     def storage_type(self):
         return 'local'
         
-    def save(self, key, local_file):
+    def save(self, key, local_file, checksum=None, move=False, link=False):
+        """
+        with move, local_file may be renamed into place and is gone afterwards.
+        with link, local_file may be hardlinked into place, see the class docstring.
+        """
         save_path = os.path.join(self._path, key)
+        if checksum and get_file_md5(save_path) == checksum:
+            logger.debug('skip unchanged file', path=save_path)
+            return save_path
         os.makedirs(os.path.dirname(save_path), exist_ok=True)
-        shutil.copy(local_file, save_path)
+        temp_path = f'{save_path}.tmp-{os.getpid()}-{threading.get_ident()}'
+        try:
+            method = self._place(local_file, temp_path, move, link)
+            os.replace(temp_path, save_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        with self._lock:
+            self.save_methods[method] += 1
+        logger.debug('local save', path=save_path, method=method)
+        return save_path
+
+    @staticmethod
+    def _place(local_file, dst_path, move, link):
+        if move:
+            try:
+                os.rename(local_file, dst_path)
+                return 'rename'
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+        if link:
+            try:
+                os.link(local_file, dst_path)
+                return 'hardlink'
+            except OSError as e:
+                if e.errno not in COPY_FALLBACK_ERRORS:
+                    raise
+        try:
+            with open(local_file, 'rb') as src, open(dst_path, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            shutil.copystat(local_file, dst_path)
+            return 'reflink'
+        except OSError as e:
+            if e.errno not in COPY_FALLBACK_ERRORS:
+                raise
+        shutil.copy(local_file, dst_path)
+        return 'copy'
+
+    def stats(self):
+        with self._lock:
+            return dict(self.save_methods)
 
     def fetch_file(self,file_path):
         yield file_path
@@ -1,36 +1,105 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import gzip
 from io import BytesIO
 import json
-import tempfile
+import threading
+import time
 import traceback
-import pulsar
-from _pulsar import ConsumerType
-from qcloud_cos import CosConfig
-from qcloud_cos import CosS3Client
 from basepy.log import logger
+from dataspin.providers.clients import get_cos_client, get_pulsar_client
+from dataspin.utils.common import convert_size_to_bytes, is_unchanged
+from dataspin.utils.multipart import MultipartWriter
+from dataspin.utils.ranged import open_ranged, DEFAULT_PART_SIZE, DEFAULT_CONCURRENCY
 
 
 class TDMQStreamProvider:
+    """
+    Receives messages in batches of up to batch_size, waiting at most batch_timeout ms
+    for a batch to fill. Finished messages are acknowledged off the processing thread,
+    every batch_size messages or when the buffer runs dry: one by one with ack_mode batch,
+    or with a single cumulative ack with ack_mode cumulative (failover subscription).
+    Trigger messages are sent asynchronously through a batching producer, flush_sends
+    waits for them and raises if any failed.
 
-    def __init__(self, host=None, token=None, topic=None, subscription_name=None,**kwargs):
-        self._client = pulsar.Client(
-            service_url='http://'+host, authentication=pulsar.AuthenticationToken(token))
-        self._consumer = self._client.subscribe(topic=topic,
-                                                subscription_name=subscription_name,
-                                                consumer_type=ConsumerType.Shared)
-        self._producer = self._client.create_producer(topic=topic)
-        self._pendding_message = []
+    close ends a run: it waits for the acks and sends, and raises if any failed. The next
+    run starts with get; acks flushed before that are done inline, no thread is left.
+
+    client can be given to run against another broker, e.g. an in-process fake in tests.
+    """
+
+    def __init__(self, host=None, token=None, topic=None, subscription_name=None, client=None, **kwargs):
+        self._client_args = (host, token)
+        self._client = client
+        self._topic = topic
+        self._subscription_name = subscription_name
+        self._batch_size = int(kwargs.get('batch_size', 100))
+        self._batch_timeout = int(kwargs.get('batch_timeout', 100))
+        self._ack_mode = kwargs.get('ack_mode', 'batch')
+        self._send_delay = int(kwargs.get('send_delay', 10))
+        self._consumer = None
+        self._producer = None
+        self._buffered_message = deque()
+        self._pendding_message = deque()
+        self._done_message = []
+        self._ack_executor = None
+        self._closed = False
+        self._send_failures = 0
+        self._ack_failures = 0
+        self._send_lock = threading.Lock()
+
+    @property
+    def client(self):
+        # created on first use, loading a project must not import pulsar or connect
+        if self._client is None:
+            self._client = get_pulsar_client(*self._client_args)
+        return self._client
+
+    @property
+    def consumer(self):
+        if self._consumer is None:
+            import pulsar
+            consumer_type = (pulsar.ConsumerType.Failover if self._ack_mode == 'cumulative'
+                             else pulsar.ConsumerType.Shared)
+            self._consumer = self.client.subscribe(topic=self._topic,
+                                                   subscription_name=self._subscription_name,
+                                                   consumer_type=consumer_type,
+                                                   batch_receive_policy=pulsar.ConsumerBatchReceivePolicy(
+                                                       self._batch_size, -1, self._batch_timeout))
+        return self._consumer
+
+    @property
+    def producer(self):
+        if self._producer is None:
+            self._producer = self.client.create_producer(topic=self._topic,
+                                                          batching_enabled=True,
+                                                          batching_max_publish_delay_ms=self._send_delay)
+        return self._producer
+
+    def _receive(self, block, timeout):
+        deadline = time.time() + timeout / 1000 if timeout is not None else None
+        while True:
+            message_list = self.consumer.batch_receive()
+            if message_list or not block:
+                break
+            if deadline is not None and time.time() >= deadline:
+                break
+        self._buffered_message.extend(message_list)
 
     def get(self, block=True, timeout=None):
-        message = self._consumer.receive(timeout_millis=timeout)
-        if message:
-            self._pendding_message.append(message)
-            body = json.loads(message.data())
-            if body.get('data_format') == 'dataspin':
-                return body
-            else:
-                return self._transform_raw_cos(body)
-        return None
+        self._closed = False
+        if not self._buffered_message:
+            self.flush()
+            self._receive(block, timeout)
+        if not self._buffered_message:
+            return None
+        message = self._buffered_message.popleft()
+        self._pendding_message.append(message)
+        body = json.loads(message.data())
+        if body.get('data_format') == 'dataspin':
+            return body
+        else:
+            return self._transform_raw_cos(body)
 
     def _transform_raw_cos(self, body):
         try:
@@ -43,20 +112,74 @@ class TDMQStreamProvider:
 
     def send_message(self, message: dict):
         logger.debug('send tdmq message body', body=message)
-        self._producer.send(content=json.dumps(message).encode('utf-8'))
+        self.producer.send_async(json.dumps(message).encode('utf-8'), self._on_sent)
+
+    def _on_sent(self, result, message_id):
+        import pulsar
+        if result != pulsar.Result.Ok:
+            with self._send_lock:
+                self._send_failures += 1
+            logger.error('send tdmq message failed', result=str(result))
 
     def task_done(self, file_path):
-        message = self._pendding_message.pop()
-        self._consumer.acknowledge(message)
+        message = self._pendding_message.popleft()
+        self._done_message.append(message)
+        if len(self._done_message) >= self._batch_size:
+            self.flush()
+
+    def _acknowledge(self, messages):
+        try:
+            if self._ack_mode == 'cumulative':
+                self.consumer.acknowledge_cumulative(messages[-1])
+            else:
+                for message in messages:
+                    self.consumer.acknowledge(message)
+        except Exception as e:
+            with self._send_lock:
+                self._ack_failures += len(messages)
+            logger.error('acknowledge tdmq messages failed', error=repr(e))
+
+    def flush(self):
+        done_message, self._done_message = self._done_message, []
+        if not done_message:
+            return
+        if self._closed:
+            self._acknowledge(done_message)
+            return
+        if self._ack_executor is None:
+            self._ack_executor = ThreadPoolExecutor(max_workers=1)
+        self._ack_executor.submit(self._acknowledge, done_message)
+
+    def close(self):
+        self.flush()
+        self._closed = True
+        if self._ack_executor is not None:
+            self._ack_executor.shutdown(wait=True)
+            self._ack_executor = None
+        with self._send_lock:
+            ack_failures, self._ack_failures = self._ack_failures, 0
+        self.flush_sends()
+        if ack_failures:
+            raise Exception(f'{ack_failures} tdmq messages failed to acknowledge')
+
+    def flush_sends(self):
+        if self._producer is not None:
+            self._producer.flush()
+        with self._send_lock:
+            send_failures, self._send_failures = self._send_failures, 0
+        if send_failures:
+            raise Exception(f'{send_failures} tdmq messages failed to send')
 
 
 class COSStorageProvider:
     def __init__(self, path=None, access_key=None, secret_key=None, region=None, **kwargs):
-        config = CosConfig(Region=region, SecretId=access_key,
-                           SecretKey=secret_key, Token=None, Scheme='https')
-        self._client = CosS3Client(config)
+        self._client = get_cos_client(access_key, secret_key, region, **kwargs)
         self._path = path
         self._bucket, self._prefix = path.split('/', 1)
+        self._fetch_mode = kwargs.get('fetch_mode', 'stream')
+        self._part_size = convert_size_to_bytes(kwargs.get('part_size', DEFAULT_PART_SIZE))
+        self._fetch_concurrency = int(kwargs.get('fetch_concurrency', DEFAULT_CONCURRENCY))
+        self._multipart_chunksize = convert_size_to_bytes(kwargs.get('multipart_chunksize', '16MB'))
 
     @property
     def path(self):
@@ -81,19 +204,89 @@ class COSStorageProvider:
             marker = response['NextMarker']
 
     def fetch_file(self, file_path):
+        if self._fetch_mode == 'ranged':
+            yield from self.fetch_file_ranged(file_path)
+            return
+        bucket, key = file_path.split('/', 1)
+        response = self._client.get_object(
+            Bucket=bucket,
+            Key=key)
+        fp = response['Body'].get_raw_stream()
+        try:
+            yield fp
+        finally:
+            fp.close()
+
+    def head(self, file_path):
+        bucket, key = file_path.split('/', 1)
+        head = self._client.head_object(Bucket=bucket, Key=key)
+        return {'etag': head['ETag'], 'size': int(head['Content-Length']),
+                'md5': head.get('x-cos-meta-md5')}
+
+    def fetch_file_ranged(self, file_path):
+        """
+        Stream the object with parallel ranged GETs, pinned to the ETag seen at start.
+        """
         bucket, key = file_path.split('/', 1)
-        with tempfile.TemporaryFile('w+b') as fp:
-            response = self._client.get_object(
-                Bucket=bucket,
-                Key=key)
-            fp = response['Body'].get_raw_stream()
+        head = self._client.head_object(Bucket=bucket, Key=key)
+        etag = head['ETag']
+
+        def fetch_range(start, end):
+            response = self._client.get_object(Bucket=bucket, Key=key, IfMatch=etag,
+                                               Range=f'bytes={start}-{end}')
+            return response['Body'].get_raw_stream().read()
+
+        fp = open_ranged(fetch_range, int(head['Content-Length']), self._part_size, self._fetch_concurrency)
+        try:
             yield fp
+        finally:
+            fp.close()
 
-    def save(self, key, local_file):
+    def save(self, key, local_file, checksum=None):
+        """
+        with the md5 checksum of local_file, the upload is skipped when the object
+        already has that content, and the checksum is stored in the object metadata
+        """
         key = self._prefix + '/' + key
-        self._client.upload_file(Bucket=self._bucket, LocalFilePath=local_file,
-                                 Key=key)
-        return self._bucket + '/' + key
+        path = self._bucket + '/' + key
+        kwargs = {}
+        if checksum:
+            if is_unchanged(self, path, checksum):
+                logger.debug('skip unchanged object', path=path)
+                return path
+            kwargs['Metadata'] = {'x-cos-meta-md5': checksum}
+        self._client.upload_file(Bucket=self._bucket, LocalFilePath=local_file, Key=key,
+                                 PartSize=self._multipart_chunksize // (1024 * 1024) or 1, **kwargs)
+        return path
+
+    def open_multipart_writer(self, key):
+        """
+        writer streaming into a multipart upload of key, commit returns the saved path
+        """
+        key = self._prefix + '/' + key
+        client, bucket = self._client, self._bucket
+
+        def create():
+            return client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+
+        def upload_part(upload_id, part_number, data):
+            return client.upload_part(Bucket=bucket, Key=key, Body=data, PartNumber=part_number,
+                                      UploadId=upload_id)['ETag']
+
+        def complete(upload_id, parts):
+            client.complete_multipart_upload(
+                Bucket=bucket, Key=key, UploadId=upload_id,
+                MultipartUpload={'Part': [{'PartNumber': n, 'ETag': etag} for n, etag in parts]})
+            return bucket + '/' + key
+
+        def abort(upload_id):
+            client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+
+        def put(data):
+            client.put_object(Bucket=bucket, Key=key, Body=data)
+            return bucket + '/' + key
+
+        return MultipartWriter(create, upload_part, complete, abort, put, self._multipart_chunksize)
 
     def save_data(self, key, lines):
         key = self._prefix + '/' + key
@@ -1,57 +1,440 @@
-from threading import BoundedSemaphore, Event
+from collections import Counter, deque
+from threading import BoundedSemaphore, Event, Lock
+import logging
+from logging.handlers import RotatingFileHandler
+import multiprocessing
+import selectors
 import subprocess
 import os
 import sys
 import time
-import tempfile
-from .utils.tail import FileTail
+import traceback
+from basepy.log import logger
+from .utils.common import uuid_generator, convert_size_to_bytes
+
+
+def _pidfd_supported():
+    if not hasattr(os, 'pidfd_open'):
+        return False
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+        return True
+    except OSError:
+        return False
+
 
 class JobRunner:
-    pass
+    """
+    Jobs are queued by run and recover and started by manage_loop as slots free up, at most
+    process_count at once. manage_loop sleeps in a selector until a running job exits or a
+    new job is queued, so a finished job frees its slot and the next queued job starts at
+    once, and an idle runner uses no cpu.
 
+    Overlapping runs of one process follow its overlap policy:
+        allow   up to max_concurrent runs queued or running, unlimited by default
+        queue   one run at a time, at most one more waiting
+        skip    no new run while one is queued or running
+    A run beyond the policy is dropped. The time each job waited in the queue is kept in
+    queue_lags and logged when over queue_lag_warning seconds.
+
+    Subclasses start a job in _start, watching the file objects that become readable when
+    it ends, and handle them in _on_event, calling _finish once the job is done.
+    """
+    overlap_policies = ['allow', 'queue', 'skip']
+    queue_lag_warning = 1.0
 
-class ProcessJobRunner(JobRunner):
     def __init__(self, **kwargs):
-        super(ProcessJobRunner, self).__init__()
         self.max_process_count = kwargs.get('process_count') or os.cpu_count()*2
         self.semaphore = BoundedSemaphore(self.max_process_count)
         self.close_event = Event()
-        self.runners = []
+        self.pending = deque()
+        self.running = 0
+        self.log_dirs = {}
+        self.queue_lags = {}
+        self._pending_by_process = Counter()
+        self._running_by_process = Counter()
+        self._running_limits = {}
+        self._lock = Lock()
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
 
-    def run(self, project_path, dataprocess_name):
-        cmd_args = [sys.executable, '-m', 'dataspin', 'run-process', project_path, dataprocess_name]
-        self.semaphore.acquire()
-        fd, logfile = tempfile.mkstemp()
-        # logfile_obj = open(logfile, 'ab')
-        p = subprocess.Popen(cmd_args, stdout=fd, stderr=fd)
-        self.runners.append((p, FileTail(logfile)))
+    def run(self, project_path, dataprocess_name, overlap_policy='allow', max_concurrent=None):
+        return self.submit(('run', project_path, dataprocess_name, None), overlap_policy, max_concurrent)
 
     def recover(self, project_path, dataprocess_name, recover_path):
-        cmd_args = [sys.executable, '-m', 'dataspin', 'recover-process', project_path, dataprocess_name, recover_path]
-        self.semaphore.acquire()
-        fd, logfile = tempfile.mkstemp()
-        # logfile_obj = open(logfile, 'ab')
-        p = subprocess.Popen(cmd_args, stdout=fd, stderr=fd)
-        self.runners.append((p, FileTail(logfile)))
+        return self.submit(('recover', project_path, dataprocess_name, recover_path))
+
+    def submit(self, job, overlap_policy='allow', max_concurrent=None):
+        """
+        queue the job, return False when its overlap policy drops it
+        """
+        if overlap_policy not in self.overlap_policies:
+            raise Exception(f'unknown overlap policy {overlap_policy}')
+        key = job[1:3]
+        with self._lock:
+            pending, running = self._pending_by_process[key], self._running_by_process[key]
+            if overlap_policy == 'skip':
+                dropped = pending + running > 0
+            elif overlap_policy == 'queue':
+                dropped = pending > 0
+                self._running_limits[key] = 1
+            else:
+                dropped = max_concurrent is not None and pending + running >= int(max_concurrent)
+            if dropped:
+                logger.info('drop overlapping job', job=job, overlap_policy=overlap_policy,
+                            pending=pending, running=running)
+                return False
+            self.pending.append((job, time.monotonic()))
+            self._pending_by_process[key] += 1
+        self._wakeup()
+        return True
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_w, b'\0')
+        except BlockingIOError:
+            pass
+
+    def _next_job(self):
+        for index, (job, queued_at) in enumerate(self.pending):
+            key = job[1:3]
+            limit = self._running_limits.get(key)
+            if limit is None or self._running_by_process[key] < limit:
+                del self.pending[index]
+                return job, queued_at
+        return None, None
+
+    def _dispatch(self):
+        while True:
+            with self._lock:
+                if not self.pending or not self.semaphore.acquire(blocking=False):
+                    return
+                job, queued_at = self._next_job()
+                if job is None:
+                    self.semaphore.release()
+                    return
+                key = job[1:3]
+                self._pending_by_process[key] -= 1
+                self._running_by_process[key] += 1
+                self.running += 1
+            lag = time.monotonic() - queued_at
+            self.queue_lags[key] = lag
+            if lag > self.queue_lag_warning:
+                logger.warning('job waited in queue', job=job, queue_lag=lag)
+            try:
+                self._start(job)
+            except Exception as e:
+                logger.error('start job failed', job=job, error=repr(e))
+                self._finish(job)
+
+    def _finish(self, job):
+        with self._lock:
+            self.running -= 1
+            self._running_by_process[job[1:3]] -= 1
+        self.semaphore.release()
+
+    def _watch(self, fileobj, data):
+        self._selector.register(fileobj, selectors.EVENT_READ, data)
+
+    def _unwatch(self, fileobj):
+        try:
+            self._selector.unregister(fileobj)
+        except (KeyError, ValueError):
+            pass
+
+    def _start(self, job):
+        raise NotImplementedError
+
+    def _on_event(self, fileobj, data):
+        raise NotImplementedError
 
     def manage_loop(self, empty_exit=False):
         while not self.close_event.is_set():
-            for p in self.runners:
-                p[0].poll()
-            running_runners = list(filter(lambda x:x[0].returncode == None, self.runners))
-            num = len(self.runners) - len(running_runners)
-            if num > 0:
-                for i in range(num):
-                    self.semaphore.release()
-            terminated_runner = set(self.runners) - set(running_runners)
-            for runner, logfile in terminated_runner:
-                sys.stdout.write(''.join(logfile.tail()))
-            self.runners = running_runners
-            if empty_exit and len(self.runners) == 0:
+            self._dispatch()
+            with self._lock:
+                if empty_exit and not self.pending and self.running == 0:
+                    break
+            for key, _ in self._selector.select():
+                if key.data is None:
+                    try:
+                        while os.read(self._wakeup_r, 4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    self._on_event(key.fileobj, key.data)
+
+    def close(self):
+        self.close_event.set()
+        self._wakeup()
+
+
+class _ChildProcess:
+    def __init__(self, job, popen, exit_fd, prefix, job_log):
+        self.job = job
+        self.popen = popen
+        self.exit_fd = exit_fd
+        self.prefix = prefix
+        self.job_log = job_log
+        self.buffer = bytearray()
+        self.output_open = True
+
+
+class ProcessJobRunner(JobRunner):
+    """
+    Runs every job as a fresh `python -m dataspin` child. Exits are watched through a pidfd,
+    or where the kernel has none, a pipe the child holds open until it exits.
+
+    Child output is read from a pipe as it arrives and written to stdout line by line,
+    prefixed with project/process/run id. A line longer than max_line_bytes is split, so
+    a job never buffers more than that. With log_max_size, output is also written to
+    <log dir>/<process>.log rotated at that size, log_backups files kept; the log dir of a
+    project is set in log_dirs.
+    """
+    max_line_bytes = 64 * 1024
+    log_backups = 5
+
+    def __init__(self, **kwargs):
+        super(ProcessJobRunner, self).__init__(**kwargs)
+        self.use_pidfd = _pidfd_supported()
+        self.log_max_size = convert_size_to_bytes(kwargs['log_max_size']) if kwargs.get('log_max_size') else None
+        self.runners = []
+        self._job_logs = {}
+
+    def command(self, job, run_id):
+        action, project_path, dataprocess_name, recover_path = job
+        if action == 'recover':
+            return [sys.executable, '-m', 'dataspin', 'recover-process', project_path, dataprocess_name, recover_path]
+        return [sys.executable, '-m', 'dataspin', 'run-process', project_path, dataprocess_name, '--run-id', run_id]
+
+    def _job_log(self, project_path, dataprocess_name):
+        if not self.log_max_size or project_path not in self.log_dirs:
+            return None
+        log_path = os.path.join(self.log_dirs[project_path], f'{dataprocess_name}.log')
+        if log_path not in self._job_logs:
+            os.makedirs(self.log_dirs[project_path], exist_ok=True)
+            job_log = logging.getLogger(f'dataspin.jobs.{log_path}')
+            job_log.propagate = False
+            job_log.setLevel(logging.INFO)
+            handler = RotatingFileHandler(log_path, maxBytes=self.log_max_size, backupCount=self.log_backups)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            job_log.addHandler(handler)
+            self._job_logs[log_path] = job_log
+        return self._job_logs[log_path]
+
+    def _start(self, job):
+        action, project_path, dataprocess_name, recover_path = job
+        run_id = os.path.basename(os.path.normpath(recover_path)) if action == 'recover' else uuid_generator('PR')
+        cmd_args = self.command(job, run_id)
+        if self.use_pidfd:
+            p = subprocess.Popen(cmd_args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            exit_fd = os.pidfd_open(p.pid)
+        else:
+            exit_fd, child_fd = os.pipe()
+            try:
+                p = subprocess.Popen(cmd_args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                     pass_fds=(child_fd,))
+            finally:
+                os.close(child_fd)
+        os.set_blocking(p.stdout.fileno(), False)
+        project_name = os.path.splitext(os.path.basename(project_path))[0]
+        child = _ChildProcess(job, p, exit_fd, f'{project_name}/{dataprocess_name}/{run_id}',
+                              self._job_log(project_path, dataprocess_name))
+        self.runners.append(child)
+        self._watch(p.stdout, child)
+        self._watch(exit_fd, child)
+
+    def _emit(self, child, line):
+        text = '[{}] {}'.format(child.prefix, bytes(line).decode('utf-8', 'replace').rstrip('\r'))
+        sys.stdout.write(text + '\n')
+        if child.job_log:
+            child.job_log.info(text)
+
+    def _read_output(self, child):
+        if not child.output_open:
+            return
+        while True:
+            try:
+                data = os.read(child.popen.stdout.fileno(), 65536)
+            except BlockingIOError:
+                break
+            if not data:
+                child.output_open = False
+                self._unwatch(child.popen.stdout)
                 break
-            time.sleep(1)
+            child.buffer.extend(data)
+            lines = child.buffer.split(b'\n')
+            child.buffer = lines.pop()
+            for line in lines:
+                for start in range(0, max(len(line), 1), self.max_line_bytes):
+                    self._emit(child, line[start:start + self.max_line_bytes])
+            while len(child.buffer) > self.max_line_bytes:
+                self._emit(child, child.buffer[:self.max_line_bytes])
+                del child.buffer[:self.max_line_bytes]
+        sys.stdout.flush()
+
+    def _on_event(self, fileobj, child):
+        if fileobj is child.popen.stdout:
+            self._read_output(child)
+            return
+        child.popen.wait()
+        self._unwatch(child.exit_fd)
+        os.close(child.exit_fd)
+        self._read_output(child)
+        if child.buffer:
+            self._emit(child, child.buffer)
+            sys.stdout.flush()
+        self._unwatch(child.popen.stdout)
+        child.popen.stdout.close()
+        self.runners.remove(child)
+        self._finish(child.job)
+
+    def close(self):
+        for child in self.runners:
+            child.popen.terminate()
+        super(ProcessJobRunner, self).close()
+
+
+def _load_engine(engines, project_path):
+    """
+    cached engine of the project, reloaded when the project file changed
+    """
+    from dataspin.core import SpinEngine
+    from dataspin.project import ProjectConfig
+    mtime = os.stat(project_path).st_mtime
+    cached = engines.get(project_path)
+    if cached is None or cached[0] != mtime:
+        if cached is not None:
+            cached[1].close()
+        engines[project_path] = (mtime, SpinEngine(ProjectConfig.load(project_path)))
+    return engines[project_path][1]
+
+
+def _worker_main(conn):
+    from dataspin.providers.clients import clear_clients
+    # the forkserver preloaded the sdks, clients must be built in this process
+    clear_clients()
+    engines = {}
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, OSError):
+            break
+        if job is None:
+            break
+        action, project_path, name, recover_path = job
+        try:
+            process = _load_engine(engines, project_path).data_processes[name]
+            if action == 'recover':
+                process.recover(recover_path)
+            else:
+                process.run()
+            conn.send(('done', None))
+        except Exception as e:
+            traceback.print_exc()
+            conn.send(('error', repr(e)))
+        sys.stdout.flush()
+        sys.stderr.flush()
+    for _, engine in engines.values():
+        engine.close()
+
+
+class _Worker:
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.job = None
+
+
+class WorkerPoolJobRunner(JobRunner):
+    """
+    Runs jobs on long-lived worker processes forked from a forkserver that has already
+    imported dataspin and the provider sdks. Each worker keeps the SpinEngine of every
+    project it ran, with its clients and caches, and receives jobs over a pipe. A worker
+    that dies is replaced by a fresh one, its job is reported as failed.
+
+    Workers write straight to the stdout of the runner, without job prefixes, so
+    log_max_size is not supported here.
+    """
+    preload_modules = ['dataspin.main', 'dataspin.core', 'boto3', 'pulsar', 'qcloud_cos', 'sqlalchemy']
+
+    def __init__(self, **kwargs):
+        if kwargs.get('log_max_size'):
+            raise Exception('log_max_size is only supported by the process runner')
+        super(WorkerPoolJobRunner, self).__init__(**kwargs)
+        self._mp = multiprocessing.get_context('forkserver')
+        self._mp.set_forkserver_preload(self.preload_modules)
+        self._idle = []
+        self._busy = []
+
+    def _spawn(self):
+        parent_conn, child_conn = self._mp.Pipe()
+        process = self._mp.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        process.start()
+        child_conn.close()
+        return _Worker(process, parent_conn)
+
+    def _start(self, job):
+        worker = self._idle.pop() if self._idle else self._spawn()
+        try:
+            worker.conn.send(job)
+        except (BrokenPipeError, EOFError, OSError):
+            self._discard(worker)
+            worker = self._spawn()
+            worker.conn.send(job)
+        worker.job = job
+        self._busy.append(worker)
+        self._watch(worker.conn, worker)
+        self._watch(worker.process.sentinel, worker)
+
+    def _discard(self, worker):
+        worker.conn.close()
+        worker.process.join()
+
+    def _collect(self, worker):
+        """
+        result of a finished job, or None while the job runs
+        """
+        try:
+            if worker.conn.poll():
+                return worker.conn.recv()
+        except (EOFError, OSError):
+            return ('crashed', worker.process.exitcode)
+        if not worker.process.is_alive():
+            return ('crashed', worker.process.exitcode)
+        return None
+
+    def _on_event(self, fileobj, worker):
+        if worker.job is None:
+            return
+        result = self._collect(worker)
+        if result is None:
+            return
+        status, detail = result
+        if status != 'done':
+            logger.error('job failed', job=worker.job, status=status, detail=detail)
+        self._unwatch(worker.conn)
+        self._unwatch(worker.process.sentinel)
+        self._busy.remove(worker)
+        job, worker.job = worker.job, None
+        if status == 'crashed':
+            self._discard(worker)
+        else:
+            self._idle.append(worker)
+        self._finish(job)
 
     def close(self):
-        for p, _ in self.runners:
-            p.terminate()
-        self.close_event.set()
\ No newline at end of file
+        super(WorkerPoolJobRunner, self).close()
+        for worker in self._idle:
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+        for worker in self._busy:
+            worker.process.terminate()
+        for worker in self._idle + self._busy:
+            worker.process.join(timeout=5)
+        self._idle, self._busy = [], []
@@ -1,4 +1,5 @@
 import hashlib
+import importlib
 import os
 import random
 from urllib.parse import parse_qsl, urlparse
@@ -190,6 +191,33 @@ def convert_time_window_to_seconds(time_window: str):
         return time_unit.get(time_unit_key) * int(time_unit_value)
     return None
 
+
+def convert_size_to_bytes(size) -> int:
+    """
+    size unit: GB, MB, KB or B, a plain number is bytes
+    """
+    if isinstance(size, int):
+        return size
+    size = str(size).strip().upper()
+    size_unit = {'GB': 1024**3, 'MB': 1024**2, 'KB': 1024, 'B': 1}
+    for unit, multiple in size_unit.items():
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)]) * multiple)
+    return int(size)
+
+
+def parse_timestamp(value) -> int:
+    """
+    epoch seconds from epoch seconds, epoch milliseconds or a datetime string
+    """
+    if isinstance(value, str) and value.isdigit():
+        value = int(value)
+    if isinstance(value, (int, float)):
+        if value > 100000000000:
+            value = value / 1000
+        return int(value)
+    return pendulum.parse(value).int_timestamp
+
     
 def get_file_md5(file_path, cal_size=8192):
     if not os.path.exists(file_path):
@@ -202,3 +230,39 @@ def get_file_md5(file_path, cal_size=8192):
             chunk = f.read(cal_size)
     return file_md5.hexdigest()
 
+
+
+def is_unchanged(provider, path, checksum):
+    """
+    whether the remote object at path already has the md5 checksum, by its md5
+    metadata or, for single part uploads, its ETag
+    """
+    try:
+        head = provider.head(path)
+    except Exception:
+        return False
+    return checksum in [head.get('md5'), head['etag'].strip('"')]
+
+
+_loaded_classes = {}
+
+
+def load_class(name, class_map, group):
+    """
+    class registered under name, from class_map ('module:Class' strings, imported on
+    first use) or else from the entry points of group; None when nothing is registered
+    """
+    key = (group, name)
+    if key not in _loaded_classes:
+        spec = class_map.get(name)
+        if spec is None:
+            from importlib.metadata import entry_points
+            matches = [ep for ep in entry_points(group=group) if ep.name == name]
+            if not matches:
+                return None
+            cls = matches[0].load()
+        else:
+            module_name, class_name = spec.split(':')
+            cls = getattr(importlib.import_module(module_name), class_name)
+        _loaded_classes[key] = cls
+    return _loaded_classes[key]
@@ -1,5 +1,6 @@
 
 import os
+import io
 import json
 import gzip
 
@@ -18,7 +19,11 @@ class DataFileReader:
                     for line in gdata:
                         yield (json.loads(line), line.strip())
             else:
-                for line in self._file.readlines():
+                # iterate instead of readlines(), so a streamed file is parsed while it downloads
+                lines = self._file
+                if not isinstance(self._file, io.TextIOBase):
+                    lines = io.TextIOWrapper(self._file, encoding='utf-8')
+                for line in lines:
                     yield (json.loads(line), line.strip())
         elif self._file_path:
             if self._ext.endswith('.gz'):
@@ -27,5 +32,5 @@ class DataFileReader:
                         yield (json.loads(line), line.strip())
             else:
                 with open(self._file_path, 'rt') as f:
-                    for line in f.readlines():
+                    for line in f:
                         yield (json.loads(line), line.strip())
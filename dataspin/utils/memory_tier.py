@@ -0,0 +1,73 @@
+import os
+import shutil
+import threading
+
+from basepy.log import logger
+
+
+class MemoryTier:
+    """
+    Keeps intermediate files of runs under a ram backed dir, e.g. a tmpfs like /dev/shm,
+    up to budget bytes per job process. A file that would take the tier over budget is
+    spilled to the run dir on disk, as are files a durable checkpoint refers to and final
+    outputs no save has persisted.
+
+    Files are only counted once written, so the tier can go over budget by the size of
+    the files being written at the same time.
+    """
+
+    def __init__(self, path, budget, durable=False):
+        self.path = os.path.abspath(path)
+        self.budget = budget
+        self.durable = durable
+        self.used = 0
+        self.spilled = 0
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def run_dir(self, run_id):
+        run_dir = os.path.join(self.path, run_id)
+        os.makedirs(run_dir, exist_ok=True)
+        return run_dir
+
+    def has_room(self):
+        with self._lock:
+            return self.used < self.budget
+
+    def contains(self, file_path):
+        return os.path.abspath(file_path).startswith(os.path.join(self.path, ''))
+
+    def add(self, file_path):
+        """
+        count a file written into the tier, False if it does not fit and must be spilled
+        """
+        size = os.path.getsize(file_path)
+        with self._lock:
+            if self.used + size > self.budget:
+                return False
+            self._sizes[file_path] = size
+            self.used += size
+        return True
+
+    def remove(self, file_path):
+        with self._lock:
+            self.used -= self._sizes.pop(file_path, 0)
+
+    def spill(self, file_path, dst_dir):
+        """
+        move a file of the tier to dst_dir on disk, returns its new path
+        """
+        dst_path = os.path.join(dst_dir, os.path.basename(file_path))
+        shutil.move(file_path, dst_path)
+        self.remove(file_path)
+        with self._lock:
+            self.spilled += 1
+        logger.debug('spill data file', file_path=file_path, dst_path=dst_path)
+        return dst_path
+
+    def clear(self, run_id):
+        run_dir = os.path.join(self.path, run_id)
+        with self._lock:
+            for file_path in [path for path in self._sizes if path.startswith(os.path.join(run_dir, ''))]:
+                self.used -= self._sizes.pop(file_path)
+        shutil.rmtree(run_dir, ignore_errors=True)
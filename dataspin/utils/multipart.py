@@ -0,0 +1,107 @@
+DEFAULT_MULTIPART_PART_SIZE = 16 * 1024 * 1024
+# every part but the last must be at least 5MB on s3
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class MultipartWriter:
+    """
+    Writable file streaming into an object storage multipart upload.
+
+    Written bytes fill a buffer of part_size, each full buffer is uploaded as one part, so
+    memory holds a single part and nothing touches local disk. The object only becomes
+    visible on commit; abort discards the uploaded parts. Output smaller than one part is
+    sent with a single put instead.
+
+    The storage is reached through callbacks:
+        create() -> upload_id
+        upload_part(upload_id, part_number, data) -> etag
+        complete(upload_id, parts)       parts is a list of (part_number, etag)
+        abort(upload_id)
+        put(data)
+    commit returns the result of complete or put.
+    """
+
+    def __init__(self, create, upload_part, complete, abort, put, part_size=DEFAULT_MULTIPART_PART_SIZE):
+        self._create = create
+        self._upload_part = upload_part
+        self._complete = complete
+        self._abort = abort
+        self._put = put
+        self._part_size = int(part_size)
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+        self.closed = False
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write to closed multipart writer')
+        self._buffer.extend(data)
+        while len(self._buffer) >= self._part_size:
+            part = bytes(self._buffer[:self._part_size])
+            del self._buffer[:self._part_size]
+            self._send_part(part)
+        return len(data)
+
+    def _send_part(self, data):
+        if self._upload_id is None:
+            self._upload_id = self._create()
+        part_number = len(self._parts) + 1
+        self._parts.append((part_number, self._upload_part(self._upload_id, part_number, data)))
+
+    def commit(self):
+        if self.closed:
+            raise ValueError('multipart writer already closed')
+        self.closed = True
+        try:
+            if self._upload_id is None:
+                return self._put(bytes(self._buffer))
+            if self._buffer:
+                self._send_part(bytes(self._buffer))
+            return self._complete(self._upload_id, self._parts)
+        except BaseException:
+            self._abort_upload()
+            raise
+        finally:
+            self._buffer = bytearray()
+
+    def abort(self):
+        if not self.closed:
+            self.closed = True
+            self._buffer = bytearray()
+            self._abort_upload()
+
+    def _abort_upload(self):
+        if self._upload_id is not None:
+            upload_id, self._upload_id = self._upload_id, None
+            self._abort(upload_id)
+
+
+class DirectSaver:
+    """
+    Drop-in for boltons AtomicSaver writing to storage instead of a local temp file:
+    write to part_file, then __exit__ commits the upload and sets dest_path to the
+    saved path, or aborts it when leaving with an exception.
+    """
+
+    def __init__(self, storage, key, on_commit=None):
+        self.storage = storage
+        self.key = key
+        self.dest_path = None
+        self.part_file = None
+        self._on_commit = on_commit
+
+    def setup(self):
+        self.part_file = self.storage.provider.open_multipart_writer(self.key)
+
+    def __enter__(self):
+        self.setup()
+        return self.part_file
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            self.part_file.abort()
+            return
+        self.dest_path = self.part_file.commit()
+        if self._on_commit:
+            self._on_commit(self)
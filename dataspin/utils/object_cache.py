@@ -0,0 +1,124 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+from basepy.log import logger
+
+
+class ObjectCache:
+    """
+    Read-through disk cache for remote objects, keyed by object path and ETag,
+    so a changed object is never served stale.
+
+    Entries are written to a temp file and renamed into place, and evicted least recently
+    used first once the cache grows over max_bytes. Eviction takes an flock on the cache
+    dir, so processes on one node can share the dir. A reader keeps an open entry readable
+    even if another process evicts it meanwhile.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.objects_dir = os.path.join(self.cache_dir, 'objects')
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size_estimate = None
+        self._lock = threading.Lock()
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+    def _entry_path(self, path, etag):
+        digest = hashlib.sha1(f'{path}\0{etag}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def get(self, path, etag):
+        """
+        return the cached object opened for reading, or None
+        """
+        entry_path = self._entry_path(path, etag)
+        try:
+            fp = open(entry_path, 'rb')
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(entry_path)
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return fp
+
+    def put(self, path, etag, fp):
+        """
+        copy the readable fp, binary file object or local path, into the cache and
+        return the cached object opened for reading
+        """
+        entry_path = self._entry_path(path, etag)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(entry_path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as temp:
+                if isinstance(fp, str):
+                    with open(fp, 'rb') as source:
+                        shutil.copyfileobj(source, temp)
+                else:
+                    shutil.copyfileobj(fp, temp)
+            size = os.path.getsize(temp_path)
+            result = open(temp_path, 'rb')
+            os.replace(temp_path, entry_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        with self._lock:
+            if self._size_estimate is not None:
+                self._size_estimate += size
+            need_evict = self._size_estimate is None or self._size_estimate > self.max_bytes
+        if need_evict:
+            self.evict()
+        return result
+
+    def evict(self):
+        with open(os.path.join(self.cache_dir, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                entries = []
+                total = 0
+                for sub_dir in os.scandir(self.objects_dir):
+                    if not sub_dir.is_dir():
+                        continue
+                    for entry in os.scandir(sub_dir.path):
+                        if entry.name.startswith('.tmp-'):
+                            continue
+                        try:
+                            stat = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+                        total += stat.st_size
+                evictions = 0
+                if total > self.max_bytes:
+                    for _, size, entry_path in sorted(entries):
+                        try:
+                            os.unlink(entry_path)
+                        except FileNotFoundError:
+                            pass
+                        total -= size
+                        evictions += 1
+                        if total <= self.max_bytes:
+                            break
+                    logger.debug('object cache evicted', count=evictions, size=total)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        with self._lock:
+            self._size_estimate = total
+            self.evictions += evictions
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
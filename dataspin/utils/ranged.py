@@ -0,0 +1,63 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import io
+
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_CONCURRENCY = 8
+
+
+class RangedReader(io.RawIOBase):
+    """
+    Sequential readable stream over an object downloaded as parallel byte range requests.
+
+    fetch_range(start, end) returns the bytes of the inclusive range. Up to `concurrency`
+    parts of `part_size` bytes are downloading ahead of the reader, so reading starts as
+    soon as the first part arrives and memory stays bounded by the ring of parts.
+    """
+
+    def __init__(self, fetch_range, size, part_size=DEFAULT_PART_SIZE, concurrency=DEFAULT_CONCURRENCY):
+        super(RangedReader, self).__init__()
+        self._fetch_range = fetch_range
+        self._size = size
+        self._part_size = int(part_size)
+        self._concurrency = int(concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=self._concurrency)
+        self._parts = deque()
+        self._next_offset = 0
+        self._buffer = memoryview(b'')
+        self._buffer_pos = 0
+        self._fill()
+
+    def _fill(self):
+        while len(self._parts) < self._concurrency and self._next_offset < self._size:
+            end = min(self._next_offset + self._part_size, self._size) - 1
+            self._parts.append(self._executor.submit(self._fetch_range, self._next_offset, end))
+            self._next_offset = end + 1
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self._buffer_pos >= len(self._buffer):
+            if not self._parts:
+                return 0
+            self._buffer = memoryview(self._parts.popleft().result())
+            self._buffer_pos = 0
+            self._fill()
+        n = min(len(b), len(self._buffer) - self._buffer_pos)
+        b[:n] = self._buffer[self._buffer_pos:self._buffer_pos + n]
+        self._buffer_pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            for part in self._parts:
+                part.cancel()
+            self._parts.clear()
+            self._executor.shutdown(wait=False)
+        super(RangedReader, self).close()
+
+
+def open_ranged(fetch_range, size, part_size=DEFAULT_PART_SIZE, concurrency=DEFAULT_CONCURRENCY):
+    return io.BufferedReader(RangedReader(fetch_range, size, part_size, concurrency),
+                             buffer_size=1024 * 1024)
@@ -0,0 +1,141 @@
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+from basepy.log import logger
+
+
+def dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+class RunRegistry:
+    """
+    Runs of the data processes of one working dir, kept in a sqlite file there. A run is
+    registered as running when it starts and marked finished with the size of its run dir
+    when it ends, so finding runs to recover only looks at the unfinished ones instead of
+    walking every run dir, and retention can prune finished runs by age or total size.
+
+    A working dir used before the registry existed is scanned once and its run dirs are
+    registered, as running if they have an unfinished checkpoint.
+    """
+    file_name = 'runs.db'
+
+    def __init__(self, working_dir):
+        self.working_dir = working_dir
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(working_dir, self.file_name), timeout=30,
+                                     check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS runs ('
+                           'run_id TEXT PRIMARY KEY, process TEXT NOT NULL, run_dir TEXT NOT NULL, '
+                           'status TEXT NOT NULL, started_at REAL, finished_at REAL, bytes INTEGER)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS runs_status ON runs (status, process)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS registry (key TEXT PRIMARY KEY, value TEXT)')
+        self._conn.commit()
+        self._seed()
+
+    def _seed(self):
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                if self._conn.execute("SELECT 1 FROM registry WHERE key = 'seeded'").fetchone():
+                    self._conn.rollback()
+                    return
+                runs = list(self._scan())
+                self._conn.executemany('INSERT OR IGNORE INTO runs (run_id, process, run_dir, status, started_at, '
+                                       'finished_at) VALUES (?, ?, ?, ?, ?, ?)', runs)
+                self._conn.execute("INSERT INTO registry (key, value) VALUES ('seeded', ?)", (str(time.time()),))
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+        logger.info('run registry seeded', working_dir=self.working_dir, runs=len(runs))
+
+    def _scan(self):
+        with os.scandir(self.working_dir) as it:
+            for entry in it:
+                if not entry.name.startswith('PR') or not entry.is_dir():
+                    continue
+                mtime = entry.stat().st_mtime
+                temp_meta_path = os.path.join(entry.path, 'meta/_temp/meta_data.json')
+                meta_path = os.path.join(entry.path, 'meta/meta_data.json')
+                if os.path.exists(temp_meta_path):
+                    with open(temp_meta_path, 'r') as f:
+                        temp_meta = json.load(f)
+                    if temp_meta['success_flag'] is False:
+                        yield entry.name, temp_meta['name'], entry.path, 'running', mtime, None
+                        continue
+                process = ''
+                if os.path.exists(meta_path):
+                    with open(meta_path, 'r') as f:
+                        meta_list = json.load(f)
+                    process = meta_list[0]['name'] if meta_list else ''
+                yield entry.name, process, entry.path, 'finished', mtime, mtime
+
+    def start(self, run_id, process, run_dir):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO runs (run_id, process, run_dir, status, started_at) '
+                               "VALUES (?, ?, ?, 'running', ?)", (run_id, process, run_dir, time.time()))
+            self._conn.commit()
+
+    def finish(self, run_id, run_dir=None):
+        size = dir_size(run_dir) if run_dir else None
+        with self._lock:
+            self._conn.execute("UPDATE runs SET status = 'finished', finished_at = ?, bytes = ? WHERE run_id = ?",
+                               (time.time(), size, run_id))
+            self._conn.commit()
+
+    def unfinished(self, process):
+        """
+        (run_id, run_dir) of the runs of process that were started and never finished
+        """
+        with self._lock:
+            return self._conn.execute("SELECT run_id, run_dir FROM runs WHERE status = 'running' AND process = ? "
+                                      'ORDER BY started_at', (process,)).fetchall()
+
+    def prune(self, max_age=None, max_bytes=None):
+        """
+        delete the dirs of finished runs older than max_age seconds, then of the oldest
+        finished runs until all finished runs take at most max_bytes; unfinished runs are
+        kept for recovery
+        """
+        with self._lock:
+            runs = self._conn.execute("SELECT run_id, run_dir, finished_at, bytes FROM runs "
+                                      "WHERE status = 'finished' ORDER BY finished_at").fetchall()
+        now = time.time()
+        total = sum(size or 0 for _, _, _, size in runs)
+        if max_bytes is not None and any(size is None for _, _, _, size in runs):
+            runs = [(run_id, run_dir, finished_at, size if size is not None else dir_size(run_dir))
+                    for run_id, run_dir, finished_at, size in runs]
+            total = sum(size for _, _, _, size in runs)
+        pruned = []
+        for run_id, run_dir, finished_at, size in runs:
+            expired = max_age is not None and now - finished_at > max_age
+            over_budget = max_bytes is not None and total > max_bytes
+            if not expired and not over_budget:
+                break
+            shutil.rmtree(run_dir, ignore_errors=True)
+            total -= size or 0
+            pruned.append(run_id)
+        if pruned:
+            with self._lock:
+                self._conn.executemany('DELETE FROM runs WHERE run_id = ?', [(run_id,) for run_id in pruned])
+                self._conn.commit()
+            logger.info('pruned finished runs', working_dir=self.working_dir, runs=len(pruned))
+        return pruned
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,10 +1,11 @@
 
+import heapq
+import itertools
 import parsy
 from parsy import seq
-from datetime import date, timedelta
-from basepy.schedule import scheduler
+from datetime import date, datetime, timedelta
+from basepy.log import logger
 import threading
-import time
 '''
 every day at 12h30m
 every week day 7 at 8h:30m
@@ -29,14 +30,14 @@ def _create_parser():
 
     def _day_timedelta(day_list):
         if isinstance(day_list, (list, tuple)):
-            return map(lambda x: timedelta(days=x-1), day_list)
+            return [timedelta(days=x-1) for x in day_list]
         return [timedelta(days=day_list-1)]
 
     space = parsy.string(" ").at_least(1)
     every = parsy.string("every")
     number = parsy.regex('[0-9]+').map(int)
 
-    number_list = (seq(number) + (parsy.string(",") >> number).many()).combine(_day_timedelta)
+    number_list = (seq(number) + (parsy.string(",") >> number).many()).map(_day_timedelta)
 
     month = (parsy.string('months').result('mon') | parsy.string('month').result('mon'))
     week = (parsy.string('weeks').result('w') | parsy.string('week').result('w') )
@@ -76,37 +77,121 @@ def _create_parser():
 
 scheduler_parser = _create_parser()
 
-def add_schedule(sched_str, callback_fn):
-    parsed = scheduler_parser.parse(sched_str)
-    if len(parsed) % 2 != 0:
-        raise Exception('Schedule string parsed wrong, expect number 2,4,or 6 values, got {}'.format(len(parsed)))
-    if parsed[0] != 'every':
-        raise Exception('Schedule pared string first word must be every, got {}'.format(parsed[0]))
-    chunks =  [tuple(parsed[i:i+2]) for i in range(0, len(parsed), 2)]
-
-    job = None
-    for key, value in chunks:
-        if key == 'every':
-            job = scheduler.every_delta(value)
-        elif key == 'day':
-            job = job.day(value)
-        elif key == 'at':
-            job = job.at_delta(value)
-        else:
-            raise Exception(f'unsupported key {key} in schedule {sched_str}')
-    if job:
-        job.do(callback_fn)
-
-def run_scheduler(interval=1):
-    stop_scheduler_event = threading.Event()
-
-    class ScheduleThread(threading.Thread):
-        @classmethod
-        def run(cls):
-            while not stop_scheduler_event.is_set():
-                scheduler.run_pending()
-                time.sleep(interval)
-
-    scheduler_thread = ScheduleThread()
-    scheduler_thread.start()
-    return stop_scheduler_event, scheduler_thread
\ No newline at end of file
+class Schedule:
+    """
+    Fire times of a schedule string, aligned to its period like cron: `every hour at 5m`
+    fires at minute 5 of each hour, `every 2 days at 12h` at noon of every other day since
+    1970-01-01, `every week day 1,5` on mondays and fridays at midnight, `every month day 3`
+    on the 3rd of each month.
+    """
+    day_anchor = datetime(1970, 1, 1)
+    week_anchor = datetime(1970, 1, 5)
+
+    def __init__(self, sched_str):
+        parsed = scheduler_parser.parse(sched_str)
+        if len(parsed) % 2 != 0:
+            raise Exception('Schedule string parsed wrong, expect number 2,4,or 6 values, got {}'.format(len(parsed)))
+        if parsed[0] != 'every':
+            raise Exception('Schedule pared string first word must be every, got {}'.format(parsed[0]))
+        self.sched_str = sched_str
+        self.period = None
+        self.days = [timedelta(0)]
+        self.at = timedelta(0)
+        for key, value in [tuple(parsed[i:i+2]) for i in range(0, len(parsed), 2)]:
+            if key == 'every':
+                self.period = value
+            elif key == 'day':
+                self.days = sorted(value)
+            elif key == 'at':
+                self.at = value
+            else:
+                raise Exception(f'unsupported key {key} in schedule {sched_str}')
+
+    def next_after(self, now):
+        """
+        first fire time strictly after now
+        """
+        if isinstance(self.period, DynamicTimedelta):
+            months = self.period.months
+            month_index = now.year * 12 + now.month - 1
+            month_index -= month_index % months
+            while True:
+                month_start = datetime(month_index // 12, month_index % 12 + 1, 1)
+                for day in self.days:
+                    fire_at = month_start + day + self.at
+                    if fire_at > now:
+                        return fire_at
+                month_index += months
+        anchor = self.week_anchor if self.period % timedelta(weeks=1) == timedelta(0) else self.day_anchor
+        period_start = anchor + (now - anchor) // self.period * self.period
+        while True:
+            for day in self.days:
+                fire_at = period_start + day + self.at
+                if fire_at > now:
+                    return fire_at
+            period_start += self.period
+
+
+class HeapScheduler:
+    """
+    Keeps the next fire time of every schedule in a min-heap and sleeps until the earliest.
+    Callbacks run on the scheduler thread and are expected to return quickly, e.g. by
+    queueing a job on a job runner. The delay between a fire time and its callback is
+    kept in lags and logged when over lag_warning seconds.
+    """
+    lag_warning = 1.0
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = None
+        self.lags = {}
+
+    def add(self, sched_str, callback_fn, name=None):
+        schedule = Schedule(sched_str)
+        fire_at = schedule.next_after(datetime.now())
+        with self._condition:
+            heapq.heappush(self._heap, (fire_at, next(self._counter), schedule, callback_fn, name or sched_str))
+            self._condition.notify()
+        return fire_at
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    if not self._heap:
+                        self._condition.wait()
+                        continue
+                    delay = (self._heap[0][0] - datetime.now()).total_seconds()
+                    if delay <= 0:
+                        break
+                    self._condition.wait(delay)
+                if self._stopped:
+                    return
+                fire_at, _, schedule, callback_fn, name = heapq.heappop(self._heap)
+                now = datetime.now()
+                heapq.heappush(self._heap, (schedule.next_after(max(now, fire_at)), next(self._counter),
+                                            schedule, callback_fn, name))
+            lag = (now - fire_at).total_seconds()
+            self.lags[name] = lag
+            if lag > self.lag_warning:
+                logger.warning('schedule fired late', name=name, fire_at=fire_at.isoformat(), lag=lag)
+            try:
+                callback_fn()
+            except Exception as e:
+                logger.error('schedule callback failed', name=name, error=repr(e))
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='scheduler', daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,92 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+import sys
+import threading
+import time
+
+from basepy.log import logger
+
+DEFAULT_UPLOAD_CONCURRENCY = 8
+DEFAULT_UPLOAD_RETRIES = 3
+DEFAULT_UPLOAD_BACKOFF = 1.0
+TRANSIENT_ERROR_CODES = {'RequestTimeout', 'Throttling', 'ThrottlingException', 'SlowDown',
+                         'RequestLimitExceeded', 'InternalError', 'ServiceUnavailable'}
+
+
+def is_transient_error(e):
+    """
+    whether an upload failing with e may work when tried again: lost connections, timeouts,
+    throttling and 5xx responses, not a missing file, denied access or a bad request.
+    The sdk exceptions are looked up in sys.modules, an error of an sdk means it is loaded.
+    """
+    if isinstance(e, (ConnectionError, TimeoutError)):
+        return True
+    botocore_exceptions = sys.modules.get('botocore.exceptions')
+    if botocore_exceptions and isinstance(e, (botocore_exceptions.HTTPClientError,
+                                              botocore_exceptions.ConnectionError)):
+        return True
+    cos_exceptions = sys.modules.get('qcloud_cos.cos_exception')
+    if cos_exceptions and isinstance(e, cos_exceptions.CosClientError):
+        return True
+    status, code = None, None
+    if isinstance(getattr(e, 'response', None), dict):
+        status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        code = e.response.get('Error', {}).get('Code')
+    elif cos_exceptions and isinstance(e, cos_exceptions.CosServiceError):
+        status, code = e.get_status_code(), e.get_error_code()
+    return code in TRANSIENT_ERROR_CODES or status == 429 or int(status or 0) >= 500
+
+
+class BackgroundUploader:
+    """
+    Bounded thread pool running uploads in the background.
+
+    An upload failing with a transient error, see is_transient_error, is retried up to
+    `retries` times, sleeping backoff * 2 ** attempt between tries. submit returns a future resolving to the upload result, so callers
+    can wait for every upload of a run before reporting it done.
+    """
+
+    def __init__(self, concurrency=DEFAULT_UPLOAD_CONCURRENCY, retries=DEFAULT_UPLOAD_RETRIES,
+                 backoff=DEFAULT_UPLOAD_BACKOFF):
+        self.concurrency = int(concurrency)
+        self.retries = int(retries)
+        self.backoff = float(backoff)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.concurrency,
+                                                    thread_name_prefix='uploader')
+            return self._executor
+
+    def _run(self, fn, args):
+        attempt = 0
+        while True:
+            try:
+                return fn(*args)
+            except Exception as e:
+                if attempt >= self.retries or not is_transient_error(e):
+                    raise
+                delay = self.backoff * 2 ** attempt
+                logger.warning('upload failed, retrying', error=repr(e), attempt=attempt + 1, delay=delay)
+                time.sleep(delay)
+                attempt += 1
+
+    def submit(self, fn, *args):
+        return self.executor.submit(self._run, fn, args)
+
+    @staticmethod
+    def wait_all(futures):
+        """
+        wait for every future, then return their results in order, raising the first error
+        """
+        wait(futures)
+        return [future.result() for future in futures]
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
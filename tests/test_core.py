@@ -0,0 +1,411 @@
+import json
+import os
+import shutil
+import sqlite3
+import time
+
+import pytest
+
+from dataspin.core import DataFile, DataTaskContext, SpinEngine, SpinManager
+from dataspin.project import ProjectConfig
+
+
+def test_engine_loads_only_used_resources(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(tmp_path / 'src')
+    (tmp_path / 'src' / 'a.jsonl').write_text('{"a": {"b": 1}}\n')
+    project = {
+        "dataspin": {"working_dir": str(tmp_path / 'work')},
+        "streams": [{"name": "source", "data_format": "dataspin", "url": "local://src"},
+                    {"name": "events", "url": "sqs://?access_key=k&secret_key=s&region=us-east-1"}],
+        "storages": [{"name": "target", "url": "file://out/"},
+                     {"name": "archive", "url": "s3://bucket/archive?access_key=k&secret_key=s&region=us-east-1"}],
+        "data_processes": [
+            {"name": "flatten", "source": "source", "processes": [
+                {"name": "flatten", "function": "flatten"},
+                {"name": "save", "function": "save", "args": {"location": "target"}}]},
+            {"name": "archive", "source": "events", "processes": [
+                {"name": "save", "function": "save", "args": {"location": "archive"}}]}]
+    }
+    project_path = tmp_path / 'project.json'
+    project_path.write_text(json.dumps(project))
+
+    engine = SpinEngine(ProjectConfig.load(str(project_path)))
+    assert not engine.streams.loaded() and not engine.storages.loaded()
+    assert 'events' in engine.streams and sorted(engine.data_processes) == ['archive', 'flatten']
+
+    engine.run_process('flatten')
+    assert (tmp_path / 'out' / 'a-flatten.jsonl').read_text() == '{"a.b": 1}\n'
+    assert list(engine.streams.loaded()) == ['source']
+    assert list(engine.storages.loaded()) == ['target']
+    assert list(engine.data_processes.loaded()) == ['flatten']
+    assert engine.storages['target'].provider.stats() == {'hardlink': 1}
+
+    uploader = engine.storages['target'].uploader
+    assert uploader._executor is not None
+    engine.close()
+    assert uploader._executor is None
+
+
+def test_recover_from_registry(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(tmp_path / 'src')
+    (tmp_path / 'src' / 'a.jsonl').write_text('{"a": {"b": 1}}\n')
+    project = {
+        "dataspin": {"working_dir": str(tmp_path / 'work')},
+        "streams": [{"name": "source", "data_format": "dataspin", "url": "local://src"}],
+        "storages": [{"name": "target", "url": "file://out/"}],
+        "data_processes": [{"name": "flatten", "source": "source", "processes": [
+            {"name": "flatten", "function": "flatten"},
+            {"name": "save", "function": "save", "args": {"location": "target"}}]}]
+    }
+    project_path = tmp_path / 'project.json'
+    project_path.write_text(json.dumps(project))
+    engine = SpinEngine(ProjectConfig.load(str(project_path)))
+    process = engine.data_processes['flatten']
+
+    def crash(data_file, context):
+        raise RuntimeError('crash')
+
+    monkeypatch.setattr(process.task_list[1], 'process', crash)
+    with pytest.raises(RuntimeError):
+        process.run(run_id='PRCRASHED')
+    monkeypatch.undo()
+    monkeypatch.chdir(tmp_path)
+    process.run(run_id='PRDONE')
+
+    manager = SpinManager()
+    recover, recover_dirs = manager.check_recover(process)
+    assert recover and recover_dirs == [str(tmp_path / 'work' / 'PRCRASHED')]
+    process.recover(recover_dirs[0])
+    assert manager.check_recover(process) == (False, [])
+    assert (tmp_path / 'out' / 'a-flatten.jsonl').read_text() == '{"a.b": 1}\n'
+
+    # died between two messages, nothing to recover and no longer running
+    os.makedirs(tmp_path / 'work' / 'PRDIED' / 'meta')
+    engine.run_registry.start('PRDIED', 'flatten', str(tmp_path / 'work' / 'PRDIED'))
+    assert manager.check_recover(process) == (False, [])
+    assert engine.run_registry.unfinished('flatten') == []
+
+
+def test_trigger_streams_flushed_and_closed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(tmp_path / 'src')
+    (tmp_path / 'src' / 'a.jsonl').write_text('{"a": {"b": 1}}\n')
+    project = {
+        "dataspin": {"working_dir": str(tmp_path / 'work')},
+        "streams": [{"name": "source", "data_format": "dataspin", "url": "local://src"},
+                    {"name": "events", "url": "local://events"}],
+        "storages": [{"name": "target", "url": "file://out/"}],
+        "data_processes": [{"name": "flatten", "source": "source", "processes": [
+            {"name": "flatten", "function": "flatten"},
+            {"name": "save", "function": "save", "args": {"location": "target", "trigger": "events"}}]}]
+    }
+    project_path = tmp_path / 'project.json'
+    project_path.write_text(json.dumps(project))
+    engine = SpinEngine(ProjectConfig.load(str(project_path)))
+
+    class FakeProvider:
+        def __init__(self):
+            self.calls = []
+
+        def send_message(self, message):
+            self.calls.append('send')
+
+        def flush_sends(self):
+            self.calls.append('flush')
+
+        def close(self):
+            self.calls.append('close')
+
+    provider = FakeProvider()
+    engine.streams['events']._provider = provider
+    engine.run_process('flatten')
+    assert provider.calls == ['send', 'flush', 'close']
+
+
+def test_intermediates_released_after_checkpoint(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(tmp_path / 'src')
+    (tmp_path / 'src' / 'a.jsonl').write_text('{"a": {"b": 1}}\n')
+    project = {
+        "dataspin": {"working_dir": str(tmp_path / 'work')},
+        "streams": [{"name": "source", "data_format": "dataspin", "url": "local://src"}],
+        "storages": [{"name": "target", "url": "file://out/"}],
+        "data_processes": [{"name": "flatten", "source": "source", "processes": [
+            {"name": "flatten", "function": "flatten"},
+            {"name": "again", "function": "flatten"},
+            {"name": "save", "function": "save", "args": {"location": "target"}}]}]
+    }
+    project_path = tmp_path / 'project.json'
+    project_path.write_text(json.dumps(project))
+    engine = SpinEngine(ProjectConfig.load(str(project_path)))
+    process = engine.data_processes['flatten']
+
+    def crash(data_file, context):
+        raise RuntimeError('crash')
+
+    monkeypatch.setattr(process.task_list[2], 'process', crash)
+    with pytest.raises(RuntimeError):
+        process.run(run_id='PRRUN')
+    monkeypatch.undo()
+    monkeypatch.chdir(tmp_path)
+    run_dir = tmp_path / 'work' / 'PRRUN'
+    assert not (run_dir / 'a-flatten.jsonl').exists()
+    assert (run_dir / 'a-flatten-flatten.jsonl').exists()
+    assert (tmp_path / 'src' / 'a.jsonl').exists()
+
+    process.recover(str(run_dir))
+    assert (tmp_path / 'out' / 'a-flatten-flatten.jsonl').read_text() == '{"a.b": 1}\n'
+    with open(run_dir / 'meta' / 'meta_data.json') as f:
+        history = json.load(f)[0]['task_meta']
+    assert [task['name'] for task in history] == ['flatten', 'flatten', 'save']
+
+
+def memory_engine(tmp_path, save=True, **dataspin):
+    processes = [{"name": "flatten", "function": "flatten"},
+                 {"name": "again", "function": "flatten"}]
+    if save:
+        processes.append({"name": "save", "function": "save", "args": {"location": "target"}})
+    project = {
+        "dataspin": {"working_dir": str(tmp_path / 'work'), "memory_dir": str(tmp_path / 'shm'), **dataspin},
+        "streams": [{"name": "source", "data_format": "dataspin", "url": "local://src"}],
+        "storages": [{"name": "target", "url": "file://out/"}],
+        "data_processes": [{"name": "flatten", "source": "source", "processes": processes}]
+    }
+    project_path = tmp_path / 'project.json'
+    project_path.write_text(json.dumps(project))
+    return SpinEngine(ProjectConfig.load(str(project_path)))
+
+
+@pytest.mark.parametrize('budget, spilled', [('1MB', 0), ('10B', 2)])
+def test_memory_tier(tmp_path, monkeypatch, budget, spilled):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(tmp_path / 'src')
+    (tmp_path / 'src' / 'a.jsonl').write_text('{"a": {"b": 1}}\n')
+    engine = memory_engine(tmp_path, memory_budget=budget)
+    engine.data_processes['flatten'].run(run_id='PRRUN')
+    assert (tmp_path / 'out' / 'a-flatten-flatten.jsonl').read_text() == '{"a.b": 1}\n'
+    assert engine.memory_tier.spilled == spilled
+    assert engine.memory_tier.used == 0
+    assert not (tmp_path / 'shm' / 'PRRUN').exists()
+    assert (tmp_path / 'work' / 'PRRUN' / 'a-flatten-flatten.jsonl').exists() == bool(spilled)
+
+
+def test_memory_tier_keeps_unsaved_outputs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(tmp_path / 'src')
+    (tmp_path / 'src' / 'a.jsonl').write_text('{"a": {"b": 1}}\n')
+    engine = memory_engine(tmp_path, save=False)
+    engine.data_processes['flatten'].run(run_id='PRRUN')
+    assert (tmp_path / 'work' / 'PRRUN' / 'a-flatten-flatten.jsonl').read_text() == '{"a.b": 1}\n'
+    assert engine.memory_tier.used == 0
+    with open(tmp_path / 'work' / 'PRRUN' / 'meta' / 'meta_data.json') as f:
+        output_files = json.load(f)[0]['task_meta'][-1]['output_files']
+    assert [data_file['file_path'] for data_file in output_files] == [str(tmp_path / 'work' / 'PRRUN' / 'a-flatten-flatten.jsonl')]
+
+
+def test_memory_tier_durable_checkpoint(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(tmp_path / 'src')
+    (tmp_path / 'src' / 'a.jsonl').write_text('{"a": {"b": 1}}\n')
+    engine = memory_engine(tmp_path, memory_durable=True)
+    process = engine.data_processes['flatten']
+
+    def crash(data_file, context):
+        raise RuntimeError('crash')
+
+    monkeypatch.setattr(process.task_list[2], 'process', crash)
+    with pytest.raises(RuntimeError):
+        process.run(run_id='PRRUN')
+    monkeypatch.undo()
+    monkeypatch.chdir(tmp_path)
+    shutil.rmtree(tmp_path / 'shm')
+
+    process.recover(str(tmp_path / 'work' / 'PRRUN'))
+    assert (tmp_path / 'out' / 'a-flatten-flatten.jsonl').read_text() == '{"a.b": 1}\n'
+
+
+def test_parallel_fan_out(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(tmp_path / 'src')
+    lines = [json.dumps({'app': f'app{n % 20:02d}', 'v': {'n': n}}) for n in range(100)]
+    (tmp_path / 'src' / 'a.jsonl').write_text('\n'.join(lines) + '\n')
+    project = {
+        "dataspin": {"working_dir": str(tmp_path / 'work')},
+        "streams": [{"name": "source", "data_format": "dataspin", "url": "local://src"}],
+        "storages": [{"name": "target", "url": "file://out/"}],
+        "data_processes": [{"name": "split", "source": "source", "parallelism": 4, "processes": [
+            {"name": "splitby", "function": "splitby", "args": {"key": ["app"], "tags": {"app": "{data.app}"}}},
+            {"name": "flatten", "function": "flatten"},
+            {"name": "save", "function": "save", "args": {"location": "target", "path_suffix": "{app}"}}]}]
+    }
+    project_path = tmp_path / 'project.json'
+    project_path.write_text(json.dumps(project))
+    engine = SpinEngine(ProjectConfig.load(str(project_path)))
+    process = engine.data_processes['split']
+    assert process.map_files(lambda n: n * 2, list(range(50))) == list(range(0, 100, 2))
+
+    process.run(run_id='PRRUN')
+    apps = [f'app{n:02d}' for n in range(20)]
+    with open(tmp_path / 'work' / 'PRRUN' / 'meta' / 'meta_data.json') as f:
+        history = json.load(f)[0]['task_meta']
+    assert [data_file['tags']['app'] for data_file in history[1]['output_files']] == apps
+    for n, app in enumerate(apps):
+        saved = (tmp_path / 'out' / app / f'a-group-{app}-flatten.jsonl').read_text().splitlines()
+        assert saved == [json.dumps({'app': app, 'v.n': m}) for m in range(n, 100, 20)]
+
+
+def test_recover_after_move_save(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(tmp_path / 'src')
+    (tmp_path / 'src' / 'a.jsonl').write_text('{"a": {"b": 1}}\n')
+    project = {
+        "dataspin": {"working_dir": str(tmp_path / 'work')},
+        "streams": [{"name": "source", "data_format": "dataspin", "url": "local://src"}],
+        "storages": [{"name": "target", "url": "file://out/"}],
+        "data_processes": [{"name": "flatten", "source": "source", "processes": [
+            {"name": "flatten", "function": "flatten"},
+            {"name": "save", "function": "save", "args": {"location": "target", "move": True}}]}]
+    }
+    project_path = tmp_path / 'project.json'
+    project_path.write_text(json.dumps(project))
+    engine = SpinEngine(ProjectConfig.load(str(project_path)))
+    process = engine.data_processes['flatten']
+    save = process.task_list[1]
+    original = type(save).process_multi
+
+    def save_then_crash(data_files, context):
+        original(save, data_files, context)
+        raise RuntimeError('crash after save')
+
+    monkeypatch.setattr(save, 'process_multi', save_then_crash)
+    with pytest.raises(RuntimeError):
+        process.run(run_id='PRMOVED')
+    monkeypatch.undo()
+    monkeypatch.chdir(tmp_path)
+    assert not (tmp_path / 'work' / 'PRMOVED' / 'a-flatten.jsonl').exists()
+
+    process.recover(str(tmp_path / 'work' / 'PRMOVED'))
+    assert (tmp_path / 'out' / 'a-flatten.jsonl').read_text() == '{"a.b": 1}\n'
+    assert SpinManager().check_recover(process) == (False, [])
+
+
+def test_deserialize_missing_file(tmp_path):
+    (tmp_path / 'a.jsonl').write_text('{"a": 1}\n')
+    meta = DataFile(str(tmp_path / 'a.jsonl')).serialize()
+    os.remove(tmp_path / 'a.jsonl')
+    assert DataFile.deserialize(meta) is None
+    assert DataFile.deserialize(meta, moved=True).file_path == str(tmp_path / 'a.jsonl')
+    assert DataFile.deserialize(meta, verify=False).file_path == str(tmp_path / 'a.jsonl')
+
+
+def test_deduplicate_recovery_keeps_claimed_records(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(tmp_path / 'src')
+    (tmp_path / 'src' / 'a.jsonl').write_text('{"id": 1}\n{"id": 2}\n')
+    project = {
+        "dataspin": {"working_dir": str(tmp_path / 'work')},
+        "streams": [{"name": "source", "data_format": "dataspin", "url": "local://src"}],
+        "storages": [{"name": "target", "url": "file://out/"}],
+        "pk_caches": [{"name": "ids", "url": f"sqlite://{tmp_path}/pk.db", "timeout": "1d"}],
+        "data_processes": [{"name": "dedup", "source": "source", "processes": [
+            {"name": "deduplicate", "function": "deduplicate", "args": {"key": ["id"], "pk_cache": "ids"}},
+            {"name": "save", "function": "save", "args": {"location": "target"}}]}]
+    }
+    project_path = tmp_path / 'project.json'
+    project_path.write_text(json.dumps(project))
+    engine = SpinEngine(ProjectConfig.load(str(project_path)))
+    process = engine.data_processes['dedup']
+    original = type(process.task_list[0]).process
+    calls = []
+
+    def dedup_then_crash(data_file, context):
+        calls.append(data_file)
+        if len(calls) == 1:
+            original(process.task_list[0], data_file, context)
+            raise RuntimeError('crash after dedup')
+        return original(process.task_list[0], data_file, context)
+
+    monkeypatch.setattr(process.task_list[0], 'process', dedup_then_crash)
+    with pytest.raises(RuntimeError):
+        process.run(run_id='PRRUN')
+    monkeypatch.undo()
+    monkeypatch.chdir(tmp_path)
+
+    process.recover(str(tmp_path / 'work' / 'PRRUN'))
+    assert (tmp_path / 'out' / 'a-deduplicate.jsonl').read_text() == '{"id": 1}\n{"id": 2}\n'
+
+    (tmp_path / 'src' / 'b.jsonl').write_text('{"id": 2}\n{"id": 3}\n')
+    process.run(run_id='PRNEXT')
+    assert (tmp_path / 'out' / 'b-deduplicate.jsonl').read_text() == '{"id": 3}\n'
+
+    pk_cache = engine.pk_caches['ids']
+    engine.close()
+    with pytest.raises(sqlite3.ProgrammingError):
+        pk_cache.exists_many([(1,)])
+
+
+class FakeIndexStorage:
+    def __init__(self, args=None, files=None):
+        self.args = args or {}
+        self.files = files or {}
+        self.listed = []
+
+    def get(self, prefix=None):
+        self.listed.append(prefix)
+        return iter([])
+
+    def fetch_file(self, file_path):
+        yield self.files[file_path]
+
+
+def dedup_engine(tmp_path):
+    project = {
+        "dataspin": {"working_dir": str(tmp_path / 'work')},
+        "streams": [{"name": "source", "data_format": "dataspin", "url": "local://src"}],
+        "data_processes": [{"name": "dedup", "source": "source", "processes": [
+            {"name": "deduplicate", "function": "deduplicate", "args": {"key": ["id"], "timestamp_field": "ts"}}]}]
+    }
+    project_path = tmp_path / 'project.json'
+    project_path.write_text(json.dumps(project))
+    return SpinEngine(ProjectConfig.load(str(project_path)))
+
+
+def test_deduplicate_event_time_range(tmp_path):
+    engine = dedup_engine(tmp_path)
+    process = engine.data_processes['dedup']
+    dedup = process.task_list[0]
+    os.makedirs(tmp_path / 'work' / 'PRRUN')
+    context = DataTaskContext('dedup', 'PRRUN', str(tmp_path / 'work' / 'PRRUN'), [], engine=engine, process=process)
+
+    tagged = DataFile(str(tmp_path / 'none.jsonl'), tags={'datetime_start': '2022-03-01T00:00:00Z',
+                                                          'datetime_end': '2022-03-01T01:00:00Z'})
+    assert dedup.event_time_range(tagged, context) == ((1646092800, 1646096400), tagged)
+
+    (tmp_path / 'a.jsonl').write_text('{"id": 1, "ts": 1646096400000}\n{"id": 2, "ts": "bad"}\n'
+                                      '{"id": 3}\n{"id": 4, "ts": "2022-03-01T00:00:00Z"}\n')
+    local = DataFile(str(tmp_path / 'a.jsonl'))
+    assert dedup.event_time_range(local, context) == ((1646092800, 1646096400), local)
+
+    remote = DataFile('bucket/a.jsonl', provider=FakeIndexStorage(files={'bucket/a.jsonl': str(tmp_path / 'a.jsonl')}))
+    time_range, spooled = dedup.event_time_range(remote, context)
+    assert time_range == (1646092800, 1646096400) and not spooled.provider
+    assert spooled.file_path == str(tmp_path / 'work' / 'PRRUN' / 'a-spool.jsonl')
+    assert [data['id'] for data, line in spooled.readlines()] == [1, 2, 3, 4]
+
+
+def test_update_pk_cache_event_time_window(tmp_path):
+    process = dedup_engine(tmp_path).data_processes['dedup']
+    storage = FakeIndexStorage({'time_window': '1d', 'event_time_slack': '1h',
+                                'index_pattern': 'index/{year}/{month}/{day}/{hour}/{app_id}/'})
+    data_file = DataFile('bucket/a.jsonl', tags={'app_id': 'APP1'}, provider=storage)
+    process.update_pk_cache(data_file, ['id'], (1646092800, 1646096400))
+    assert sorted(storage.listed) == ['index/2022/02/28/23/APP1/', 'index/2022/03/01/00/APP1/',
+                                      'index/2022/03/01/01/APP1/', 'index/2022/03/01/02/APP1/']
+
+    # records dated after now still load the partitions they fall in
+    storage.listed = []
+    future = int(time.time()) + 3 * 24 * 60 * 60
+    process.update_pk_cache(data_file, ['id'], (future, future))
+    assert time.strftime('index/%Y/%m/%d/%H/APP1/', time.gmtime(future)) in storage.listed
@@ -0,0 +1,51 @@
+import subprocess
+import sys
+
+import pytest
+
+HEAVY_MODULES = ['boto3', 'botocore', 'pulsar', 'qcloud_cos', 'sqlalchemy', 'jinja2']
+
+
+def import_times(code):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def loaded_modules(code):
+    code = f'import sys; {code}; print(" ".join(sys.modules))'
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    return result.stdout.split()
+
+
+def heavy(modules):
+    return [name for name in modules if name.split('.')[0] in HEAVY_MODULES]
+
+
+def test_cli_import_time():
+    times = import_times('import dataspin.main')
+    assert not heavy(times)
+    # microseconds, about 50ms here, the heavy sdks alone take several times that
+    assert times['dataspin.main'] < 200000
+    assert not heavy(loaded_modules('import dataspin.main'))
+
+
+def test_local_provider_imports_no_backends():
+    modules = loaded_modules("from dataspin.providers import get_provider; "
+                             "from dataspin.functions import creat_function_with; "
+                             "get_provider('file://out/'); get_provider('local://src'); "
+                             "creat_function_with('save', {})")
+    assert 'dataspin.providers.local' in modules
+    assert not heavy(modules)
+
+
+def test_unknown_platform():
+    from dataspin.providers import get_provider
+    with pytest.raises(Exception, match='No provider for platform'):
+        get_provider('ftp://host/path')
@@ -0,0 +1,84 @@
+from io import BytesIO
+import gzip
+import json
+import time
+
+import pytest
+
+from dataspin.pkindex.index_format import pk_hash, write_index, read_index, read_header, is_binary_index
+from dataspin.pkindex.pk_index import load_pk_hashes, PKIndexCache
+
+
+def build_index(keys, **kwargs):
+    fp = BytesIO()
+    write_index(fp, [pk_hash(key) for key in keys], ['app_id', 'event_id'], 100, 200, **kwargs)
+    return fp.getvalue()
+
+
+def test_write_read_index():
+    keys = [('APP1', f'event_{i}') for i in range(20000)] + [('APP1', 'event_1')]
+    content = build_index(keys, block_size=1000)
+    assert is_binary_index(content)
+    header, key_hashes = read_index(content)
+    assert header['key'] == ['app_id', 'event_id']
+    assert (header['time_start'], header['time_end']) == (100, 200)
+    assert header['count'] == 20000
+    assert len(header['blocks']) == 20
+    assert list(key_hashes) == sorted(set(pk_hash(key) for key in keys))
+    v1_size = sum(len(json.dumps({'app_id': app_id, 'event_id': event_id})) + 1 for app_id, event_id in keys)
+    assert len(content) < v1_size / 2
+    assert all(type(key_hash) is bytes and len(key_hash) == 16 for key_hash in key_hashes)
+    header, _ = read_header(build_index([]))
+    assert header['count'] == 0 and header['blocks'] == []
+
+
+def test_old_index_version_rejected():
+    content = b'DSPKIDX2' + build_index([('APP1', 'a')])[8:]
+    assert is_binary_index(content)
+    with pytest.raises(Exception, match='unsupported pk index version'):
+        read_index(content)
+    with pytest.raises(Exception, match='unsupported pk index version'):
+        load_pk_hashes(content, '.index', ['app_id', 'event_id'])
+
+
+def test_load_pk_hashes():
+    keys = [('APP1', 'a'), ('APP1', 'b')]
+    v1 = '\n'.join(json.dumps({'app_id': app_id, 'event_id': event_id}) for app_id, event_id in keys).encode()
+    v2 = build_index(keys)
+    assert sorted(load_pk_hashes(v1, '.jsonl', ['app_id', 'event_id'])) == list(load_pk_hashes(v2, '.index', ['app_id', 'event_id']))
+    with pytest.raises(Exception):
+        load_pk_hashes(v2, '.index', ['event_id'])
+
+
+class MemoryDataFile:
+    def __init__(self, content, ext):
+        self.content = content
+        self.ext = ext
+
+    def read_bytes(self):
+        return self.content
+
+
+def test_pk_index_cache_v2():
+    cache = PKIndexCache(['app_id', 'event_id'], 60, int(time.time()))
+    cache.update_pk_files([MemoryDataFile(build_index([('APP1', 'a')]), '.index'),
+                           MemoryDataFile(b'{"app_id": "APP1", "event_id": "b"}\n', '.jsonl')])
+    assert cache.is_exists({'app_id': 'APP1', 'event_id': 'a'})
+    assert cache.is_exists({'app_id': 'APP1', 'event_id': 'b'})
+    assert not cache.is_exists({'app_id': 'APP1', 'event_id': 'c'})
+
+
+def test_pk_index_cache_parse_processes():
+    files = [MemoryDataFile(build_index([('APP1', f'{i}-{j}') for j in range(50)]), '.index') for i in range(4)]
+    files.append(MemoryDataFile(gzip.compress(b'{"app_id": "APP2", "event_id": "x"}\n'), '.jsonl.gz'))
+    serial = PKIndexCache(['app_id', 'event_id'], 60, int(time.time()))
+    serial.update_pk_files(files)
+    parallel = PKIndexCache(['app_id', 'event_id'], 60, int(time.time()), parse_processes=2)
+    try:
+        parallel.update_pk_files(files)
+        assert parallel._parse_pool is not None
+    finally:
+        parallel.close()
+    assert parallel._parse_pool is None
+    assert parallel._cache == serial._cache
+    assert len(serial._cache) == 201
@@ -0,0 +1,135 @@
+import socketserver
+import threading
+import time
+
+import pytest
+
+from dataspin.pkindex.pk_cache import (MemoryPKCache, SqlitePKCache, RedisPKCache,
+                                       get_pk_cache)
+
+
+class RedisStandInHandler(socketserver.StreamRequestHandler):
+    """
+    Serves the handful of redis commands the pk cache uses, from a dict.
+    """
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        count = int(line[1:-2])
+        args = []
+        for _ in range(count):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def write_bulk(self, value):
+        if value is None:
+            return b'$-1\r\n'
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+
+    def handle(self):
+        store = self.server.store
+        while True:
+            command = self.read_command()
+            if command is None:
+                break
+            name = command[0].upper()
+            self.server.commands.append(name)
+            now = time.time()
+            if name == b'MGET':
+                values = []
+                for key in command[1:]:
+                    value, expire_at = store.get(key, (None, None))
+                    if expire_at is not None and expire_at <= now:
+                        value = None
+                    values.append(value)
+                reply = b'*%d\r\n' % len(values) + b''.join(self.write_bulk(v) for v in values)
+            elif name == b'SET':
+                options = [arg.upper() for arg in command[3:]]
+                expire_at = None
+                if b'EX' in options:
+                    expire_at = now + int(options[options.index(b'EX') + 1])
+                value, current_expire_at = store.get(command[1], (None, None))
+                live = value is not None and (current_expire_at is None or current_expire_at > now)
+                if b'NX' in options and live:
+                    reply = b'$-1\r\n'
+                else:
+                    store[command[1]] = (command[2], expire_at)
+                    reply = b'+OK\r\n'
+            elif name == b'GET':
+                value, expire_at = store.get(command[1], (None, None))
+                if expire_at is not None and expire_at <= now:
+                    value = None
+                reply = self.write_bulk(value)
+            elif name in (b'PING', b'SELECT', b'AUTH'):
+                reply = b'+OK\r\n'
+            else:
+                reply = b'-ERR unknown command\r\n'
+            self.wfile.write(reply)
+
+
+@pytest.fixture
+def redis_stand_in():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), RedisStandInHandler)
+    server.daemon_threads = True
+    server.store = {}
+    server.commands = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def check_backend(cache):
+    keys = [('APP1', f'event_{i}') for i in range(1200)]
+    assert cache.exists_many(keys) == [False] * len(keys)
+    cache.add_many(keys[:600])
+    assert cache.exists_many(keys) == [True] * 600 + [False] * 600
+    assert cache.exists(('APP1', 'event_1'))
+    assert not cache.exists(('APP2', 'event_1'))
+    cache.add(('APP2', 'event_1'))
+    assert cache.exists(('APP2', 'event_1'))
+
+    claim_keys = [('APP3', f'event_{i}') for i in range(600)]
+    assert cache.claim_many(claim_keys[:400], 'run-a') == [True] * 400
+    assert cache.claim_many(claim_keys, 'run-b') == [False] * 400 + [True] * 200
+    # a retry of the same input keeps the keys it claimed
+    assert cache.claim_many(claim_keys[:400], 'run-a') == [True] * 400
+    assert cache.claim_many([('APP1', 'event_1')], 'run-a') == [False]
+
+
+def test_memory_pk_cache():
+    check_backend(MemoryPKCache('memory', timeout=60))
+
+
+def test_memory_pk_cache_expire():
+    cache = MemoryPKCache('memory', timeout=1)
+    cache.add(('a', 1))
+    assert cache.exists(('a', 1))
+    cache._keys[cache.encode_key(('a', 1))] = time.time() - 1
+    assert not cache.exists(('a', 1))
+
+
+def test_sqlite_pk_cache(tmp_path):
+    path = str(tmp_path / 'pk' / 'cache.db')
+    cache = SqlitePKCache('sqlite', path, timeout=60, batch_size=250)
+    check_backend(cache)
+    cache.close()
+
+    reopened = get_pk_cache('sqlite', f'sqlite://{path}', timeout=60)
+    assert reopened.exists(('APP1', 'event_1'))
+    assert not get_pk_cache('other', f'sqlite://{path}', timeout=60).exists(('APP1', 'event_1'))
+
+
+def test_redis_pk_cache(redis_stand_in):
+    host, port = redis_stand_in.server_address
+    cache = get_pk_cache('redis', f'redis://{host}:{port}/0', timeout=60)
+    assert isinstance(cache, RedisPKCache)
+    check_backend(cache)
+    # 1200 keys with the default batch size of 500 is three MGET round trips
+    assert redis_stand_in.commands.count(b'MGET') == 3 + 3 + 1 + 1 + 1
+    assert redis_stand_in.commands.count(b'SET') == 600 + 1 + 2 * 400 + 600 + 1
+    cache.close()
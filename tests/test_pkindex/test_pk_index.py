@@ -0,0 +1,118 @@
+import calendar
+import datetime
+
+import pytest
+
+from dataspin.pkindex.pk_index import IndexSearcher
+
+pattern = "datalog/event/{app_id}/{year}/{month}/{day}/{hour}/{minute}/"
+
+
+def ts(*args):
+    return calendar.timegm(datetime.datetime(*args).timetuple())
+
+
+def test_prefixs_24h_window():
+    searcher = IndexSearcher()
+    prefixs = searcher.get_index_prefixs(pattern, {'app_id': 'APP1'},
+                                         ts(2022, 3, 1, 10, 58), ts(2022, 3, 2, 10, 58))
+    assert prefixs[:3] == ['datalog/event/APP1/2022/03/01/10/58/',
+                           'datalog/event/APP1/2022/03/01/10/59/',
+                           'datalog/event/APP1/2022/03/01/11/']
+    assert 'datalog/event/APP1/2022/03/01/23/' in prefixs
+    assert prefixs[-3:] == ['datalog/event/APP1/2022/03/02/10/56/',
+                            'datalog/event/APP1/2022/03/02/10/57/',
+                            'datalog/event/APP1/2022/03/02/10/58/']
+    assert len(prefixs) == 2 + 13 + 10 + 59
+    assert len(set(prefixs)) == len(prefixs)
+
+
+def test_prefixs_whole_days():
+    searcher = IndexSearcher()
+    prefixs = searcher.get_index_prefixs(pattern, {'app_id': 'APP1'},
+                                         ts(2022, 2, 27, 23, 0), ts(2022, 3, 2, 0, 0))
+    assert prefixs == ['datalog/event/APP1/2022/02/27/23/',
+                       'datalog/event/APP1/2022/02/28/',
+                       'datalog/event/APP1/2022/03/01/',
+                       'datalog/event/APP1/2022/03/02/00/00/']
+
+
+def test_prefixs_tags_after_time():
+    searcher = IndexSearcher()
+    prefixs = searcher.get_index_prefixs("index/{year}/{month}/{day}/{hour}/{app_id}/", {'app_id': 'APP1'},
+                                         ts(2022, 3, 1, 22, 30), ts(2022, 3, 2, 1, 10))
+    assert prefixs == ['index/2022/03/01/22/APP1/',
+                       'index/2022/03/01/23/APP1/',
+                       'index/2022/03/02/00/APP1/',
+                       'index/2022/03/02/01/APP1/']
+    with pytest.raises(Exception):
+        searcher.get_index_prefixs("index/{year}/{month}/{app_id}/", {'app_id': 'APP1'},
+                                   ts(2022, 3, 1), ts(2022, 3, 2))
+
+
+class FakeStorage:
+    def __init__(self, keys):
+        self.keys = keys
+        self.listed = []
+
+    def get(self, prefix=None):
+        for key in sorted(self.keys):
+            if key.startswith(prefix):
+                self.listed.append(key)
+                yield key
+
+
+def test_select_index_files():
+    storage = FakeStorage(['datalog/event/APP1/2022/02/28/10/01/a.index',
+                           'datalog/event/APP1/2022/02/28/10/01/a.jsonl',
+                           'datalog/event/APP1/2022/03/01/00/00/b.index',
+                           'datalog/event/APP1/2022/03/01/00/01/c.index',
+                           'datalog/event/APP2/2022/03/01/00/00/d.index'])
+    searcher = IndexSearcher(list_concurrency=4)
+    files = searcher.select_index_files(storage, pattern, {'app_id': 'APP1'},
+                                        ts(2022, 2, 28, 0, 0), ts(2022, 3, 1, 0, 0))
+    assert files == ['datalog/event/APP1/2022/02/28/10/01/a.index',
+                     'datalog/event/APP1/2022/03/01/00/00/b.index']
+
+
+def test_select_new_index_files():
+    storage = FakeStorage(['datalog/event/APP1/2022/03/01/00/00/a.index',
+                           'datalog/event/APP1/2022/03/01/00/01/b.index'])
+    searcher = IndexSearcher()
+    window = (pattern, {'app_id': 'APP1'}, ts(2022, 3, 1, 0, 0), ts(2022, 3, 1, 0, 2))
+    assert searcher.select_new_index_files(storage, *window) == storage.keys
+    storage.keys.append('datalog/event/APP1/2022/03/01/00/01/c.index')
+    assert searcher.select_new_index_files(storage, *window) == ['datalog/event/APP1/2022/03/01/00/01/c.index']
+
+    searcher = IndexSearcher(refresh_interval=60)
+    assert len(searcher.select_new_index_files(storage, *window)) == 3
+    storage.keys.append('datalog/event/APP1/2022/03/01/00/02/d.index')
+    assert searcher.select_new_index_files(storage, *window) == []
+
+
+def test_select_new_index_files_out_of_order():
+    storage = FakeStorage(['datalog/event/APP1/2022/03/01/00/00/m.index',
+                           'datalog/event/APP1/2022/03/01/00/01/m.index'])
+    searcher = IndexSearcher()
+    window = (pattern, {'app_id': 'APP1'}, ts(2022, 3, 1, 0, 0), ts(2022, 3, 1, 0, 2))
+    assert searcher.select_new_index_files(storage, *window) == storage.keys
+    # a late file named after an earlier source file sorts before the keys already listed
+    storage.keys.append('datalog/event/APP1/2022/03/01/00/01/a.index')
+    storage.keys.append('datalog/event/APP1/2022/03/01/00/00/b.index')
+    assert sorted(searcher.select_new_index_files(storage, *window)) == [
+        'datalog/event/APP1/2022/03/01/00/00/b.index', 'datalog/event/APP1/2022/03/01/00/01/a.index']
+
+    # once the hour has passed it is listed as one prefix, keys seen under minutes stay known
+    hour_window = (pattern, {'app_id': 'APP1'}, ts(2022, 3, 1, 0, 0), ts(2022, 3, 1, 0, 59, 59))
+    storage.keys.append('datalog/event/APP1/2022/03/01/00/00/a.index')
+    assert searcher.select_new_index_files(storage, *hour_window) == ['datalog/event/APP1/2022/03/01/00/00/a.index']
+
+
+def test_select_new_index_files_forgets_passed_prefixs():
+    storage = FakeStorage(['datalog/event/APP1/2022/03/01/00/00/a.index',
+                           'datalog/event/APP1/2022/03/01/00/01/b.index'])
+    searcher = IndexSearcher()
+    searcher.select_new_index_files(storage, pattern, {'app_id': 'APP1'}, ts(2022, 3, 1, 0, 0), ts(2022, 3, 1, 0, 2))
+    searcher.select_new_index_files(storage, pattern, {'app_id': 'APP1'}, ts(2022, 3, 1, 0, 1), ts(2022, 3, 1, 0, 2))
+    [seen_keys] = searcher._seen_keys.values()
+    assert sorted(seen_keys) == ['datalog/event/APP1/2022/03/01/00/01/', 'datalog/event/APP1/2022/03/01/00/02/']
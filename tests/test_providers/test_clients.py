@@ -0,0 +1,32 @@
+import threading
+
+from dataspin.providers.clients import get_aws_client, get_aws_resource, clear_clients
+from dataspin.providers.aws import S3StorageProvider
+
+
+def test_shared_aws_client():
+    clear_clients()
+    client = get_aws_client('s3', 'key', 'secret', 'us-east-1', max_pool_connections='20')
+    assert client is get_aws_client('s3', 'key', 'secret', 'us-east-1', max_pool_connections='20')
+    assert client.meta.config.max_pool_connections == 20
+    assert client is not get_aws_client('s3', 'key', 'secret', 'us-west-2', max_pool_connections='20')
+
+    first = S3StorageProvider(path='bucket/data', access_key='key', secret_key='secret', region='us-east-1')
+    second = S3StorageProvider(path='bucket/data', access_key='key', secret_key='secret', region='us-east-1')
+    assert first._s3_client is second._s3_client
+    clear_clients()
+
+
+def test_aws_resource_per_thread():
+    clear_clients()
+    resource = get_aws_resource('sqs', 'key', 'secret', 'us-east-1')
+    assert resource is get_aws_resource('sqs', 'key', 'secret', 'us-east-1')
+    other = []
+    thread = threading.Thread(target=lambda: other.append(get_aws_resource('sqs', 'key', 'secret', 'us-east-1')))
+    thread.start()
+    thread.join()
+    assert other[0] is not resource
+    assert other[0].meta.client is not resource.meta.client
+    clear_clients()
+    assert resource is not get_aws_resource('sqs', 'key', 'secret', 'us-east-1')
+    clear_clients()
@@ -0,0 +1,79 @@
+import errno
+import fcntl
+import os
+
+from botocore.stub import Stubber
+import pytest
+
+from dataspin.providers.aws import S3StorageProvider
+from dataspin.providers.local import LocalStorageProvider
+from dataspin.utils.common import get_file_md5
+
+
+def test_s3_skip_unchanged(tmp_path):
+    local_file = tmp_path / 'a.jsonl'
+    local_file.write_text('{"a": 1}\n')
+    checksum = get_file_md5(str(local_file))
+    provider = S3StorageProvider(path='bucket/data', access_key='key', secret_key='secret', region='us-east-1')
+    with Stubber(provider._s3_client) as stubber:
+        stubber.add_response('head_object', {'ETag': '"multipart-2"', 'ContentLength': 9,
+                                             'Metadata': {'md5': checksum}},
+                             {'Bucket': 'bucket', 'Key': 'data/a.jsonl'})
+        assert provider.save('a.jsonl', str(local_file), checksum=checksum) == 'bucket/data/a.jsonl'
+        stubber.assert_no_pending_responses()
+
+    with Stubber(provider._s3_client) as stubber:
+        stubber.add_client_error('head_object', http_status_code=404)
+        stubber.add_response('put_object', {'ETag': f'"{checksum}"'})
+        provider.save('a.jsonl', str(local_file), checksum=checksum)
+        stubber.assert_no_pending_responses()
+
+
+def test_s3_min_part_size():
+    with pytest.raises(Exception, match='minimum part size'):
+        S3StorageProvider(path='bucket/data', access_key='key', secret_key='secret', region='us-east-1',
+                          multipart_chunksize='1MB')
+
+
+def test_local_skip_unchanged(tmp_path):
+    local_file = tmp_path / 'a.jsonl'
+    local_file.write_text('{"a": 1}\n')
+    provider = LocalStorageProvider(str(tmp_path / 'out'), None)
+    save_path = provider.save('a.jsonl', str(local_file))
+    mtime = os.stat(save_path).st_mtime_ns
+    assert provider.save('a.jsonl', str(local_file), checksum=get_file_md5(str(local_file))) == save_path
+    assert os.stat(save_path).st_mtime_ns == mtime
+
+
+def test_local_save_methods(tmp_path, monkeypatch):
+    local_file = tmp_path / 'a.jsonl'
+    local_file.write_text('{"a": 1}\n')
+    provider = LocalStorageProvider(str(tmp_path / 'out'), None)
+    save_path = provider.save('x/a.jsonl', str(local_file), link=True)
+    assert os.stat(save_path).st_ino == os.stat(local_file).st_ino
+    assert provider.stats() == {'hardlink': 1}
+
+    def cross_device(*args):
+        raise OSError(errno.EXDEV, 'cross-device link')
+
+    monkeypatch.setattr(os, 'link', cross_device)
+    monkeypatch.setattr(fcntl, 'ioctl', cross_device)
+    provider.save('x/a.jsonl', str(local_file), link=True)
+    assert local_file.exists()
+    assert provider.save_methods['copy'] == 1
+
+    monkeypatch.setattr(os, 'rename', cross_device)
+    provider.save('x/b.jsonl', str(local_file), move=True)
+    assert provider.save_methods['copy'] == 2
+    monkeypatch.undo()
+
+    # not a working file of a run, its output never shares the inode
+    save_path = provider.save('x/d.jsonl', str(local_file))
+    assert os.stat(save_path).st_ino != os.stat(local_file).st_ino
+    assert provider.save_methods['hardlink'] == 1
+
+    save_path = provider.save('x/c.jsonl', str(local_file), move=True)
+    assert not local_file.exists()
+    assert os.stat(save_path).st_nlink == 1
+    assert provider.save_methods['rename'] == 1
+    assert (tmp_path / 'out' / 'x' / 'c.jsonl').read_text() == '{"a": 1}\n'
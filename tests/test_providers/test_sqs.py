@@ -0,0 +1,132 @@
+import json
+import time
+
+import pytest
+
+from dataspin.providers.aws import SQSStreamProvider
+
+
+class FakeMessage:
+    def __init__(self, n, body):
+        self.message_id = f'message_{n}'
+        self.receipt_handle = f'handle_{n}'
+        self.body = json.dumps(body)
+
+
+class FakeQueue:
+    """
+    Local stand-in for an SQS queue resource.
+    """
+
+    def __init__(self, count, visibility_timeout=30):
+        self.attributes = {'VisibilityTimeout': str(visibility_timeout)}
+        self.messages = [FakeMessage(n, {'data_format': 'dataspin', 'file_url': f's3://bucket/file_{n}.jsonl'})
+                         for n in range(count)]
+        self.receive_calls = []
+        self.delete_calls = []
+        self.visibility_calls = []
+
+    def receive_messages(self, MaxNumberOfMessages=1, WaitTimeSeconds=0, **kwargs):
+        self.receive_calls.append((MaxNumberOfMessages, WaitTimeSeconds))
+        received, self.messages = self.messages[:MaxNumberOfMessages], self.messages[MaxNumberOfMessages:]
+        return received
+
+    def delete_messages(self, Entries):
+        self.delete_calls.append([entry['ReceiptHandle'] for entry in Entries])
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries]}
+
+    def change_message_visibility_batch(self, Entries):
+        self.visibility_calls.append([entry['ReceiptHandle'] for entry in Entries])
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries]}
+
+
+def test_batched_receive_and_delete():
+    queue = FakeQueue(25)
+    provider = SQSStreamProvider(queue=queue, wait_time='5')
+    file_urls = []
+    while True:
+        message = provider.get()
+        if message is None:
+            break
+        file_urls.append(message['file_url'])
+        provider.task_done(message['file_url'])
+    provider.close()
+    assert file_urls == [f's3://bucket/file_{n}.jsonl' for n in range(25)]
+    assert queue.receive_calls == [(10, 5)] * 4
+    assert [len(handles) for handles in queue.delete_calls] == [10, 10, 5]
+    assert sum(queue.delete_calls, []) == [f'handle_{n}' for n in range(25)]
+
+
+def test_non_blocking_receive():
+    queue = FakeQueue(1)
+    provider = SQSStreamProvider(queue=queue, batch_size='20')
+    provider.get(block=False)
+    assert queue.receive_calls == [(10, 0)]
+
+
+def test_visibility_heartbeat():
+    queue = FakeQueue(3)
+    provider = SQSStreamProvider(queue=queue, visibility_timeout='1')
+    provider.get()
+    time.sleep(0.8)
+    provider.close()
+    assert queue.visibility_calls
+    assert queue.visibility_calls[0] == ['handle_1', 'handle_2', 'handle_0']
+
+
+def test_visibility_heartbeat_keeps_done_messages():
+    queue = FakeQueue(3)
+    provider = SQSStreamProvider(queue=queue, visibility_timeout='1')
+    message = provider.get()
+    provider.task_done(message['file_url'])
+    # finished but not deleted yet, it must not come back while it waits for a full batch
+    time.sleep(1.2)
+    assert not queue.delete_calls
+    assert len(queue.visibility_calls) >= 2
+    assert all('handle_0' in handles for handles in queue.visibility_calls)
+    provider.close()
+    assert queue.delete_calls == [['handle_0']]
+
+
+def test_task_done_matches_file():
+    queue = FakeQueue(3)
+    provider = SQSStreamProvider(queue=queue)
+    provider.get()
+    provider.get()
+    provider.task_done('bucket//file_1.jsonl')
+    with pytest.raises(Exception):
+        provider.task_done('bucket/file_2.jsonl')
+    provider.close()
+    assert queue.delete_calls == [['handle_1']]
+
+
+def test_visibility_heartbeat_from_queue():
+    queue = FakeQueue(3, visibility_timeout=1)
+    provider = SQSStreamProvider(queue=queue)
+    provider.get()
+    time.sleep(0.8)
+    provider.close()
+    assert provider.visibility_timeout == 1
+    assert queue.visibility_calls[0] == ['handle_1', 'handle_2', 'handle_0']
+
+    queue = FakeQueue(3, visibility_timeout=1)
+    provider = SQSStreamProvider(queue=queue, visibility_timeout='0')
+    provider.get()
+    time.sleep(0.8)
+    provider.close()
+    assert not queue.visibility_calls
+
+
+def test_queue_looked_up_on_first_use(monkeypatch):
+    lookups = []
+
+    class FakeResource:
+        def get_queue_by_name(self, QueueName):
+            lookups.append(QueueName)
+            return FakeQueue(2)
+
+    monkeypatch.setattr('dataspin.providers.aws.get_aws_resource', lambda *args, **kwargs: FakeResource())
+    provider = SQSStreamProvider(name='events', access_key='key', secret_key='secret', region='us-east-1')
+    assert not lookups
+    assert provider.get(block=False) and provider.get(block=False)
+    assert lookups == ['events']
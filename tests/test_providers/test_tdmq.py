@@ -0,0 +1,168 @@
+import json
+
+import pulsar
+import pytest
+
+from dataspin.providers.tencent import TDMQStreamProvider
+
+
+class FakeMessage:
+    def __init__(self, n, body):
+        self.n = n
+        self._data = json.dumps(body).encode('utf-8')
+
+    def data(self):
+        return self._data
+
+
+class FakeConsumer:
+    def __init__(self, broker, batch_receive_policy):
+        self.broker = broker
+        self.batch_size = batch_receive_policy.policy().getMaxNumMessages()
+        self.acked = []
+        self.cumulative_acked = []
+
+    def batch_receive(self):
+        self.broker.batch_receive_calls += 1
+        batch, self.broker.messages = self.broker.messages[:self.batch_size], self.broker.messages[self.batch_size:]
+        return batch
+
+    def acknowledge(self, message):
+        self.acked.append(message.n)
+
+    def acknowledge_cumulative(self, message):
+        self.cumulative_acked.append(message.n)
+
+
+class FakeProducer:
+    def __init__(self, broker, **kwargs):
+        self.broker = broker
+        self.kwargs = kwargs
+        self.flushed = False
+
+    def send_async(self, content, callback):
+        self.broker.sent.append(json.loads(content))
+        callback(self.broker.send_result, len(self.broker.sent))
+
+    def flush(self):
+        self.flushed = True
+
+
+class FakeBroker:
+    """
+    In-process stand-in for a pulsar client and its topic.
+    """
+
+    def __init__(self, count):
+        self.messages = [FakeMessage(n, {'cos': {'cosBucket': {'name': 'bucket'},
+                                                 'cosObject': {'key': f'/file_{n}.jsonl'}}})
+                         for n in range(count)]
+        self.batch_receive_calls = 0
+        self.sent = []
+        self.send_result = pulsar.Result.Ok
+        self.consumer = None
+        self.consumer_type = None
+        self.producer = None
+
+    def subscribe(self, topic, subscription_name, consumer_type, batch_receive_policy):
+        self.consumer_type = consumer_type
+        self.consumer = FakeConsumer(self, batch_receive_policy)
+        return self.consumer
+
+    def create_producer(self, topic, **kwargs):
+        self.producer = FakeProducer(self, **kwargs)
+        return self.producer
+
+
+def consume_all(provider):
+    file_urls = []
+    while True:
+        message = provider.get(block=False)
+        if message is None:
+            break
+        file_urls.append(message['file_url'])
+        provider.task_done(message['file_url'])
+    provider.close()
+    return file_urls
+
+
+def test_batch_receive_and_ack():
+    broker = FakeBroker(25)
+    provider = TDMQStreamProvider(topic='topic', subscription_name='sub', client=broker, batch_size='10')
+    assert consume_all(provider) == [f'cos://bucket/file_{n}.jsonl' for n in range(25)]
+    assert broker.batch_receive_calls == 4
+    assert broker.consumer.acked == list(range(25))
+    assert broker.producer is None
+
+
+def test_cumulative_ack():
+    broker = FakeBroker(25)
+    provider = TDMQStreamProvider(topic='topic', subscription_name='sub', client=broker,
+                                  batch_size='10', ack_mode='cumulative')
+    consume_all(provider)
+    assert broker.consumer_type == pulsar.ConsumerType.Failover
+    assert broker.consumer.cumulative_acked == [9, 19, 24]
+
+
+def test_async_send():
+    broker = FakeBroker(0)
+    provider = TDMQStreamProvider(topic='topic', subscription_name='sub', client=broker)
+    provider.send_message({'data_format': 'dataspin', 'file_url': 'cos://bucket/a.jsonl'})
+    provider.send_message({'data_format': 'dataspin', 'file_url': 'cos://bucket/b.jsonl'})
+    provider.close()
+    assert [message['file_url'] for message in broker.sent] == ['cos://bucket/a.jsonl', 'cos://bucket/b.jsonl']
+    assert broker.producer.kwargs['batching_enabled']
+    assert broker.producer.flushed
+
+    broker.send_result = pulsar.Result.Timeout
+    provider.send_message({'data_format': 'dataspin', 'file_url': 'cos://bucket/c.jsonl'})
+    with pytest.raises(Exception):
+        provider.flush_sends()
+    provider.flush_sends()
+
+    provider.send_message({'data_format': 'dataspin', 'file_url': 'cos://bucket/d.jsonl'})
+    with pytest.raises(Exception):
+        provider.close()
+
+
+def test_connect_on_first_use(monkeypatch):
+    brokers = []
+
+    def get_client(host, token):
+        brokers.append(FakeBroker(1))
+        return brokers[-1]
+
+    monkeypatch.setattr('dataspin.providers.tencent.get_pulsar_client', get_client)
+    provider = TDMQStreamProvider(host='pulsar://host', token='token', topic='topic', subscription_name='sub')
+    assert not brokers
+    assert consume_all(provider) == ['cos://bucket/file_0.jsonl']
+    assert len(brokers) == 1 and brokers[0].consumer.acked == [0]
+
+
+def test_ack_failures_raised_on_close():
+    broker = FakeBroker(3)
+    provider = TDMQStreamProvider(topic='topic', subscription_name='sub', client=broker)
+
+    def fail(message):
+        raise RuntimeError('ack failed')
+
+    provider.consumer.acknowledge = fail
+    with pytest.raises(Exception, match='3 tdmq messages failed to acknowledge'):
+        consume_all(provider)
+    provider.close()
+
+
+def test_flush_after_close():
+    broker = FakeBroker(3)
+    provider = TDMQStreamProvider(topic='topic', subscription_name='sub', client=broker, batch_size='2')
+    message = provider.get(block=False)
+    provider.close()
+    provider.task_done(message['file_url'])
+    provider.flush()
+    assert broker.consumer.acked == [0]
+    assert provider._ack_executor is None
+
+    # the next run starts with get and acks in the background again
+    assert consume_all(provider) == ['cos://bucket/file_1.jsonl', 'cos://bucket/file_2.jsonl']
+    assert broker.consumer.acked == [0, 1, 2]
+    assert provider._ack_executor is None
@@ -0,0 +1,126 @@
+import json
+import os
+import sys
+import time
+
+import pytest
+
+from dataspin.runner import ProcessJobRunner, WorkerPoolJobRunner
+
+
+def write_project(tmp_path):
+    project = {
+        "dataspin": {"working_dir": str(tmp_path / 'work')},
+        "streams": [{"name": "source", "data_format": "dataspin", "url": "local://src"}],
+        "storages": [{"name": "target", "url": "file://out/"}],
+        "data_processes": [{"name": "flatten", "source": "source", "processes": [
+            {"name": "flatten", "function": "flatten"},
+            {"name": "save", "function": "save", "args": {"location": "target"}}]}]
+    }
+    project_path = tmp_path / 'project.json'
+    project_path.write_text(json.dumps(project))
+    return str(project_path)
+
+
+def test_worker_pool_runner(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(tmp_path / 'src')
+    (tmp_path / 'src' / 'a.jsonl').write_text('{"a": {"b": 1}}\n')
+    project_path = write_project(tmp_path)
+
+    runner = WorkerPoolJobRunner(process_count=2)
+    try:
+        runner.run(project_path, 'flatten')
+        runner.manage_loop(empty_exit=True)
+        assert (tmp_path / 'out' / 'a-flatten.jsonl').read_text() == '{"a.b": 1}\n'
+        worker_pid = runner._idle[0].process.pid
+
+        (tmp_path / 'src' / 'b.jsonl').write_text('{"b": {"c": 2}}\n')
+        runner.run(project_path, 'flatten')
+        runner.run(project_path, 'missing')
+        runner.manage_loop(empty_exit=True)
+        assert (tmp_path / 'out' / 'b-flatten.jsonl').exists()
+        assert worker_pid in [worker.process.pid for worker in runner._idle]
+        assert len(runner._idle) == 2
+
+        for worker in runner._idle:
+            worker.process.kill()
+            worker.process.join()
+        runner.run(project_path, 'flatten')
+        runner.manage_loop(empty_exit=True)
+        assert not runner._busy
+        assert runner.semaphore.acquire(blocking=False) and runner.semaphore.acquire(blocking=False)
+    finally:
+        runner.close()
+
+
+def test_worker_pool_rejects_log_max_size():
+    with pytest.raises(Exception, match='process runner'):
+        WorkerPoolJobRunner(process_count=1, log_max_size='1MB')
+
+
+class QuickJobRunner(ProcessJobRunner):
+    def command(self, job, run_id):
+        return [sys.executable, '-c', f'print("job {job[2]}")']
+
+
+@pytest.mark.parametrize('use_pidfd', [True, False])
+def test_process_runner_event_driven(use_pidfd, capsys):
+    runner = QuickJobRunner(process_count=2)
+    runner.use_pidfd = use_pidfd and runner.use_pidfd
+    for n in range(6):
+        runner.run('project.json', str(n))
+    assert len(runner.pending) == 6
+    started = time.monotonic()
+    runner.manage_loop(empty_exit=True)
+    assert time.monotonic() - started < 5
+    lines = capsys.readouterr().out.splitlines()
+    assert sorted(line.split('] ', 1)[1] for line in lines) == [f'job {n}' for n in range(6)]
+    assert all(line.startswith('[project/') for line in lines)
+    assert not runner.runners and runner.running == 0
+    runner.close()
+
+
+class NoisyJobRunner(ProcessJobRunner):
+    max_line_bytes = 100
+
+    def command(self, job, run_id):
+        script = 'import sys; print("x" * 250); sys.stdout.flush(); print("partial", end="")'
+        return [sys.executable, '-c', script]
+
+
+def test_process_runner_output(tmp_path, capsys):
+    runner = NoisyJobRunner(process_count=1, log_max_size='1KB')
+    runner.log_dirs['/projects/demo.json'] = str(tmp_path / 'logs')
+    runner.run('/projects/demo.json', 'split')
+    runner.manage_loop(empty_exit=True)
+    lines = capsys.readouterr().out.splitlines()
+    prefix = lines[0].split('] ', 1)[0] + ']'
+    assert prefix.startswith('[demo/split/PR')
+    assert [line[len(prefix) + 1:] for line in lines] == ['x' * 100, 'x' * 100, 'x' * 50, 'partial']
+    assert (tmp_path / 'logs' / 'split.log').read_text().splitlines() == lines
+    runner.close()
+
+
+class SleepJobRunner(ProcessJobRunner):
+    def command(self, job, run_id):
+        return [sys.executable, '-c', 'import time; time.sleep(0.2)']
+
+
+def test_overlap_policies():
+    runner = SleepJobRunner(process_count=4)
+    assert runner.run('project.json', 'skip', overlap_policy='skip')
+    assert not runner.run('project.json', 'skip', overlap_policy='skip')
+    assert runner.run('project.json', 'queue', overlap_policy='queue')
+    assert not runner.run('project.json', 'queue', overlap_policy='queue')
+    for n in range(3):
+        assert runner.run('project.json', 'allow', max_concurrent=2) == (n < 2)
+    runner._dispatch()
+    assert runner._running_by_process[('project.json', 'queue')] == 1
+    assert runner.run('project.json', 'queue', overlap_policy='queue')
+    runner._dispatch()
+    assert runner._running_by_process[('project.json', 'queue')] == 1
+    assert len(runner.pending) == 1
+    runner.manage_loop(empty_exit=True)
+    assert runner.queue_lags[('project.json', 'queue')] >= 0.1
+    runner.close()
@@ -0,0 +1,14 @@
+import pytest
+
+from dataspin.utils.common import parse_timestamp
+
+
+@pytest.mark.parametrize('value', [1646092800, 1646092800.5, '1646092800', 1646092800000, '1646092800000',
+                                   '2022-03-01T00:00:00Z', '2022-03-01 08:00:00+08:00'])
+def test_parse_timestamp(value):
+    assert parse_timestamp(value) == 1646092800
+
+
+def test_parse_timestamp_invalid():
+    with pytest.raises(Exception):
+        parse_timestamp('bad')
@@ -0,0 +1,114 @@
+import pytest
+
+from dataspin.functions.function import SplitByFunction, MergeFunction
+from dataspin.utils.multipart import MultipartWriter, DirectSaver
+
+
+class FakeUpload:
+    """
+    Records the calls of a multipart upload.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.completed = None
+        self.aborted = False
+        self.put_data = None
+
+    def writer(self, part_size):
+        return MultipartWriter(self.create, self.upload_part, self.complete, self.abort, self.put, part_size)
+
+    def create(self):
+        return 'upload-1'
+
+    def upload_part(self, upload_id, part_number, data):
+        self.parts.append(data)
+        return f'etag-{part_number}'
+
+    def complete(self, upload_id, parts):
+        self.completed = parts
+        return 'bucket/key'
+
+    def abort(self, upload_id):
+        self.aborted = True
+
+    def put(self, data):
+        self.put_data = data
+        return 'bucket/key'
+
+
+def test_parts_of_fixed_size():
+    upload = FakeUpload()
+    writer = upload.writer(part_size=10)
+    for n in range(5):
+        writer.write(b'record-%d\n' % n)
+    assert upload.parts == [b'record-0\nr', b'ecord-1\nre', b'cord-2\nrec', b'ord-3\nreco']
+    assert writer.commit() == 'bucket/key'
+    assert b''.join(upload.parts) == b''.join(b'record-%d\n' % n for n in range(5))
+    assert upload.completed == [(n, f'etag-{n}') for n in range(1, 6)]
+
+
+def test_small_output_single_put():
+    upload = FakeUpload()
+    writer = upload.writer(part_size=1024)
+    writer.write(b'{"a": 1}\n')
+    assert writer.commit() == 'bucket/key'
+    assert upload.put_data == b'{"a": 1}\n'
+    assert not upload.parts
+
+
+def test_abort():
+    upload = FakeUpload()
+    writer = upload.writer(part_size=4)
+    writer.write(b'0123456789')
+    writer.abort()
+    assert upload.aborted and upload.completed is None
+    with pytest.raises(ValueError):
+        writer.write(b'x')
+
+
+class FakeStorage:
+    def __init__(self):
+        self.uploads = []
+        self.provider = self
+
+    def open_multipart_writer(self, key):
+        upload = FakeUpload()
+        self.uploads.append((key, upload))
+        return upload.writer(part_size=4)
+
+
+class FakeContext:
+    def __init__(self, storage):
+        self.storage = storage
+
+    def temp_path(self, name):
+        return name
+
+    def create_file_saver(self, dst_path, tags=None):
+        key = (tags or {}).get('app_id', '') + '/' + dst_path
+        return DirectSaver(self.storage, key)
+
+
+class BrokenFile:
+    name = 'a'
+    tags = {'app_id': 'APP1'}
+
+    def readlines(self):
+        yield {'app_id': 'APP1'}, '{"app_id": "APP1"}'
+        yield {'app_id': 'APP2'}, '{"app_id": "APP2"}'
+        raise IOError('read failed')
+
+
+@pytest.mark.parametrize('function', [SplitByFunction({'key': ['app_id'], 'tags': {}}),
+                                      MergeFunction({})])
+def test_direct_uploads_aborted_on_error(function):
+    storage = FakeStorage()
+    context = FakeContext(storage)
+    context.data_file = BrokenFile()
+    with pytest.raises(IOError):
+        function.process(BrokenFile(), context)
+    assert storage.uploads
+    assert all(upload.aborted and upload.completed is None for _, upload in storage.uploads)
+    if isinstance(function, MergeFunction):
+        assert [key for key, _ in storage.uploads] == ['APP1/a-merge-default_0.jsonl']
@@ -0,0 +1,35 @@
+from io import BytesIO
+import os
+import time
+
+from dataspin.utils.object_cache import ObjectCache
+
+
+def test_read_through(tmp_path):
+    cache = ObjectCache(str(tmp_path), max_bytes=1024)
+    assert cache.get('bucket/a.jsonl', '"etag1"') is None
+    with cache.put('bucket/a.jsonl', '"etag1"', BytesIO(b'a' * 100)) as fp:
+        assert fp.read() == b'a' * 100
+    with cache.get('bucket/a.jsonl', '"etag1"') as fp:
+        assert fp.read() == b'a' * 100
+    assert cache.get('bucket/a.jsonl', '"etag2"') is None
+    assert cache.stats() == {'hits': 1, 'misses': 2, 'evictions': 0}
+
+    shared = ObjectCache(str(tmp_path), max_bytes=1024)
+    with shared.get('bucket/a.jsonl', '"etag1"') as fp:
+        assert fp.read() == b'a' * 100
+
+
+def test_lru_eviction(tmp_path):
+    cache = ObjectCache(str(tmp_path), max_bytes=250)
+    for name in ['a', 'b']:
+        cache.put(f'bucket/{name}', 'etag', BytesIO(b'x' * 100)).close()
+    # make b the least recently used
+    past = time.time() - 100
+    os.utime(cache._entry_path('bucket/b', 'etag'), (past, past))
+    cache.get('bucket/a', 'etag').close()
+    cache.put('bucket/c', 'etag', BytesIO(b'x' * 100)).close()
+    assert cache.get('bucket/b', 'etag') is None
+    cache.get('bucket/a', 'etag').close()
+    cache.get('bucket/c', 'etag').close()
+    assert cache.stats()['evictions'] == 1
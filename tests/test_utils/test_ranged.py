@@ -0,0 +1,44 @@
+import gzip
+import json
+import threading
+
+from dataspin.utils.file import DataFileReader
+from dataspin.utils.ranged import RangedReader, open_ranged
+
+
+def make_fetch_range(content, calls):
+    def fetch_range(start, end):
+        calls.append((start, end, threading.get_ident()))
+        return content[start:end + 1]
+    return fetch_range
+
+
+def test_ranged_reader_sequential():
+    content = bytes(range(256)) * 1000
+    calls = []
+    reader = RangedReader(make_fetch_range(content, calls), len(content), part_size=10000, concurrency=4)
+    assert reader.read() == content
+    assert [(start, end) for start, end, _ in calls][:3] == [(0, 9999), (10000, 19999), (20000, 29999)]
+    assert calls[-1][:2] == (250000, 255999)
+    assert len(calls) == 26
+    reader.close()
+
+
+def test_ranged_reader_empty():
+    calls = []
+    fp = open_ranged(make_fetch_range(b'', calls), 0)
+    assert fp.read() == b''
+    assert calls == []
+
+
+def test_ranged_reader_lines():
+    lines = [json.dumps({'event_id': i}) for i in range(5000)]
+    content = ('\n'.join(lines) + '\n').encode('utf-8')
+    fp = open_ranged(make_fetch_range(content, []), len(content), part_size=1000, concurrency=3)
+    records = [data['event_id'] for data, line in DataFileReader(file=fp, ext='.jsonl').readlines()]
+    assert records == list(range(5000))
+
+    content = gzip.compress(content)
+    fp = open_ranged(make_fetch_range(content, []), len(content), part_size=1000, concurrency=3)
+    records = [data['event_id'] for data, line in DataFileReader(file=fp, ext='.jsonl.gz').readlines()]
+    assert records == list(range(5000))
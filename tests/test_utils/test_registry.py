@@ -0,0 +1,55 @@
+import json
+import os
+
+from dataspin.utils.registry import RunRegistry
+
+
+def write_checkpoint(run_dir, name, success_flag=False):
+    os.makedirs(os.path.join(run_dir, 'meta', '_temp'))
+    with open(os.path.join(run_dir, 'meta', '_temp', 'meta_data.json'), 'w') as f:
+        json.dump({'name': name, 'success_flag': success_flag}, f)
+
+
+def test_seeded_once_from_existing_runs(tmp_path):
+    write_checkpoint(str(tmp_path / 'PRA'), 'flatten')
+    write_checkpoint(str(tmp_path / 'PRB'), 'split')
+    os.makedirs(tmp_path / 'PRC' / 'meta')
+    registry = RunRegistry(str(tmp_path))
+    assert registry.unfinished('flatten') == [('PRA', str(tmp_path / 'PRA'))]
+    assert registry.unfinished('split') == [('PRB', str(tmp_path / 'PRB'))]
+    registry.finish('PRA')
+    registry.close()
+
+    write_checkpoint(str(tmp_path / 'PRD'), 'flatten')
+    registry = RunRegistry(str(tmp_path))
+    assert registry.unfinished('flatten') == []
+
+
+def test_start_and_finish(tmp_path):
+    registry = RunRegistry(str(tmp_path))
+    registry.start('PR1', 'flatten', str(tmp_path / 'PR1'))
+    registry.start('PR2', 'flatten', str(tmp_path / 'PR2'))
+    registry.finish('PR1')
+    assert registry.unfinished('flatten') == [('PR2', str(tmp_path / 'PR2'))]
+    assert RunRegistry(str(tmp_path)).unfinished('flatten') == [('PR2', str(tmp_path / 'PR2'))]
+
+
+def test_prune_finished_runs(tmp_path, monkeypatch):
+    registry = RunRegistry(str(tmp_path))
+    for n, size in enumerate([300, 200, 100]):
+        run_dir = tmp_path / f'PR{n}'
+        os.makedirs(run_dir)
+        (run_dir / 'data.jsonl').write_bytes(b'x' * size)
+        registry.start(f'PR{n}', 'flatten', str(run_dir))
+        registry.finish(f'PR{n}', str(run_dir))
+    os.makedirs(tmp_path / 'PR3')
+    registry.start('PR3', 'flatten', str(tmp_path / 'PR3'))
+
+    assert registry.prune(max_bytes=350) == ['PR0']
+    assert not (tmp_path / 'PR0').exists() and (tmp_path / 'PR1').exists()
+    assert registry.prune(max_age=3600) == []
+
+    monkeypatch.setattr('time.time', lambda: os.stat(tmp_path / 'PR3').st_mtime + 7200)
+    assert registry.prune(max_age=3600) == ['PR1', 'PR2']
+    assert (tmp_path / 'PR3').exists()
+    assert registry.unfinished('flatten') == [('PR3', str(tmp_path / 'PR3'))]
@@ -1,7 +1,8 @@
-from dataspin.utils.schedule import scheduler_parser
+from dataspin.utils.schedule import scheduler_parser, Schedule, HeapScheduler
 from parsy import ParseError
 import pytest
-from datetime import timedelta
+import threading
+from datetime import datetime, timedelta
 
 def test_parse_simple_1():
     assert scheduler_parser.parse('every 1day') == ['every', timedelta(days=1)]
@@ -19,4 +20,32 @@ def test_parse_simple_2():
     assert scheduler_parser.parse('every hour at 2m3s') == ['every', timedelta(hours=1), 'at', timedelta(minutes=2, seconds=3)]
 
 def test_parse_simple_3():
-    assert scheduler_parser.parse('every week day 5 at 12h') == ['every', timedelta(weeks=1), 'day', [timedelta(days=4)], 'at', timedelta(hours=12)]
\ No newline at end of file
+    assert scheduler_parser.parse('every week day 5 at 12h') == ['every', timedelta(weeks=1), 'day', [timedelta(days=4)], 'at', timedelta(hours=12)]
+
+def test_next_fire_time():
+    now = datetime(2026, 10, 19, 13, 50, 7)
+    assert Schedule('every hour at 5m').next_after(now) == datetime(2026, 10, 19, 14, 5)
+    assert Schedule('every 10 minutes').next_after(now) == datetime(2026, 10, 19, 14, 0)
+    assert Schedule('every day at 12h30m').next_after(now) == datetime(2026, 10, 20, 12, 30)
+    assert Schedule('every week day 1,5').next_after(now) == datetime(2026, 10, 23)
+    assert Schedule('every month day 3 at 8h:30m').next_after(now) == datetime(2026, 11, 3, 8, 30)
+    assert Schedule('every 30 seconds').next_after(datetime(2026, 10, 19, 13, 50, 30)) == datetime(2026, 10, 19, 13, 51)
+
+
+def test_heap_scheduler():
+    fired = []
+    done = threading.Event()
+
+    def callback(name):
+        fired.append(name)
+        if len(fired) >= 3:
+            done.set()
+
+    scheduler = HeapScheduler()
+    scheduler.add('every 1 second', lambda: callback('fast'))
+    scheduler.add('every 1 hour', lambda: callback('slow'))
+    scheduler.start()
+    assert done.wait(5)
+    scheduler.stop()
+    assert set(fired) == {'fast'}
+    assert scheduler.lags['every 1 second'] < 1
@@ -0,0 +1,69 @@
+import threading
+import time
+
+import pytest
+
+from dataspin.utils.uploader import BackgroundUploader
+
+
+def test_concurrent_uploads():
+    uploader = BackgroundUploader(concurrency=4)
+    lock = threading.Lock()
+    state = {'running': 0, 'peak': 0}
+
+    def upload(n):
+        with lock:
+            state['running'] += 1
+            state['peak'] = max(state['peak'], state['running'])
+        time.sleep(0.05)
+        with lock:
+            state['running'] -= 1
+        return n
+
+    futures = [uploader.submit(upload, n) for n in range(12)]
+    assert uploader.wait_all(futures) == list(range(12))
+    assert state['peak'] == 4
+    uploader.close()
+
+
+def test_retry_with_backoff():
+    uploader = BackgroundUploader(retries=2, backoff=0.01)
+    calls = []
+
+    def flaky(n):
+        calls.append(n)
+        if len(calls) < 3:
+            raise ConnectionResetError('connection reset')
+        return n
+
+    assert uploader.wait_all([uploader.submit(flaky, 1)]) == [1]
+    assert len(calls) == 3
+
+    def broken():
+        raise ConnectionResetError('connection reset')
+
+    with pytest.raises(ConnectionResetError):
+        uploader.wait_all([uploader.submit(broken)])
+    uploader.close()
+
+
+def test_no_retry_on_permanent_errors():
+    from botocore.exceptions import ClientError, EndpointConnectionError
+
+    uploader = BackgroundUploader(retries=2, backoff=0.01)
+    for error, tries in [(FileNotFoundError('gone'), 1),
+                         (ClientError({'Error': {'Code': 'AccessDenied'},
+                                       'ResponseMetadata': {'HTTPStatusCode': 403}}, 'PutObject'), 1),
+                         (ClientError({'Error': {'Code': 'SlowDown'},
+                                       'ResponseMetadata': {'HTTPStatusCode': 503}}, 'PutObject'), 3),
+                         (EndpointConnectionError(endpoint_url='https://s3'), 3)]:
+        calls = []
+
+        def upload():
+            calls.append(1)
+            raise error
+
+        with pytest.raises(type(error)):
+            uploader.wait_all([uploader.submit(upload)])
+        assert len(calls) == tries
+    uploader.close()